@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""Benchmark the puzzle builder stage by stage on synthetic archives and record the results as JSON."""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import pickle
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, replace
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+
+try:
+    import resource
+except ModuleNotFoundError:
+    # Not available on Windows; peak RSS is then reported as null.
+    resource = None
+
+import build_lichess_puzzles
+from build_lichess_puzzles import BuilderConfig, PuzzleSeed
+from fixtures import default_config
+from synthetic_puzzles import PuzzleMix, write_synthetic_archive
+
+STAGES = ("parse_puzzle_seed", "choose_balanced", "write_outputs", "build_dataset", "end_to_end")
+RESULTS_VERSION = 1
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark builder stages on synthetic archives")
+    parser.add_argument("--rows", default="20000,100000", help="Comma-separated archive sizes in rows")
+    parser.add_argument("--seed", type=int, default=1, help="Synthetic archive seed")
+    parser.add_argument("--malformed-rate", type=float, default=0.01, help="Share of malformed rows")
+    parser.add_argument("--illegal-rate", type=float, default=0.01, help="Share of rows with an illegal move")
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"Comma-separated subset of: {', '.join(STAGES)}")
+    parser.add_argument("--workers", type=int, default=1, help="Builder --workers for build_dataset/end_to_end")
+    parser.add_argument("--index-dir", default=None, help="Builder --index-dir; the index is written before timing")
+    parser.add_argument("--target-per-combo", type=int, default=80, help="Builder --target-per-combo")
+    parser.add_argument("--candidate-multiplier", type=int, default=6, help="Builder --candidate-multiplier")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per stage; the fastest is recorded")
+    parser.add_argument("--archive-dir", default=".cache/bench", help="Where generated archives are kept for reuse")
+    parser.add_argument("--output", default=None, help="Results file (default: .cache/bench/builder-<commit>.json)")
+    parser.add_argument("--compare", default=None, help="Earlier results file to compare against")
+    return parser.parse_args()
+
+
+def git_commit() -> Optional[str]:
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).resolve().parent
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip() or None
+
+
+def peak_rss_bytes() -> Optional[int]:
+    """High-water RSS of this process and of any builder workers it waited for."""
+    if resource is None:
+        return None
+    # ru_maxrss is in KiB on Linux and in bytes on macOS.
+    scale = 1 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) * scale
+
+
+def group_by_combo(candidates: List[PuzzleSeed]) -> Dict[str, Dict[str, List[PuzzleSeed]]]:
+    grouped: Dict[str, Dict[str, List[PuzzleSeed]]] = defaultdict(lambda: defaultdict(list))
+    for seed in candidates:
+        grouped[build_lichess_puzzles.combo_key(seed)][seed.motif].append(seed)
+    return grouped
+
+
+def select_all(config: BuilderConfig, grouped: Dict[str, Dict[str, List[PuzzleSeed]]]) -> Dict[str, List[PuzzleSeed]]:
+    # The selection loop of build_dataset.
+    rng = random.Random(config.seed)
+    selected: Dict[str, List[PuzzleSeed]] = {}
+    for key, seeds_by_motif in sorted(grouped.items()):
+        target = min(config.target_per_combo, sum(len(items) for items in seeds_by_motif.values()))
+        if target > 0:
+            selected[key] = build_lichess_puzzles.choose_balanced(
+                seeds_by_motif,
+                target,
+                config.backrank_max_share,
+                config.max_single_motif_share,
+                rng
+            )
+    return selected
+
+
+def prepare_inputs(config: BuilderConfig, work_dir: Path) -> Path:
+    """Precompute each stage's input once, so isolated stages only time their own work."""
+    rows: List[Dict[str, str]] = []
+    with build_lichess_puzzles.open_puzzle_stream(config) as stream:
+        rows.extend(build_lichess_puzzles.make_row_reader(config, stream, Counter()))
+    scan = build_lichess_puzzles.scan_candidates(config)
+    selected = select_all(config, group_by_combo(scan.candidates))
+    path = work_dir / "inputs.pickle"
+    with open(path, "wb") as handle:
+        pickle.dump({"rows": rows, "candidates": scan.candidates, "selected": selected}, handle)
+    return path
+
+
+def run_stage(stage: str, config: BuilderConfig, inputs_path: Path, output_dir: Path) -> Dict[str, object]:
+    """Run one stage in this (fresh) process and measure it."""
+    with open(inputs_path, "rb") as handle:
+        inputs = pickle.load(handle)
+    config = replace(config, output_dir=output_dir)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        started = time.perf_counter()
+        if stage == "parse_puzzle_seed":
+            rejections: Counter[str] = Counter()
+            for row in inputs["rows"]:
+                build_lichess_puzzles.parse_puzzle_seed(row, config, rejections)
+            items = len(inputs["rows"])
+        elif stage == "choose_balanced":
+            grouped = group_by_combo(inputs["candidates"])
+            started = time.perf_counter()
+            select_all(config, grouped)
+            items = len(inputs["candidates"])
+        elif stage == "write_outputs":
+            build_lichess_puzzles.write_outputs(config, inputs["selected"])
+            items = sum(len(seeds) for seeds in inputs["selected"].values())
+        elif stage == "build_dataset":
+            _, items = build_lichess_puzzles.build_dataset(config)
+        elif stage == "end_to_end":
+            selected_by_combo, items = build_lichess_puzzles.build_dataset(config)
+            build_lichess_puzzles.write_outputs(config, selected_by_combo)
+        else:
+            raise ValueError(f"Unknown stage: {stage}")
+        elapsed = time.perf_counter() - started
+
+    return {"items": items, "wallSeconds": elapsed, "peakRssBytes": peak_rss_bytes()}
+
+
+# What "items" counts for each stage, for the rate column.
+STAGE_UNITS = {
+    "parse_puzzle_seed": "rows reaching the parser",
+    "choose_balanced": "candidates",
+    "write_outputs": "puzzles written",
+    "build_dataset": "archive rows",
+    "end_to_end": "archive rows"
+}
+
+
+def measure(stage: str, config: BuilderConfig, inputs_path: Path, output_dir: Path, repeat: int) -> Dict[str, object]:
+    best: Optional[Dict[str, object]] = None
+    spawn = multiprocessing.get_context("spawn")
+    for _ in range(max(1, repeat)):
+        # A new process per run keeps peak RSS specific to the stage.
+        with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+            run = pool.submit(run_stage, stage, config, inputs_path, output_dir).result()
+        if best is None or run["wallSeconds"] < best["wallSeconds"]:
+            best = run
+    assert best is not None
+    seconds = float(best["wallSeconds"])
+    return {
+        "stage": stage,
+        "unit": STAGE_UNITS[stage],
+        "items": best["items"],
+        "wallSeconds": round(seconds, 6),
+        "itemsPerSecond": round(int(best["items"]) / seconds, 1) if seconds > 0 else None,
+        "peakRssBytes": best["peakRssBytes"]
+    }
+
+
+def compare(results: Dict[str, object], baseline_path: Path) -> None:
+    baseline = json.loads(baseline_path.read_text(encoding="utf-8"))
+    previous = {(item["stage"], item["rows"]): item for item in baseline["results"]}
+    print(f"Compared with {baseline_path} ({baseline.get('commit') or 'unknown commit'}):")
+    for item in results["results"]:
+        old = previous.get((item["stage"], item["rows"]))
+        if old is None:
+            continue
+        speedup = old["wallSeconds"] / item["wallSeconds"] if item["wallSeconds"] else float("inf")
+        memory = ""
+        if item["peakRssBytes"] and old["peakRssBytes"]:
+            memory = f"  peak RSS x{item['peakRssBytes'] / old['peakRssBytes']:.2f}"
+        print(f"  {item['stage']:18} {item['rows']:>9} rows  {old['wallSeconds']:8.3f}s -> {item['wallSeconds']:8.3f}s  x{speedup:.2f} faster{memory}")
+
+
+def main() -> None:
+    args = parse_args()
+    stages = [stage for stage in args.stages.split(",") if stage]
+    unknown = sorted(set(stages).difference(STAGES))
+    if unknown:
+        raise SystemExit(f"Unknown stages: {', '.join(unknown)}")
+    mix = PuzzleMix(malformed_rate=args.malformed_rate, illegal_rate=args.illegal_rate)
+    archive_dir = Path(args.archive_dir).expanduser()
+    commit = git_commit()
+
+    results: Dict[str, object] = {
+        "version": RESULTS_VERSION,
+        "createdAt": datetime.now(timezone.utc).isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {
+            "seed": args.seed,
+            "mix": asdict(mix),
+            "workers": args.workers,
+            "indexed": args.index_dir is not None,
+            "targetPerCombo": args.target_per_combo,
+            "candidateMultiplier": args.candidate_multiplier
+        },
+        "results": []
+    }
+
+    for rows in [int(value) for value in args.rows.split(",") if value]:
+        archive = archive_dir / f"synthetic-{rows}-s{args.seed}-m{args.malformed_rate}-i{args.illegal_rate}.csv.zst"
+        if not archive.exists():
+            started = time.perf_counter()
+            write_synthetic_archive(archive, rows, args.seed, mix)
+            print(f"Generated {archive} in {time.perf_counter() - started:.1f}s")
+
+        config = replace(
+            default_config(),
+            input_path=archive,
+            seed=args.seed,
+            workers=args.workers,
+            target_per_combo=args.target_per_combo,
+            candidate_multiplier=args.candidate_multiplier,
+            index_dir=Path(args.index_dir).expanduser() if args.index_dir else None
+        )
+        with tempfile.TemporaryDirectory() as temp:
+            work_dir = Path(temp)
+            with contextlib.redirect_stdout(io.StringIO()):
+                inputs_path = prepare_inputs(config, work_dir)
+            for stage in stages:
+                result = {"rows": rows, **measure(stage, config, inputs_path, work_dir / "out", args.repeat)}
+                results["results"].append(result)
+                rss = result["peakRssBytes"]
+                rss_text = f"{rss / 2 ** 20:8.1f} MiB" if rss else "     n/a"
+                rate = result["itemsPerSecond"]
+                print(
+                    f"{stage:18} {rows:>9} rows  {result['wallSeconds']:8.3f}s"
+                    f"  {rate or 0:>12,.0f} {result['unit']}/s  peak RSS {rss_text}"
+                )
+
+    output = Path(args.output).expanduser() if args.output else archive_dir / f"builder-{commit or 'local'}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2), encoding="utf-8")
+    print(f"Wrote {output}")
+    if args.compare:
+        compare(results, Path(args.compare).expanduser())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""Measure the memory the builder's candidate pool takes as --candidate-multiplier grows."""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import io
+import multiprocessing
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import replace
+from pathlib import Path
+from typing import Dict, List
+
+import build_lichess_puzzles
+from bench_builder import peak_rss_bytes
+from fixtures import default_config
+from synthetic_puzzles import PuzzleMix, write_synthetic_archive
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Measure candidate pool memory per --candidate-multiplier")
+    parser.add_argument("--input", default=None, help="Puzzle archive (default: a generated synthetic archive)")
+    parser.add_argument("--rows", type=int, default=200000, help="Rows in the generated synthetic archive")
+    parser.add_argument("--seed", type=int, default=1, help="Synthetic archive seed")
+    parser.add_argument("--multipliers", default="6,20,60", help="Comma-separated --candidate-multiplier values")
+    parser.add_argument("--target-per-combo", type=int, default=80, help="Builder --target-per-combo")
+    parser.add_argument("--archive-dir", default=".cache/bench", help="Where generated archives are kept for reuse")
+    return parser.parse_args()
+
+
+def measure(archive: Path, target_per_combo: int, multiplier: int) -> Dict[str, object]:
+    """Scan in this (fresh) process; report what the accepted pool keeps alive."""
+    config = replace(
+        default_config(),
+        input_path=archive,
+        target_per_combo=target_per_combo,
+        candidate_multiplier=multiplier,
+        # Keep more synthetic rows, so large multipliers still fill up.
+        min_popularity=0,
+        min_nb_plays=0
+    )
+    tracemalloc.start()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        scan = build_lichess_puzzles.scan_candidates(config)
+    elapsed = time.perf_counter() - started
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "candidates": len(scan.candidates),
+        "retainedBytes": retained,
+        "tracedPeakBytes": peak,
+        "peakRssBytes": peak_rss_bytes(),
+        "wallSeconds": elapsed
+    }
+
+
+def main() -> None:
+    args = parse_args()
+    if args.input:
+        archive = Path(args.input).expanduser()
+    else:
+        mix = PuzzleMix()
+        archive = Path(args.archive_dir).expanduser() / f"synthetic-{args.rows}-s{args.seed}-m{mix.malformed_rate}-i{mix.illegal_rate}.csv.zst"
+        if not archive.exists():
+            write_synthetic_archive(archive, args.rows, args.seed, mix)
+
+    multipliers: List[int] = [int(value) for value in args.multipliers.split(",") if value]
+    spawn = multiprocessing.get_context("spawn")
+    for multiplier in multipliers:
+        # A new process per run keeps the RSS high-water mark specific to it.
+        with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+            result = pool.submit(measure, archive, args.target_per_combo, multiplier).result()
+        candidates = int(result["candidates"])
+        per_candidate = int(result["retainedBytes"]) / candidates if candidates else 0.0
+        rss = result["peakRssBytes"]
+        rss_text = f"{int(rss) / 2 ** 20:8.1f} MiB" if rss else "     n/a"
+        print(
+            f"multiplier {multiplier:>3}  {candidates:>8} candidates  retained {int(result['retainedBytes']) / 2 ** 20:7.1f} MiB"
+            f"  ({per_candidate:6.0f} B/candidate)  traced peak {int(result['tracedPeakBytes']) / 2 ** 20:7.1f} MiB"
+            f"  peak RSS {rss_text}  {float(result['wallSeconds']):6.1f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
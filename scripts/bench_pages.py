@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Compare bytes transferred per puzzle served by whole-combo shards and by paged shards."""
+
+from __future__ import annotations
+
+import argparse
+import gzip
+import hashlib
+import json
+import random
+import re
+from pathlib import Path
+from typing import Dict, List
+
+from build_lichess_puzzles import paginate
+
+SHARD_NAME = re.compile(r"p(\d+)/r(\d+)\.json$")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark bytes per served puzzle for whole and paged shards")
+    parser.add_argument("--input", default="public/puzzles", help="Output directory of an unpaged JSON-format build")
+    parser.add_argument("--page-sizes", default="25,50,100", help="Comma-separated page sizes to compare")
+    parser.add_argument("--served", default="1,5,20", help="Comma-separated puzzles served per combo in one session")
+    parser.add_argument("--trials", type=int, default=200, help="Simulated sessions per combo")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for page picks")
+    return parser.parse_args()
+
+
+def encoded_sizes(entries: List[Dict[str, object]]) -> tuple[int, int]:
+    data = json.dumps(entries, ensure_ascii=False).encode("utf-8")
+    return len(data), len(gzip.compress(data, 9))
+
+
+def page_manifest_bytes(page_counts: List[int]) -> int:
+    """Size of one combo's manifest "pages" list, the price of paging a combo."""
+    entries = [
+        {"path": f"lichess/p0/r0000.p{page}.json", "sha256": hashlib.sha256(b"").hexdigest(), "bytes": 0, "puzzles": count}
+        for page, count in enumerate(page_counts)
+    ]
+    return len(json.dumps(entries))
+
+
+def simulate(page_sizes: List[tuple[int, int]], served: int, trials: int, rng: random.Random) -> tuple[float, float]:
+    """Average (raw, gzip) bytes a session fetches to serve ``served`` puzzles.
+
+    ``page_sizes`` holds (puzzles, (raw, gzip)) per page; pages are picked like
+    the web client does, weighted by puzzle count, and each page is fetched once.
+    """
+    weights = [puzzles for puzzles, _ in page_sizes]
+    raw_total = 0
+    gzip_total = 0
+    for _ in range(trials):
+        fetched = set(rng.choices(range(len(page_sizes)), weights=weights, k=served))
+        for page in fetched:
+            raw_total += page_sizes[page][1][0]
+            gzip_total += page_sizes[page][1][1]
+    return raw_total / trials, gzip_total / trials
+
+
+def main() -> None:
+    args = parse_args()
+    lichess_dir = Path(args.input).expanduser() / "lichess"
+    shard_paths = [path for path in sorted(lichess_dir.glob("p*/r*.json")) if SHARD_NAME.search(path.as_posix())]
+    if not shard_paths:
+        raise SystemExit(f"No unpaged JSON shards found under {lichess_dir}")
+    combos = [json.loads(path.read_bytes()) for path in shard_paths]
+    puzzles = sum(map(len, combos))
+    page_sizes = [int(value) for value in args.page_sizes.split(",") if value]
+    served_counts = [int(value) for value in args.served.split(",") if value]
+    print(f"{len(combos)} combos, {puzzles} puzzles, {puzzles / len(combos):.0f} per combo on average")
+
+    layouts: Dict[str, List[List[tuple[int, tuple[int, int]]]]] = {"whole": [[(len(entries), encoded_sizes(entries))] for entries in combos]}
+    for size in page_sizes:
+        layouts[f"pages of {size}"] = [
+            [(len(page), encoded_sizes(list(page))) for page in paginate(entries, size)]
+            for entries in combos
+        ]
+
+    for served in served_counts:
+        print(f"Serving {served} puzzle(s) per combo session:")
+        for name, combo_pages in layouts.items():
+            rng = random.Random(args.seed)
+            raw = 0.0
+            gzipped = 0.0
+            manifest = 0
+            for pages in combo_pages:
+                combo_raw, combo_gzip = simulate(pages, served, args.trials, rng)
+                raw += combo_raw
+                gzipped += combo_gzip
+                if name != "whole":
+                    manifest += page_manifest_bytes([count for count, _ in pages])
+            per_puzzle = len(combo_pages) * served
+            print(
+                f"  {name:14} {raw / per_puzzle:9.0f} B/puzzle  gzip {gzipped / per_puzzle:8.0f} B/puzzle"
+                f"  manifest +{manifest:,} B"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""Compare row throughput of the columnar reader against csv.DictReader."""
+
+from __future__ import annotations
+
+import argparse
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Callable, Optional
+
+import zstandard
+
+from build_lichess_puzzles import (
+    BuilderConfig,
+    accepts_themes,
+    fen_may_fit_piece_range,
+    parse_int_field,
+    parse_themes,
+    rating_bucket_for,
+    row_filter_for
+)
+from fixtures import default_config
+from lichess_reader import NEEDED_COLUMNS, ColumnarPuzzleReader, CsvPuzzleReader
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark puzzle CSV readers in rows/s")
+    parser.add_argument("--input", default="lichess_db_puzzle.csv.zst", help="Path to lichess_db_puzzle.csv.zst")
+    parser.add_argument("--max-rows", type=int, default=None, help="Optional cap on rows read per run")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per reader; the best run is reported")
+    return parser.parse_args()
+
+
+class FilteredCsvReader(CsvPuzzleReader):
+    """The pre-columnar path: DictReader rows run through the string-level stages of parse_puzzle_seed."""
+
+    def __init__(self, stream, config: BuilderConfig, max_rows: Optional[int] = None) -> None:
+        super().__init__(stream, max_rows=max_rows)
+        self.config = config
+
+    def __iter__(self):
+        config = self.config
+        for row in super().__iter__():
+            if any(row.get(column) is None for column in NEEDED_COLUMNS):
+                continue
+            try:
+                fen = row["FEN"]
+                rating = int(row["Rating"])
+                moves = [move for move in row["Moves"].split(" ") if move]
+            except (KeyError, ValueError):
+                continue
+            if not row["PuzzleId"] or not fen or len(moves) < 2 or not fen_may_fit_piece_range(fen, config):
+                continue
+            rating_bucket = rating_bucket_for(rating, config.bucket_size)
+            if rating_bucket < config.min_rating or rating_bucket > config.max_rating:
+                continue
+            if (
+                parse_int_field(row, "Popularity") < config.min_popularity
+                or parse_int_field(row, "NbPlays") < config.min_nb_plays
+            ):
+                continue
+            if not accepts_themes(parse_themes(row.get("Themes", ""))):
+                continue
+            yield row
+
+
+def run_reader(input_path: Path, max_rows: Optional[int], make_reader: Callable) -> tuple[int, int, float]:
+    """Return (rows scanned, rows yielded, seconds) for one full pass."""
+    dctx = zstandard.ZstdDecompressor()
+    started = time.perf_counter()
+    with open(input_path, "rb") as compressed:
+        with dctx.stream_reader(compressed) as stream:
+            reader = make_reader(stream, max_rows)
+            survivors = sum(1 for _ in reader)
+    return reader.rows_scanned, survivors, time.perf_counter() - started
+
+
+def main() -> None:
+    args = parse_args()
+    input_path = Path(args.input).expanduser()
+    config = default_config()
+    row_filter = row_filter_for(config)
+
+    readers = {
+        "csv (filtered)": lambda stream, max_rows: FilteredCsvReader(stream, config, max_rows=max_rows),
+        "csv.DictReader": lambda stream, max_rows: CsvPuzzleReader(stream, max_rows=max_rows),
+        "columnar (no filter)": lambda stream, max_rows: ColumnarPuzzleReader(stream, max_rows=max_rows),
+        "columnar (filtered)": lambda stream, max_rows: ColumnarPuzzleReader(
+            stream, row_filter, Counter(), max_rows=max_rows
+        )
+    }
+
+    # Rates are relative to the first entry, the path the builder used before the columnar reader.
+    baseline: Optional[float] = None
+    for name, make_reader in readers.items():
+        runs = [run_reader(input_path, args.max_rows, make_reader) for _ in range(max(1, args.repeat))]
+        rows, survivors, elapsed = min(runs, key=lambda run: run[2])
+        rate = rows / elapsed if elapsed > 0 else float("inf")
+        baseline = baseline or rate
+        print(f"{name:22} {rows:>9} rows  {survivors:>9} yielded  {elapsed:7.3f}s  {rate:>12,.0f} rows/s  x{rate / baseline:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""Time replay_line against the previous legal_moves/gives_check/san replay."""
+
+from __future__ import annotations
+
+import argparse
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence
+
+from build_lichess_puzzles import BuilderConfig, ReplayedLine, replay_line
+from fixtures import default_config, lines_to_replay, replay_line_reference
+from synthetic_puzzles import PuzzleMix, write_synthetic_archive
+
+Replayer = Callable[[str, Sequence[str], BuilderConfig, Optional[Counter[str]]], Optional[ReplayedLine]]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark line replay on the rows that reach it")
+    parser.add_argument("--input", default=None, help="Puzzle archive (default: a generated synthetic archive)")
+    parser.add_argument("--rows", type=int, default=100000, help="Rows in the generated synthetic archive")
+    parser.add_argument("--seed", type=int, default=1, help="Synthetic archive seed")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per replayer; the best run is reported")
+    parser.add_argument("--archive-dir", default=".cache/bench", help="Where generated archives are kept for reuse")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    if args.input:
+        archive = Path(args.input).expanduser()
+    else:
+        mix = PuzzleMix()
+        archive = Path(args.archive_dir).expanduser() / f"synthetic-{args.rows}-s{args.seed}-m{mix.malformed_rate}-i{mix.illegal_rate}.csv.zst"
+        if not archive.exists():
+            write_synthetic_archive(archive, args.rows, args.seed, mix)
+
+    config = default_config()
+    lines = lines_to_replay(archive, config)
+    print(f"{len(lines)} lines to replay")
+
+    replayers: Dict[str, Replayer] = {"reference": replay_line_reference, "replay_line": replay_line}
+    results: Dict[str, tuple[List[Optional[ReplayedLine]], Counter[str]]] = {}
+    for name, replayer in replayers.items():
+        best = float("inf")
+        for _ in range(max(1, args.repeat)):
+            rejections: Counter[str] = Counter()
+            started = time.perf_counter()
+            replayed = [replayer(fen, moves, config, rejections) for fen, moves in lines]
+            best = min(best, time.perf_counter() - started)
+        results[name] = (replayed, rejections)
+        accepted = sum(1 for line in replayed if line is not None)
+        print(f"  {name:12} {len(lines) / best:10,.0f} lines/s  {best:7.3f}s  {accepted} replayed")
+    if results["replay_line"] != results["reference"]:
+        raise SystemExit("replay_line differs from the reference replay")
+
+
+if __name__ == "__main__":
+    main()
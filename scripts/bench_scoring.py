@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""Compare per-row filtering and scoring against the NumPy batches of --vectorize."""
+
+from __future__ import annotations
+
+import argparse
+import time
+from collections import Counter
+from dataclasses import replace
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import build_lichess_puzzles
+from build_lichess_puzzles import PuzzleSeed, ReplayState, batched, parse_or_skip, parse_puzzle_batch, replayed_line_of
+from fixtures import default_config
+from lichess_reader import CsvPuzzleReader
+from synthetic_puzzles import PuzzleMix, write_synthetic_archive
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark scalar and batched NumPy filtering and scoring in rows/s")
+    parser.add_argument("--input", default=None, help="Puzzle archive (default: a generated synthetic archive)")
+    parser.add_argument("--rows", type=int, default=100000, help="Rows in the generated synthetic archive")
+    parser.add_argument("--seed", type=int, default=1, help="Synthetic archive seed")
+    parser.add_argument("--batch-sizes", default="64,256,1024,4096,16384", help="Comma-separated --batch-size values")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per variant; the best run is reported")
+    parser.add_argument("--archive-dir", default=".cache/bench", help="Where generated archives are kept for reuse")
+    return parser.parse_args()
+
+
+def read_rows(archive: Path) -> List[Dict[str, str]]:
+    # The csv reader applies no filters, so every numeric check runs in the parser.
+    config = replace(default_config(), input_path=archive)
+    with build_lichess_puzzles.open_puzzle_stream(config) as stream:
+        return list(CsvPuzzleReader(stream))
+
+
+def main() -> None:
+    args = parse_args()
+    if build_lichess_puzzles.numpy is None:
+        raise SystemExit("NumPy is not installed: python -m pip install numpy")
+    if args.input:
+        archive = Path(args.input).expanduser()
+    else:
+        mix = PuzzleMix()
+        archive = Path(args.archive_dir).expanduser() / f"synthetic-{args.rows}-s{args.seed}-m{mix.malformed_rate}-i{mix.illegal_rate}.csv.zst"
+        if not archive.exists():
+            write_synthetic_archive(archive, args.rows, args.seed, mix)
+
+    config = replace(default_config(), input_path=archive)
+    rows: List[Optional[Dict[str, str]]] = list(read_rows(archive))
+    # Replay every line once up front and reuse it in the timed runs, so they
+    # measure the filters and scoring rather than python-chess.
+    reference = [parse_or_skip(row, config, Counter()) for row in rows]
+    replay_state: ReplayState = {
+        seed.puzzle_id: (seed.line_fingerprint, replayed_line_of(seed)) for seed in reference if seed is not None
+    }
+    accepted = sum(1 for seed in reference if seed is not None)
+    print(f"{len(rows)} rows, {accepted} accepted, lines replayed ahead of timing")
+
+    def run_scalar() -> List[Optional[PuzzleSeed]]:
+        rejections: Counter[str] = Counter()
+        return [parse_or_skip(row, config, rejections, replay_state) for row in rows]
+
+    def run_batched(size: int) -> List[Optional[PuzzleSeed]]:
+        rejections: Counter[str] = Counter()
+        results: List[Optional[PuzzleSeed]] = []
+        for batch in batched(rows, size):
+            results.extend(parse_puzzle_batch(batch, config, rejections, replay_state))
+        return results
+
+    batch_sizes = [int(value) for value in args.batch_sizes.split(",") if value]
+    variants = [("scalar", run_scalar)]
+    variants.extend((f"batch {size}", lambda size=size: run_batched(size)) for size in batch_sizes)
+    for name, run in variants:
+        best = float("inf")
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            results = run()
+            best = min(best, time.perf_counter() - started)
+        if results != reference:
+            raise SystemExit(f"{name}: results differ from the scalar parser")
+        print(f"  {name:12} {len(rows) / best:12,.0f} rows/s  {best:7.3f}s")
+
+
+if __name__ == "__main__":
+    main()
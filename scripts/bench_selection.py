@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Time choose_balanced against the previous sort-and-scan selector as pools grow."""
+
+from __future__ import annotations
+
+import argparse
+import random
+import time
+from typing import Callable, Dict, List
+
+from build_lichess_puzzles import MOTIF_PRIORITY, PuzzleSeed, choose_balanced
+from fixtures import choose_balanced_reference, synthetic_pool
+
+Selector = Callable[[Dict[str, List[PuzzleSeed]], int, float, float, random.Random], List[PuzzleSeed]]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark balanced selection on synthetic candidate pools")
+    parser.add_argument(
+        "--sizes",
+        default="480,5000,20000,100000",
+        help="Comma-separated candidates per combo"
+    )
+    parser.add_argument(
+        "--target-ratio",
+        type=int,
+        default=6,
+        help="Pool size / target, i.e. --candidate-multiplier (default: 6)"
+    )
+    parser.add_argument("--seed", type=int, default=7, help="Seed for the pools and the selection rng")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per selector; the best run is reported")
+    parser.add_argument("--skip-reference-above", type=int, default=100000, help="Skip the old selector for larger pools")
+    return parser.parse_args()
+
+
+def timed(
+    selector: Selector,
+    pool: Dict[str, List[PuzzleSeed]],
+    target: int,
+    seed: int,
+    repeat: int
+) -> tuple[List[str], float]:
+    timings: List[float] = []
+    for _ in range(max(1, repeat)):
+        rng = random.Random(seed)
+        started = time.perf_counter()
+        selected = selector(pool, target, 0.2, 0.45, rng)
+        timings.append(time.perf_counter() - started)
+    # Include the rng state so a later combo would see the same draws.
+    return [item.puzzle_id for item in selected] + [str(rng.random())], min(timings)
+
+
+def main() -> None:
+    args = parse_args()
+    sizes = [int(value) for value in args.sizes.split(",") if value]
+    scenarios = {
+        # Every motif plentiful: the round-robin alone fills the target.
+        "mixed": {motif: 1.0 for motif in MOTIF_PRIORITY},
+        # Mostly back-rank mates: the share limits stall the round-robin and
+        # the leftover passes have to fill the target.
+        "skewed": {"backrank": 20.0, "mate": 2.0, "fork": 1.0}
+    }
+    for name, weights in scenarios.items():
+        for size in sizes:
+            pool = synthetic_pool(size, random.Random(args.seed), weights)
+            target = max(1, size // args.target_ratio)
+            selected_ids, elapsed = timed(choose_balanced, pool, target, args.seed, args.repeat)
+            line = f"{name:7} {size:>7} candidates  target {target:>6}  deque {elapsed * 1000:9.1f} ms"
+            if size <= args.skip_reference_above:
+                reference_ids, reference_time = timed(choose_balanced_reference, pool, target, args.seed, args.repeat)
+                if reference_ids != selected_ids:
+                    raise SystemExit(f"Selections differ for {name} at {size} candidates")
+                line += f"  list {reference_time * 1000:9.1f} ms  x{reference_time / elapsed:6.1f}  identical"
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
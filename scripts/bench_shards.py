@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Compare size and parse time of JSON and columnar puzzle shards."""
+
+from __future__ import annotations
+
+import argparse
+import gzip
+import json
+import re
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from build_lichess_puzzles import decode_columnar_shard, encode_columnar_shard
+
+SHARD_NAME = re.compile(r"p(\d+)/r(\d+)\.json$")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark columnar puzzle shards against the JSON shards")
+    parser.add_argument("--input", default="public/puzzles", help="Output directory of a JSON-format build")
+    parser.add_argument("--repeat", type=int, default=5, help="Parse runs per format; the best run is reported")
+    return parser.parse_args()
+
+
+def best_time(repeat: int, action: Callable[[], object]) -> float:
+    timings: List[float] = []
+    for _ in range(max(1, repeat)):
+        started = time.perf_counter()
+        action()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main() -> None:
+    args = parse_args()
+    lichess_dir = Path(args.input).expanduser() / "lichess"
+    shard_paths = sorted(lichess_dir.glob("p*/r*.json"))
+    shard_paths = [path for path in shard_paths if SHARD_NAME.search(path.as_posix())]
+    if not shard_paths:
+        raise SystemExit(f"No JSON shards found under {lichess_dir}")
+
+    json_blobs: List[bytes] = []
+    columnar_blobs: List[bytes] = []
+    combos: List[tuple[int, int]] = []
+    puzzles = 0
+    for path in shard_paths:
+        match = SHARD_NAME.search(path.as_posix())
+        assert match is not None
+        combo = (int(match.group(1)), int(match.group(2)))
+        entries = json.loads(path.read_bytes())
+        json_blob = json.dumps(entries, ensure_ascii=False).encode("utf-8")
+        columnar_blob = json.dumps(encode_columnar_shard(entries), ensure_ascii=False).encode("utf-8")
+        if decode_columnar_shard(json.loads(columnar_blob), *combo) != entries:
+            raise SystemExit(f"Columnar round trip changed {path}")
+        json_blobs.append(json_blob)
+        columnar_blobs.append(columnar_blob)
+        combos.append(combo)
+        puzzles += len(entries)
+
+    sizes: Dict[str, tuple[int, int]] = {
+        "json": (sum(map(len, json_blobs)), sum(len(gzip.compress(blob, 9)) for blob in json_blobs)),
+        "columnar": (sum(map(len, columnar_blobs)), sum(len(gzip.compress(blob, 9)) for blob in columnar_blobs))
+    }
+    print(f"{len(shard_paths)} shards, {puzzles} puzzles")
+    json_raw, json_gzip = sizes["json"]
+    for name, (raw, gzipped) in sizes.items():
+        print(
+            f"{name:9} {raw:>10,} B  ({raw / puzzles:6.1f} B/puzzle, x{raw / json_raw:.2f})"
+            f"  gzip {gzipped:>9,} B  ({gzipped / puzzles:5.1f} B/puzzle, x{gzipped / json_gzip:.2f})"
+        )
+
+    json_parse = best_time(args.repeat, lambda: [json.loads(blob) for blob in json_blobs])
+    columnar_parse = best_time(args.repeat, lambda: [json.loads(blob) for blob in columnar_blobs])
+    columnar_decode = best_time(args.repeat, lambda: [
+        decode_columnar_shard(json.loads(blob), *combo) for blob, combo in zip(columnar_blobs, combos)
+    ])
+    print(f"json.loads   json {json_parse * 1000:8.2f} ms   columnar {columnar_parse * 1000:8.2f} ms  x{columnar_parse / json_parse:.2f}")
+    # Full decoding rebuilds pieces and move text with python-chess; clients
+    # that only need some fields can skip most of that work.
+    print(f"full decode  columnar {columnar_decode * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
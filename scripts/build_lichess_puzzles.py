@@ -4,30 +4,71 @@
 from __future__ import annotations
 
 import argparse
-import csv
+import gzip
+import hashlib
+import heapq
 import io
+import itertools
 import json
 import math
+import mmap
+import operator
+import os
 import random
-import shutil
+import sqlite3
 import sys
-from collections import defaultdict
-from dataclasses import dataclass
+import time
+from collections import ChainMap, Counter, defaultdict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+from dataclasses import asdict, dataclass, field, fields, replace
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Dict, List, Optional, Sequence
+from typing import BinaryIO, ContextManager, Deque, Dict, Iterable, Iterator, List, MutableMapping, Optional, Sequence, Tuple, TypeVar, Union, get_args, get_type_hints
 
 import chess
+import requests
+from download_lichess_db import PUZZLE_DB_URL, ArchiveVerificationError, new_session, remote_info, stream_archive
+from lichess_reader import NEEDED_COLUMNS, ColumnarPuzzleReader, CsvPuzzleReader, LineIndex, RowFilter, read_line_index, write_line_index
 try:
     import zstandard
 except ModuleNotFoundError:
     print("Missing dependency: zstandard", file=sys.stderr)
     print("Install it with: python -m pip install -r requirements.txt", file=sys.stderr)
     sys.exit(1)
+try:
+    import brotli
+except ModuleNotFoundError:
+    # Optional: only needed for the .br siblings written by --precompress.
+    brotli = None
+try:
+    import numpy
+except ModuleNotFoundError:
+    # Optional: only needed for --vectorize.
+    numpy = None
 
 MANIFEST_VERSION = 6
+# The replaced manifest; the files it names outlive it by one build.
+PREVIOUS_MANIFEST_NAME = "manifest.previous.json"
 SOURCE_NAME = "lichess_db"
 PUZZLE_SOURCE = "lichess_static"
+SHARD_FORMATS = ("json", "columnar")
+CANDIDATE_POOLS = ("first", "best")
+READERS = ("columnar", "csv")
+CACHE_KEYS = ("mtime", "hash")
+SHARD_PATTERNS = {
+    "json": "lichess/p{pieceCount}/r{ratingBucket}.json",
+    "columnar": "lichess/p{pieceCount}/r{ratingBucket}.cols.json"
+}
+PAGED_SHARD_PATTERNS = {
+    "json": "lichess/p{pieceCount}/r{ratingBucket}.p{page}.json",
+    "columnar": "lichess/p{pieceCount}/r{ratingBucket}.p{page}.cols.json"
+}
+COLUMNAR_SHARD_VERSION = 1
+HASHED_NAME_DIGITS = 16
+PRECOMPRESSED_SUFFIXES = ("gz", "br", "zst")
+
+T = TypeVar("T")
 
 TACTICAL_THEMES = {
     "mate",
@@ -120,27 +161,157 @@ class BuilderConfig:
     max_single_motif_share: float
     max_rows: Optional[int]
     seed: Optional[int]
+    workers: int = 1
+    batch_size: int = 2000
+    stop_when_saturated: bool = False
+    reader: str = "columnar"
+    cache_dir: Optional[Path] = None
+    cache_key: str = "mtime"
+    incremental: bool = False
+    state_file: Optional[Path] = None
+    input_url: Optional[str] = None
+    tee_input: bool = False
+    shard_format: str = "json"
+    hash_shards: bool = False
+    precompress: bool = False
+    stats_json: Optional[Path] = None
+    candidate_db: Optional[Path] = None
+    page_size: int = 0
+    candidate_pool: str = "first"
+    vectorize: bool = False
+    profiles: Optional[Path] = None
+    index_dir: Optional[Path] = None
+
+
+# BuilderConfig fields that hold a Path, for configs read back from JSON.
+PATH_FIELDS = (
+    "input_path",
+    "output_dir",
+    "cache_dir",
+    "state_file",
+    "stats_json",
+    "candidate_db",
+    "profiles",
+    "index_dir"
+)
 
-
-@dataclass
+# Allowed values of the BuilderConfig fields that the CLI offers as choices.
+SETTING_CHOICES = {
+    "reader": READERS,
+    "cache_key": CACHE_KEYS,
+    "shard_format": SHARD_FORMATS,
+    "candidate_pool": CANDIDATE_POOLS
+}
+# The JSON values that can stand for each BuilderConfig field type.
+_JSON_TYPES = {int: (int,), float: (int, float), bool: (bool,), str: (str,), Path: (str,)}
+_JSON_TYPE_NAMES = {int: "an integer", float: "a number", bool: "true or false", str: "a string", Path: "a path string"}
+
+
+def setting_error(name: str, value: object) -> Optional[str]:
+    """Why ``value``, read from JSON, can't be the BuilderConfig field ``name``; None if it can."""
+    hint = get_type_hints(BuilderConfig)[name]
+    optional = type(None) in get_args(hint)
+    expected = next(arg for arg in get_args(hint) if arg is not type(None)) if optional else hint
+    if value is None:
+        return None if optional else f"{name} must not be null"
+    if isinstance(value, bool) != (expected is bool) or not isinstance(value, _JSON_TYPES[expected]):
+        return f"{name} must be {_JSON_TYPE_NAMES[expected]}{' or null' if optional else ''}"
+    choices = SETTING_CHOICES.get(name)
+    if choices is not None and value not in choices:
+        return f"{name} must be one of {', '.join(choices)}"
+    return None
+
+
+def config_error(config: BuilderConfig) -> Optional[str]:
+    """The first combination of settings the builder refuses, or None."""
+    if config.workers < 1:
+        return "--workers must be at least 1"
+    if config.batch_size < 1:
+        return "--batch-size must be at least 1"
+    if config.tee_input and config.input_url is None:
+        return "--tee requires --input-url"
+    if config.page_size < 0:
+        return "--page-size must not be negative"
+    if config.candidate_pool == "best" and config.stop_when_saturated:
+        return "--stop-when-saturated needs --candidate-pool first"
+    if config.vectorize and numpy is None:
+        return "--vectorize needs NumPy: python -m pip install numpy"
+    if config.precompress and brotli is None:
+        return "--precompress needs brotli for the .br siblings: python -m pip install brotli"
+    return None
+
+
+@dataclass(slots=True)
 class PuzzleSeed:
+    """One accepted candidate, kept small because the scan holds thousands.
+
+    Themes and SAN moves are interned tuples (see ``interned``). The side to
+    move, piece lists and continuation text follow from ``fen`` and
+    ``continuation_san``, so they are derived on access, which in a build only
+    happens for the selected puzzles that ``as_output`` writes.
+    """
+
     puzzle_id: str
     fen: str
-    side_to_move: str
     piece_count: int
     rating_bucket: int
-    white_pieces: List[str]
-    black_pieces: List[str]
-    continuation_san: List[str]
-    continuation_text: str
-    themes: List[str]
+    continuation_san: Tuple[str, ...]
+    themes: Tuple[str, ...]
     motif: str
     simplicity_score: float
+    rating: int
+    popularity: int
+    nb_plays: int
+    first_move_forcing: bool
+    line_fingerprint: str = ""
+
+    @property
+    def side_to_move(self) -> str:
+        return self.fen.split(" ", 2)[1]
+
+    def piece_lists(self) -> tuple[List[str], List[str]]:
+        """(white, black) piece tokens, e.g. ``["Kg1", "Qd1"]``."""
+        return tokenise_pieces(chess.Board(self.fen))
+
+    @property
+    def continuation_text(self) -> str:
+        return continuation_text(self.fen, self.continuation_san)
+
+
+def interned(items: Iterable[str]) -> Tuple[str, ...]:
+    # Theme names and SAN moves repeat across puzzles; share one string each.
+    return tuple(map(sys.intern, items))
+
+
+@dataclass
+class CandidateScan:
+    """Accepted candidates in acceptance order, plus the scan that produced them."""
+
+    candidates: List[PuzzleSeed]
+    combo_cap: int
+    scanned: int
+    rejections: Counter[str]
+    saturated: bool
+    # Only filled when config.stats_json is set.
+    timings: Counter[str] = field(default_factory=Counter)
+    saturated_at_row: Dict[str, int] = field(default_factory=dict)
 
 
 def parse_args() -> BuilderConfig:
     parser = argparse.ArgumentParser(description="Build static puzzle shards from lichess_db_puzzle.csv.zst")
     parser.add_argument("--input", default="lichess_db_puzzle.csv.zst", help="Path to lichess_db_puzzle.csv.zst")
+    parser.add_argument(
+        "--input-url",
+        nargs="?",
+        const=PUZZLE_DB_URL,
+        default=None,
+        help="Stream the archive from this URL (default: the Lichess puzzle database) instead of reading --input"
+    )
+    parser.add_argument(
+        "--tee",
+        action="store_true",
+        help="With --input-url, also save the streamed archive to --input"
+    )
     parser.add_argument("--output", default="public/puzzles", help="Output directory for static puzzle assets")
     parser.add_argument("--min-piece-count", type=int, default=3, help="Minimum total pieces (incl. kings)")
     parser.add_argument("--max-piece-count", type=int, default=8, help="Maximum total pieces (incl. kings)")
@@ -156,9 +327,97 @@ def parse_args() -> BuilderConfig:
     parser.add_argument("--max-single-motif-share", type=float, default=0.45, help="Max share for any non-backrank motif per combo")
     parser.add_argument("--max-rows", type=int, default=None, help="Optional cap on CSV rows scanned (for quick iteration)")
     parser.add_argument("--seed", type=int, default=None, help="Optional random seed")
+    parser.add_argument("--workers", type=int, default=1, help="Parser processes (1 = parse in the reading process)")
+    parser.add_argument("--batch-size", type=int, default=2000, help="CSV rows per batch handed to a parser process or scored by --vectorize")
+    parser.add_argument(
+        "--index-dir",
+        default=None,
+        help="Decompress the archive once into this directory with a row-offset index; later builds read that copy, "
+        "and --workers read disjoint row ranges of it"
+    )
+    parser.add_argument(
+        "--stop-when-saturated",
+        action="store_true",
+        help="Stop reading the archive once every expected combo has a full candidate pool"
+    )
+    parser.add_argument(
+        "--profiles",
+        default=None,
+        help="JSON file of named build profiles that share one archive scan (see README)"
+    )
+    parser.add_argument(
+        "--vectorize",
+        action="store_true",
+        help="Apply the numeric filters and compute scores with NumPy over batches of --batch-size rows"
+    )
+    parser.add_argument(
+        "--candidate-pool",
+        choices=CANDIDATE_POOLS,
+        default="first",
+        help="Keep the first candidates per combo in file order (default), or scan the whole archive "
+        "and keep the best --target-per-combo per combo and motif by simplicity score"
+    )
+    parser.add_argument(
+        "--reader",
+        choices=READERS,
+        default="columnar",
+        help="Row reader: byte-level columnar reader (default) or csv.DictReader"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Directory for the parsed-candidate cache; rebuilds that only change selection settings skip the archive scan"
+    )
+    parser.add_argument(
+        "--cache-key",
+        choices=CACHE_KEYS,
+        default="mtime",
+        help="Identify the input archive by size+mtime (default) or by a SHA-256 of its contents"
+    )
+    parser.add_argument(
+        "--shard-format",
+        choices=SHARD_FORMATS,
+        default="json",
+        help="Shard encoding: one JSON object per puzzle (default, read by the web client) or a compact columnar layout"
+    )
+    parser.add_argument(
+        "--hash-shards",
+        action="store_true",
+        help="Put a content hash in each shard filename and list every shard's path, SHA-256 and size in the manifest"
+    )
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=0,
+        help="Split each combo into shard pages of at most this many puzzles (0 = one shard per combo)"
+    )
+    parser.add_argument(
+        "--precompress",
+        action="store_true",
+        help="Also write .gz, .br and .zst siblings of every output file at max compression (needs the brotli package)"
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Reuse replays from the previous build's state file and only rewrite shards whose contents changed"
+    )
+    parser.add_argument(
+        "--state-file",
+        default=".cache/puzzles/build-state.json.zst",
+        help="Build state used by --incremental"
+    )
+    parser.add_argument(
+        "--stats-json",
+        default=None,
+        help="Write per-stage timings, rejection counts and per-combo fill rates to this JSON file"
+    )
+    parser.add_argument(
+        "--candidate-db",
+        default=None,
+        help="Also store the candidate pool, capped per combo like the scan, in this SQLite database (see scripts/query_candidates.py)"
+    )
     args = parser.parse_args()
-
-    return BuilderConfig(
+    config = BuilderConfig(
         input_path=Path(args.input).expanduser(),
         output_dir=Path(args.output).expanduser(),
         min_piece_count=args.min_piece_count,
@@ -174,8 +433,32 @@ def parse_args() -> BuilderConfig:
         backrank_max_share=args.backrank_max_share,
         max_single_motif_share=args.max_single_motif_share,
         max_rows=args.max_rows,
-        seed=args.seed
+        seed=args.seed,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        stop_when_saturated=args.stop_when_saturated,
+        reader=args.reader,
+        cache_dir=Path(args.cache_dir).expanduser() if args.cache_dir else None,
+        cache_key=args.cache_key,
+        incremental=args.incremental,
+        state_file=Path(args.state_file).expanduser() if args.incremental else None,
+        input_url=args.input_url,
+        tee_input=args.tee,
+        shard_format=args.shard_format,
+        hash_shards=args.hash_shards,
+        precompress=args.precompress,
+        stats_json=Path(args.stats_json).expanduser() if args.stats_json else None,
+        candidate_db=Path(args.candidate_db).expanduser() if args.candidate_db else None,
+        page_size=args.page_size,
+        candidate_pool=args.candidate_pool,
+        vectorize=args.vectorize,
+        profiles=Path(args.profiles).expanduser() if args.profiles else None,
+        index_dir=Path(args.index_dir).expanduser() if args.index_dir else None
     )
+    error = config_error(config)
+    if error is not None:
+        parser.error(error)
+    return config
 
 
 def rating_bucket_for(rating: int, bucket_size: int) -> int:
@@ -204,8 +487,11 @@ def tokenise_pieces(board: chess.Board) -> tuple[List[str], List[str]]:
 
 def continuation_text(fen: str, san_line: Sequence[str]) -> str:
     board = chess.Board(fen)
-    move_number = board.fullmove_number
-    turn = board.turn
+    return numbered_line(board.fullmove_number, board.turn, san_line)
+
+
+def numbered_line(move_number: int, turn: chess.Color, san_line: Sequence[str]) -> str:
+    """``san_line`` with move numbers, starting at ``move_number`` with ``turn`` to move."""
     tokens: List[str] = []
     for index, san in enumerate(san_line):
         if turn == chess.WHITE:
@@ -304,102 +590,552 @@ def simplicity_score_for(
     return score
 
 
-def parse_puzzle_seed(row: Dict[str, str], config: BuilderConfig) -> Optional[PuzzleSeed]:
-    try:
-        puzzle_id = row["PuzzleId"]
-        fen = row["FEN"]
-        rating = int(row["Rating"])
-        moves_uci = [move for move in row["Moves"].split(" ") if move]
-    except (KeyError, ValueError):
-        return None
+# log10(nbPlays) / 5 reaches the 1.0 cap at this many plays.
+_PLAYS_BONUS_CAP = 100000
+_plays_bonus_table: Optional["numpy.ndarray"] = None
 
-    if not puzzle_id or not fen or len(moves_uci) < 2:
-        return None
 
-    rating_bucket = rating_bucket_for(rating, config.bucket_size)
-    if rating_bucket < config.min_rating or rating_bucket > config.max_rating:
-        return None
+def plays_bonus_table() -> "numpy.ndarray":
+    """The plays bonus for 0.._PLAYS_BONUS_CAP plays, computed with ``math.log10``.
 
-    popularity = parse_int_field(row, "Popularity", default=0)
-    nb_plays = parse_int_field(row, "NbPlays", default=0)
-    if popularity < config.min_popularity or nb_plays < config.min_nb_plays:
-        return None
+    NumPy's own log10 may differ from the C library's in the last bit, so the
+    vectorized scores look the bonus up instead of recomputing it.
+    """
+    global _plays_bonus_table
+    if _plays_bonus_table is None:
+        _plays_bonus_table = numpy.array(
+            [max(0.0, min(1.0, math.log10(max(1, plays)) / 5)) for plays in range(_PLAYS_BONUS_CAP + 1)],
+            dtype=numpy.float64
+        )
+    return _plays_bonus_table
+
+
+def simplicity_scores_for(
+    themes: Sequence[Sequence[str]],
+    ratings: "numpy.ndarray",
+    popularities: "numpy.ndarray",
+    nb_plays: "numpy.ndarray",
+    line_plies: "numpy.ndarray",
+    first_move_forcing: "numpy.ndarray",
+    config: BuilderConfig
+) -> "numpy.ndarray":
+    """``simplicity_score_for`` over arrays, bit-identical to the scalar version.
 
-    themes = parse_themes(row.get("Themes", ""))
-    if not accepts_themes(themes):
+    Every term is added in the same order with the same float64 operations; a
+    bonus the scalar version skips is added as 0.0, which changes nothing.
+    """
+    rating_span = max(1, config.max_rating - config.min_rating)
+    bounded_rating = numpy.clip(ratings, config.min_rating, config.max_rating)
+    lower_rating_bonus = (config.max_rating - bounded_rating) / rating_span
+    short_line_bonus = (config.max_plies - numpy.maximum(1, line_plies) + 1) / max(1, config.max_plies)
+    popularity_bonus = numpy.clip(popularities / 100.0, 0.0, 1.0)
+    plays_bonus = plays_bonus_table()[numpy.clip(nb_plays, 0, _PLAYS_BONUS_CAP)]
+
+    mate_bonus = numpy.zeros(len(themes))
+    tactic_bonus = numpy.zeros(len(themes))
+    for index, row_themes in enumerate(themes):
+        theme_set = set(row_themes)
+        if {"oneMove", "mateIn1"}.intersection(theme_set):
+            mate_bonus[index] = 0.9
+        elif "mateIn2" in theme_set:
+            mate_bonus[index] = 0.7
+        elif "mateIn3" in theme_set:
+            mate_bonus[index] = 0.4
+        if {"fork", "skewer", "hangingPiece"}.intersection(theme_set):
+            tactic_bonus[index] = 0.3
+
+    score = numpy.zeros(len(themes))
+    score += 1.5 * lower_rating_bonus
+    score += 1.3 * short_line_bonus
+    score += 0.8 * popularity_bonus
+    score += 0.6 * plays_bonus
+    score += numpy.where(first_move_forcing, 0.8, 0.0)
+    score += mate_bonus
+    score += tactic_bonus
+    return score
+
+
+REJECTION_STAGES = (
+    "fields",
+    "fen_prefilter",
+    "rating",
+    "popularity",
+    "themes",
+    "board",
+    "piece_count",
+    "line",
+    "duplicate",
+    "combo_full",
+    "outranked"
+)
+
+_NON_PIECE_CHARS = str.maketrans("", "", "12345678/")
+
+
+def fen_piece_count(fen: str) -> int:
+    """Count pieces in the FEN placement field without building a board."""
+    placement = fen.split(" ", 1)[0]
+    return len(placement.translate(_NON_PIECE_CHARS))
+
+
+def fen_may_fit_piece_range(fen: str, config: BuilderConfig) -> bool:
+    # The setup move can capture at most one piece, so the puzzle position has
+    # either the same number of pieces as the FEN or one fewer.
+    pieces_before_setup = fen_piece_count(fen)
+    return pieces_before_setup - 1 <= config.max_piece_count and pieces_before_setup >= config.min_piece_count
+
+
+def _square_index(name: str) -> Optional[int]:
+    if len(name) != 2 or name[0] not in "abcdefgh" or name[1] not in "12345678":
         return None
+    # Index into the expanded placement string, which runs from a8 to h1.
+    return (7 - (ord(name[1]) - ord("1"))) * 8 + (ord(name[0]) - ord("a"))
 
-    try:
-        board = chess.Board(fen)
-    except ValueError:
+
+def fen_piece_count_after_setup(fen: str, setup_uci: str) -> Optional[int]:
+    """Predict the puzzle position's piece count from strings alone.
+
+    Assumes the setup move is legal; rows where it is not are rejected later by
+    the full replay anyway.
+    """
+    fields = fen.split(" ")
+    squares = "".join("." * int(char) if char.isdigit() else char for char in fields[0].replace("/", ""))
+    from_index = _square_index(setup_uci[0:2])
+    to_index = _square_index(setup_uci[2:4])
+    if len(squares) != 64 or from_index is None or to_index is None:
         return None
 
-    working = board.copy(stack=False)
+    piece_count = 64 - squares.count(".")
+    if squares[to_index] != ".":
+        return piece_count - 1
+    is_pawn = squares[from_index] in "Pp"
+    if is_pawn and setup_uci[0] != setup_uci[2] and len(fields) > 3 and fields[3] == setup_uci[2:4]:
+        return piece_count - 1
+    return piece_count
+
+
+def predicted_combo_key(row: Dict[str, str], config: BuilderConfig) -> Optional[str]:
     try:
-        setup_move = chess.Move.from_uci(moves_uci[0])
-    except ValueError:
+        rating = int(row["Rating"])
+        fen = row["FEN"]
+        setup_uci = row["Moves"].split(" ", 1)[0]
+    except (KeyError, TypeError, AttributeError, ValueError):
+        # Missing or None (short csv.DictReader rows) fields; parse_puzzle_seed rejects the row.
         return None
-    if setup_move not in working.legal_moves:
+    piece_count = fen_piece_count_after_setup(fen, setup_uci)
+    if piece_count is None:
         return None
-    working.push(setup_move)
+    return f"p{piece_count}-r{rating_bucket_for(rating, config.bucket_size)}"
 
-    puzzle_board = working.copy(stack=False)
-    piece_count = len(puzzle_board.piece_map())
-    if piece_count < config.min_piece_count or piece_count > config.max_piece_count:
-        return None
 
-    side_to_move = "w" if puzzle_board.turn == chess.WHITE else "b"
-    white_tokens, black_tokens = tokenise_pieces(puzzle_board)
+def expected_rating_buckets(config: BuilderConfig) -> List[int]:
+    first_bucket = -(-config.min_rating // config.bucket_size) * config.bucket_size
+    return list(range(first_bucket, config.max_rating + 1, config.bucket_size))
 
-    continuation_uci = moves_uci[1:]
-    if len(continuation_uci) == 0 or len(continuation_uci) > config.max_plies:
-        return None
 
+def expected_combo_keys(config: BuilderConfig) -> set[str]:
+    return {
+        f"p{piece_count}-r{rating_bucket}"
+        for piece_count in range(config.min_piece_count, config.max_piece_count + 1)
+        for rating_bucket in expected_rating_buckets(config)
+    }
+
+
+def _reject(rejections: Optional[Counter[str]], stage: str) -> None:
+    if rejections is not None:
+        rejections[stage] += 1
+
+
+# Stages reported in the --stats-json "stageSeconds" section.
+TIMING_STAGES = (
+    "decompress",
+    "csv_parse",
+    "themes",
+    "board",
+    "replay",
+    "selection"
+)
+
+
+class _StageTiming:
+    __slots__ = ("timings", "stage", "started")
+
+    def __init__(self, timings: Counter[str], stage: str) -> None:
+        self.timings = timings
+        self.stage = stage
+        self.started = 0.0
+
+    def __enter__(self) -> None:
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.timings[self.stage] += time.perf_counter() - self.started
+
+
+_UNTIMED = nullcontext()
+
+
+def time_stage(timings: Optional[Counter[str]], stage: str) -> ContextManager[None]:
+    """Add the seconds spent in the ``with`` block to ``timings[stage]``, if timing."""
+    if timings is None:
+        return _UNTIMED
+    return _StageTiming(timings, stage)
+
+
+class TimedStream(io.RawIOBase):
+    """Read-through wrapper that adds the time spent in reads to ``timings[stage]``."""
+
+    def __init__(self, stream: BinaryIO, timings: Counter[str], stage: str = "decompress") -> None:
+        super().__init__()
+        self.stream = stream
+        self.timings = timings
+        self.stage = stage
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: bytearray) -> int:
+        started = time.perf_counter()
+        try:
+            return self.stream.readinto(buffer)
+        finally:
+            self.timings[self.stage] += time.perf_counter() - started
+
+
+def timed_iter(items: Iterable[T], timings: Counter[str], stage: str) -> Iterator[T]:
+    """Yield from ``items``, adding the time spent producing each item to ``timings[stage]``."""
+    iterator = iter(items)
+    while True:
+        started = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            timings[stage] += time.perf_counter() - started
+            return
+        timings[stage] += time.perf_counter() - started
+        yield item
+
+
+@dataclass(frozen=True, slots=True)
+class ReplayedLine:
+    """Everything parse_puzzle_seed derives from replaying a row's FEN and Moves."""
+
+    fen: str
+    piece_count: int
+    continuation_san: Tuple[str, ...]
+    first_move_forcing: bool
+
+
+# The stages replay_line rejects rows at.
+REPLAY_STAGES = ("board", "piece_count", "line")
+
+# (line fingerprint, replayed line or the REPLAY_STAGES entry that rejected it).
+ReplayRecord = tuple[str, Union[ReplayedLine, str]]
+# PuzzleId -> replay record of every row that reached the replay.
+ReplayState = MutableMapping[str, ReplayRecord]
+
+
+def line_fingerprint(fen: str, moves: str) -> str:
+    return hashlib.blake2b(f"{fen}|{moves}".encode("utf-8"), digest_size=8).hexdigest()
+
+
+def sparse_fen(board: chess.Board) -> str:
+    """``board.fen()``, built from the occupied squares only.
+
+    ``fen()`` looks up all 64 squares, while puzzle positions in the piece
+    range hold a handful of pieces.
+    """
+    ranks: List[str] = []
+    for rank_mask in reversed(chess.BB_RANKS):
+        text = ""
+        next_file = 0
+        for square in chess.scan_forward(board.occupied & rank_mask):
+            file = chess.square_file(square)
+            if file > next_file:
+                text += str(file - next_file)
+            text += board.piece_at(square).symbol()
+            next_file = file + 1
+        if next_file < 8:
+            text += str(8 - next_file)
+        ranks.append(text)
+    en_passant = chess.SQUARE_NAMES[board.ep_square] if board.has_legal_en_passant() else "-"
+    turn = "w" if board.turn == chess.WHITE else "b"
+    return f"{'/'.join(ranks)} {turn} {board.castling_xfen()} {en_passant} {board.halfmove_clock} {board.fullmove_number}"
+
+
+def play_line(board: chess.Board, moves_uci: Sequence[str]) -> Optional[tuple[List[str], bool]]:
+    """Play ``moves_uci`` on ``board``; their SAN and whether the first move is forcing.
+
+    Validation costs what it did: ``is_legal`` and the SAN disambiguation
+    and mate test still generate moves. The saving is that ``san_and_push``
+    pushes the move once and leaves the position that tells whether it gave
+    check, where ``gives_check`` and ``san`` each pushed and popped it again.
+    None when a move is malformed or illegal.
+    """
     san_line: List[str] = []
     first_move_forcing = False
-    for index, uci in enumerate(continuation_uci):
+    for uci in moves_uci:
         try:
             move = chess.Move.from_uci(uci)
         except ValueError:
             return None
-        if move not in working.legal_moves:
+        if not board.is_legal(move):
             return None
-        if index == 0:
-            first_move_forcing = working.is_capture(move) or working.gives_check(move)
-        san_line.append(working.san(move))
-        working.push(move)
+        capture = board.is_capture(move)
+        san_line.append(board.san_and_push(move))
+        if len(san_line) == 1:
+            first_move_forcing = capture or board.is_check()
+    return san_line, first_move_forcing
+
+
+def replay_line(
+    fen: str,
+    moves_uci: Sequence[str],
+    config: BuilderConfig,
+    rejections: Optional[Counter[str]] = None,
+    timings: Optional[Counter[str]] = None
+) -> Optional[ReplayedLine]:
+    with time_stage(timings, "board"):
+        try:
+            board = chess.Board(fen)
+        except ValueError:
+            return _reject(rejections, "board")
+
+        try:
+            setup_move = chess.Move.from_uci(moves_uci[0])
+        except ValueError:
+            return _reject(rejections, "board")
+        if not board.is_legal(setup_move):
+            return _reject(rejections, "board")
+        board.push(setup_move)
+
+        piece_count = chess.popcount(board.occupied)
+        if piece_count < config.min_piece_count or piece_count > config.max_piece_count:
+            return _reject(rejections, "piece_count")
+        puzzle_fen = sparse_fen(board)
+
+    continuation_uci = moves_uci[1:]
+    if len(continuation_uci) == 0 or len(continuation_uci) > config.max_plies:
+        return _reject(rejections, "line")
+
+    with time_stage(timings, "replay"):
+        played = play_line(board, continuation_uci)
+    if played is None:
+        return _reject(rejections, "line")
+    san_line, first_move_forcing = played
+
+    return ReplayedLine(
+        fen=puzzle_fen,
+        piece_count=piece_count,
+        continuation_san=interned(san_line),
+        first_move_forcing=first_move_forcing
+    )
+
+
+RowFields = tuple[str, str, int, List[str]]
+
+
+def row_fields(row: Dict[str, str], config: BuilderConfig, rejections: Optional[Counter[str]] = None) -> Optional[RowFields]:
+    """(puzzle id, FEN, rating, UCI moves) of a well-formed row that may fit the piece range."""
+    # csv.DictReader fills the missing columns of a short row with None; the
+    # columnar reader rejects the same rows as "fields".
+    if any(row.get(column) is None for column in NEEDED_COLUMNS):
+        return _reject(rejections, "fields")
+    try:
+        puzzle_id = row["PuzzleId"]
+        fen = row["FEN"]
+        rating = int(row["Rating"])
+        moves_uci = [move for move in row["Moves"].split(" ") if move]
+    except (KeyError, ValueError):
+        return _reject(rejections, "fields")
+
+    if not puzzle_id or not fen or len(moves_uci) < 2:
+        return _reject(rejections, "fields")
+
+    if not fen_may_fit_piece_range(fen, config):
+        return _reject(rejections, "fen_prefilter")
+    return puzzle_id, fen, rating, moves_uci
+
+
+def themed_line(
+    row: Dict[str, str],
+    fields: RowFields,
+    config: BuilderConfig,
+    rejections: Optional[Counter[str]] = None,
+    replay_state: Optional[ReplayState] = None,
+    timings: Optional[Counter[str]] = None
+) -> Optional[tuple[List[str], str, ReplayedLine]]:
+    """Themes, line fingerprint and replayed line of a row that passed the numeric filters."""
+    puzzle_id, fen, _, moves_uci = fields
+    with time_stage(timings, "themes"):
+        themes = parse_themes(row.get("Themes", ""))
+        themes_accepted = accepts_themes(themes)
+    if not themes_accepted:
+        return _reject(rejections, "themes")
+
+    fingerprint = line_fingerprint(fen, row["Moves"])
+    previous = replay_state.get(puzzle_id) if replay_state is not None else None
+    if previous is not None and previous[0] == fingerprint:
+        outcome = previous[1]
+    else:
+        stage: Counter[str] = Counter()
+        line = replay_line(fen, moves_uci, config, stage, timings)
+        outcome = line if line is not None else next(iter(stage))
+        if replay_state is not None:
+            replay_state[puzzle_id] = (fingerprint, outcome)
+    if isinstance(outcome, str):
+        return _reject(rejections, outcome)
+    return themes, fingerprint, outcome
+
+
+def parse_puzzle_seed(
+    row: Dict[str, str],
+    config: BuilderConfig,
+    rejections: Optional[Counter[str]] = None,
+    replay_state: Optional[ReplayState] = None,
+    timings: Optional[Counter[str]] = None
+) -> Optional[PuzzleSeed]:
+    fields = row_fields(row, config, rejections)
+    if fields is None:
+        return None
+    puzzle_id, _, rating, _ = fields
+
+    rating_bucket = rating_bucket_for(rating, config.bucket_size)
+    if rating_bucket < config.min_rating or rating_bucket > config.max_rating:
+        return _reject(rejections, "rating")
 
-    if not san_line or len(san_line) > config.max_plies:
+    popularity = parse_int_field(row, "Popularity", default=0)
+    nb_plays = parse_int_field(row, "NbPlays", default=0)
+    if popularity < config.min_popularity or nb_plays < config.min_nb_plays:
+        return _reject(rejections, "popularity")
+
+    themed = themed_line(row, fields, config, rejections, replay_state, timings)
+    if themed is None:
         return None
+    themes, fingerprint, line = themed
 
     return PuzzleSeed(
         puzzle_id=puzzle_id,
-        fen=puzzle_board.fen(),
-        side_to_move=side_to_move,
-        piece_count=piece_count,
+        fen=line.fen,
+        piece_count=line.piece_count,
         rating_bucket=rating_bucket,
-        white_pieces=white_tokens,
-        black_pieces=black_tokens,
-        continuation_san=san_line,
-        continuation_text=continuation_text(puzzle_board.fen(), san_line),
-        themes=themes,
+        continuation_san=line.continuation_san,
+        themes=interned(themes),
         motif=motif_for(themes),
         simplicity_score=simplicity_score_for(
             themes=themes,
             rating=rating,
             popularity=popularity,
             nb_plays=nb_plays,
-            line_plies=len(san_line),
-            first_move_forcing=first_move_forcing,
+            line_plies=len(line.continuation_san),
+            first_move_forcing=line.first_move_forcing,
             config=config
-        )
+        ),
+        rating=rating,
+        popularity=popularity,
+        nb_plays=nb_plays,
+        first_move_forcing=line.first_move_forcing,
+        line_fingerprint=fingerprint
     )
 
 
+def parse_puzzle_batch(
+    rows: Sequence[Optional[Dict[str, str]]],
+    config: BuilderConfig,
+    rejections: Counter[str],
+    replay_state: Optional[ReplayState] = None,
+    timings: Optional[Counter[str]] = None
+) -> List[Optional[PuzzleSeed]]:
+    """``parse_or_skip`` over a batch, with the numeric filters and scores in NumPy.
+
+    Results and rejection counts match the per-row path exactly; only the
+    rating, popularity and plays checks and the score arithmetic move to arrays.
+    """
+    results: List[Optional[PuzzleSeed]] = [None] * len(rows)
+    indexes: List[int] = []
+    parsed: List[RowFields] = []
+    popularity_list: List[int] = []
+    plays_list: List[int] = []
+    for index, row in enumerate(rows):
+        if row is None:
+            rejections["combo_full"] += 1
+            continue
+        fields = row_fields(row, config, rejections)
+        if fields is None:
+            continue
+        indexes.append(index)
+        parsed.append(fields)
+        popularity_list.append(parse_int_field(row, "Popularity", default=0))
+        plays_list.append(parse_int_field(row, "NbPlays", default=0))
+    if not parsed:
+        return results
+
+    ratings = numpy.array([fields[2] for fields in parsed], dtype=numpy.int64)
+    popularities = numpy.array(popularity_list, dtype=numpy.int64)
+    nb_plays = numpy.array(plays_list, dtype=numpy.int64)
+    rating_buckets = (ratings // config.bucket_size) * config.bucket_size
+    in_rating = (rating_buckets >= config.min_rating) & (rating_buckets <= config.max_rating)
+    popular = (popularities >= config.min_popularity) & (nb_plays >= config.min_nb_plays)
+    rejections["rating"] += int(numpy.count_nonzero(~in_rating))
+    rejections["popularity"] += int(numpy.count_nonzero(in_rating & ~popular))
+
+    kept: List[int] = []
+    lines: List[tuple[List[str], str, ReplayedLine]] = []
+    for position in numpy.flatnonzero(in_rating & popular).tolist():
+        themed = themed_line(rows[indexes[position]], parsed[position], config, rejections, replay_state, timings)
+        if themed is not None:
+            kept.append(position)
+            lines.append(themed)
+    if not kept:
+        return results
+
+    scores = simplicity_scores_for(
+        themes=[themes for themes, _, _ in lines],
+        ratings=ratings[kept],
+        popularities=popularities[kept],
+        nb_plays=nb_plays[kept],
+        line_plies=numpy.array([len(line.continuation_san) for _, _, line in lines], dtype=numpy.int64),
+        first_move_forcing=numpy.array([line.first_move_forcing for _, _, line in lines], dtype=bool),
+        config=config
+    ).tolist()
+    for position, (themes, fingerprint, line), score in zip(kept, lines, scores):
+        puzzle_id, _, rating, _ = parsed[position]
+        results[indexes[position]] = PuzzleSeed(
+            puzzle_id=puzzle_id,
+            fen=line.fen,
+            piece_count=line.piece_count,
+            rating_bucket=int(rating_buckets[position]),
+            continuation_san=line.continuation_san,
+            themes=interned(themes),
+            motif=motif_for(themes),
+            simplicity_score=score,
+            rating=rating,
+            popularity=popularity_list[position],
+            nb_plays=plays_list[position],
+            first_move_forcing=line.first_move_forcing,
+            line_fingerprint=fingerprint
+        )
+    return results
+
+
 def combo_key(seed: PuzzleSeed) -> str:
     return f"p{seed.piece_count}-r{seed.rating_bucket}"
 
 
+simplicity_score_of = operator.attrgetter("simplicity_score")
+
+
+def best_first_order(scores: Sequence[float], draws: Sequence[float]) -> List[int]:
+    """Indexes ordered by (score, draw) descending, ties kept in input order.
+
+    Two stable sorts on plain float keys give the same order as one sort on
+    (score, draw) tuples, without allocating a tuple per candidate.
+    """
+    order = sorted(range(len(scores)), key=draws.__getitem__, reverse=True)
+    order.sort(key=scores.__getitem__, reverse=True)
+    return order
+
+
 def choose_balanced(
     seeds_by_motif: Dict[str, List[PuzzleSeed]],
     target: int,
@@ -407,30 +1143,34 @@ def choose_balanced(
     max_single_motif_share: float,
     rng: random.Random
 ) -> List[PuzzleSeed]:
-    motif_buckets: Dict[str, List[PuzzleSeed]] = {}
+    """Pick ``target`` seeds round-robin over ``MOTIF_PRIORITY`` within the motif share limits.
+
+    Each motif bucket is ranked once into a deque, so every pick is O(1), and
+    leftovers are only ranked when the round-robin runs dry. Random draws are
+    consumed exactly as the original sort-and-scan selector consumed them, so
+    the output for a given rng state is unchanged.
+    """
+    motif_queues: Dict[str, Deque[PuzzleSeed]] = {}
     for motif, seeds in seeds_by_motif.items():
-        copy = list(seeds)
-        copy.sort(key=lambda seed: (seed.simplicity_score, rng.random()), reverse=True)
-        motif_buckets[motif] = copy
+        draws = [rng.random() for _ in seeds]
+        order = best_first_order(list(map(simplicity_score_of, seeds)), draws)
+        motif_queues[motif] = deque(map(seeds.__getitem__, order))
 
     selected: List[PuzzleSeed] = []
     backrank_limit = max(1, math.floor(target * backrank_max_share)) if target > 0 else 0
     motif_limit = max(1, math.floor(target * max_single_motif_share)) if target > 0 else 0
     motif_counts: Dict[str, int] = defaultdict(int)
 
+    def under_limit(motif: str) -> bool:
+        return motif_counts[motif] < (backrank_limit if motif == "backrank" else motif_limit)
+
     while len(selected) < target:
         progressed = False
         for motif in MOTIF_PRIORITY:
-            bucket = motif_buckets.get(motif)
-            if not bucket:
-                continue
-            current = motif_counts[motif]
-            if motif == "backrank":
-                if current >= backrank_limit:
-                    continue
-            elif current >= motif_limit:
+            queue = motif_queues.get(motif)
+            if not queue or not under_limit(motif):
                 continue
-            selected.append(bucket.pop(0))
+            selected.append(queue.popleft())
             motif_counts[motif] += 1
             progressed = True
             if len(selected) >= target:
@@ -438,95 +1178,1072 @@ def choose_balanced(
         if not progressed:
             break
 
-    if len(selected) < target:
-        leftovers: List[PuzzleSeed] = []
-        for bucket in motif_buckets.values():
-            leftovers.extend(bucket)
-        leftovers.sort(key=lambda seed: (seed.simplicity_score, rng.random()), reverse=True)
-        for seed in leftovers:
-            if len(selected) >= target:
-                break
-            current = motif_counts[seed.motif]
-            if seed.motif == "backrank":
-                if current >= backrank_limit:
-                    continue
-            elif current >= motif_limit:
-                continue
-            selected.append(seed)
-            motif_counts[seed.motif] += 1
+    if len(selected) >= target:
+        return selected
 
-    if len(selected) < target:
-        leftovers: List[PuzzleSeed] = []
-        for bucket in motif_buckets.values():
-            leftovers.extend(bucket)
-        leftovers.sort(key=lambda seed: (seed.simplicity_score, rng.random()), reverse=True)
-        for seed in leftovers:
+    leftovers = [seed for queue in motif_queues.values() for seed in queue]
+
+    def best_first(seeds: List[PuzzleSeed], count: int) -> List[PuzzleSeed]:
+        draws = [rng.random() for _ in seeds]
+        if count >= len(seeds):
+            order = best_first_order(list(map(simplicity_score_of, seeds)), draws)
+        else:
+            order = heapq.nlargest(count, range(len(seeds)), key=lambda index: (seeds[index].simplicity_score, draws[index]))
+        return [seeds[index] for index in order[:count]]
+
+    if any(queue and under_limit(motif) for motif, queue in motif_queues.items()):
+        # Only motifs outside MOTIF_PRIORITY can still be under their limit here.
+        for seed in best_first(leftovers, len(leftovers)):
             if len(selected) >= target:
                 break
-            selected.append(seed)
+            if under_limit(seed.motif):
+                selected.append(seed)
+                motif_counts[seed.motif] += 1
+        taken = {id(seed) for seed in selected}
+        leftovers = [seed for seed in leftovers if id(seed) not in taken]
+    else:
+        # The round-robin stopped because every motif is exhausted or at its
+        # limit, so a limit-respecting pass would pick nothing. Skip it, but
+        # advance rng past the draws it would have made (random() uses 64 bits).
+        rng.getrandbits(64 * len(leftovers))
 
+    if len(selected) < target:
+        selected.extend(best_first(leftovers, target - len(selected)))
     return selected
 
 
 def as_output(seed: PuzzleSeed) -> Dict[str, object]:
+    white_pieces, black_pieces = seed.piece_lists()
     return {
         "puzzleId": seed.puzzle_id,
         "fen": seed.fen,
         "sideToMove": seed.side_to_move,
         "pieceCount": seed.piece_count,
         "ratingBucket": seed.rating_bucket,
-        "whitePieces": seed.white_pieces,
-        "blackPieces": seed.black_pieces,
-        "continuationSan": seed.continuation_san,
+        "whitePieces": white_pieces,
+        "blackPieces": black_pieces,
+        "continuationSan": list(seed.continuation_san),
         "continuationText": seed.continuation_text,
-        "themes": seed.themes,
+        "themes": list(seed.themes),
         "source": PUZZLE_SOURCE
     }
 
 
-def build_dataset(config: BuilderConfig) -> tuple[Dict[str, List[PuzzleSeed]], int]:
-    if not config.input_path.exists():
-        print(f"Input file not found: {config.input_path}", file=sys.stderr)
-        print("Run `npm run puzzles:download` first.", file=sys.stderr)
-        sys.exit(1)
+def encode_columnar_shard(entries: Sequence[Dict[str, object]]) -> Dict[str, object]:
+    """Encode ``as_output`` entries of one shard as parallel columns.
 
-    candidates_by_combo: Dict[str, Dict[str, List[PuzzleSeed]]] = defaultdict(lambda: defaultdict(list))
-    seen_ids: set[str] = set()
-    accepted = 0
-    scanned = 0
+    Only the fields that cannot be rebuilt are kept. ``pieceCount`` and
+    ``ratingBucket`` come from the shard path, ``source`` is constant, and
+    ``sideToMove``, ``whitePieces``, ``blackPieces`` and ``continuationText``
+    all follow from ``fen`` and ``continuationSan``. Theme names are interned
+    in a per-shard table in order of first use.
+    """
+    theme_table: Dict[str, int] = {}
+    theme_ids: List[List[int]] = []
+    for entry in entries:
+        theme_ids.append([theme_table.setdefault(theme, len(theme_table)) for theme in entry["themes"]])
+    return {
+        "format": "columnar",
+        "version": COLUMNAR_SHARD_VERSION,
+        "puzzleId": [entry["puzzleId"] for entry in entries],
+        "fen": [entry["fen"] for entry in entries],
+        "continuationSan": [" ".join(entry["continuationSan"]) for entry in entries],
+        "themeTable": list(theme_table),
+        "themes": theme_ids
+    }
 
+
+def decode_columnar_shard(payload: Dict[str, object], piece_count: int, rating_bucket: int) -> List[Dict[str, object]]:
+    """Rebuild the exact ``as_output`` entries from ``encode_columnar_shard``."""
+    if payload.get("format") != "columnar" or payload.get("version") != COLUMNAR_SHARD_VERSION:
+        raise ValueError("Not a columnar puzzle shard")
+    theme_table = payload["themeTable"]
+    entries: List[Dict[str, object]] = []
+    for puzzle_id, fen, san, theme_ids in zip(payload["puzzleId"], payload["fen"], payload["continuationSan"], payload["themes"]):
+        white_pieces, black_pieces = tokenise_pieces(chess.Board(fen))
+        san_line = san.split(" ")
+        entries.append({
+            "puzzleId": puzzle_id,
+            "fen": fen,
+            "sideToMove": fen.split(" ")[1],
+            "pieceCount": piece_count,
+            "ratingBucket": rating_bucket,
+            "whitePieces": white_pieces,
+            "blackPieces": black_pieces,
+            "continuationSan": san_line,
+            "continuationText": continuation_text(fen, san_line),
+            "themes": [theme_table[index] for index in theme_ids],
+            "source": PUZZLE_SOURCE
+        })
+    return entries
+
+
+def shard_path_for(
+    lichess_dir: Path,
+    piece_count: int,
+    rating_bucket: int,
+    shard_format: str,
+    page: Optional[int] = None
+) -> Path:
+    if page is None:
+        return lichess_dir.parent / SHARD_PATTERNS[shard_format].format(pieceCount=piece_count, ratingBucket=rating_bucket)
+    pattern = PAGED_SHARD_PATTERNS[shard_format]
+    return lichess_dir.parent / pattern.format(pieceCount=piece_count, ratingBucket=rating_bucket, page=page)
+
+
+def shard_bytes(seeds: Sequence[PuzzleSeed], shard_format: str) -> bytes:
+    payload: object = [as_output(seed) for seed in seeds]
+    if shard_format == "columnar":
+        payload = encode_columnar_shard(payload)
+    return json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+
+def paginate(items: Sequence[T], page_size: int) -> List[Sequence[T]]:
+    """Consecutive pages of at most ``page_size`` items; one page when ``page_size`` is 0."""
+    if page_size <= 0:
+        return [items]
+    return [items[start:start + page_size] for start in range(0, len(items), page_size)]
+
+
+@contextmanager
+def open_puzzle_stream(config: BuilderConfig) -> Iterator[BinaryIO]:
+    if config.index_dir is not None:
+        # Sequential reads of the decompressed copy need neither zstd nor the
+        # offsets; only the row-range scan of --workers memory-maps it.
+        with open(ensure_line_index(config).csv_path, "rb") as decompressed:
+            yield decompressed
+        return
     dctx = zstandard.ZstdDecompressor()
+    if config.input_url is not None:
+        # Rows are parsed while the rest of the archive is still downloading.
+        tee_path = config.input_path if config.tee_input else None
+        with stream_archive(config.input_url, tee_path) as compressed:
+            with dctx.stream_reader(compressed) as reader:
+                yield reader
+        return
     with open(config.input_path, "rb") as compressed:
         with dctx.stream_reader(compressed) as reader:
-            text_stream = io.TextIOWrapper(reader, encoding="utf-8")
-            csv_reader = csv.DictReader(text_stream)
-            for row in csv_reader:
-                if config.max_rows is not None and scanned >= config.max_rows:
-                    break
-                scanned += 1
-                seed = parse_puzzle_seed(row, config)
-                if seed is None or seed.puzzle_id in seen_ids:
-                    continue
+            yield reader
+
+
+def line_index_paths(config: BuilderConfig) -> tuple[Path, Path]:
+    """The decompressed CSV and its row index under ``config.index_dir``."""
+    assert config.index_dir is not None
+    name = config.input_path.name
+    csv_path = config.index_dir / (name[:-len(".zst")] if name.endswith(".zst") else f"{name}.csv")
+    return csv_path, csv_path.with_name(f"{csv_path.name}.index.json")
+
+
+def ensure_line_index(config: BuilderConfig) -> LineIndex:
+    """The indexed, decompressed archive under ``config.index_dir``; written when missing or stale."""
+    csv_path, index_path = line_index_paths(config)
+    source = input_fingerprint(config)
+    index = read_line_index(csv_path, index_path)
+    if index is not None and source is not None and index.source == source:
+        return index
+    print(f"Decompressing {config.input_url or config.input_path} into {csv_path} and indexing its rows")
+    with open_puzzle_stream(replace(config, index_dir=None)) as stream:
+        return write_line_index(stream, csv_path, index_path, source or {})
+
+
+def row_filter_for(config: BuilderConfig) -> RowFilter:
+    def as_bytes(themes: set[str]) -> frozenset[bytes]:
+        return frozenset(theme.encode("utf-8") for theme in themes)
+
+    return RowFilter(
+        min_rating=config.min_rating,
+        max_rating=config.max_rating,
+        bucket_size=config.bucket_size,
+        min_popularity=config.min_popularity,
+        min_nb_plays=config.min_nb_plays,
+        min_piece_count=config.min_piece_count,
+        max_piece_count=config.max_piece_count,
+        excluded_themes=as_bytes(EXCLUDED_THEMES),
+        advanced_themes=as_bytes(ADVANCED_THEMES),
+        tactical_themes=as_bytes(TACTICAL_THEMES),
+        simple_themes=as_bytes(SIMPLE_THEMES)
+    )
+
+
+def make_row_reader(
+    config: BuilderConfig,
+    stream: BinaryIO,
+    rejections: Counter[str],
+    timings: Optional[Counter[str]] = None
+) -> Union[ColumnarPuzzleReader, CsvPuzzleReader]:
+    if config.reader == "csv":
+        return CsvPuzzleReader(stream, max_rows=config.max_rows)
+    return ColumnarPuzzleReader(stream, row_filter_for(config), rejections, max_rows=config.max_rows, timings=timings)
+
+
+def batched(rows: Iterable[Optional[Dict[str, str]]], size: int) -> Iterator[List[Optional[Dict[str, str]]]]:
+    iterator = iter(rows)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+_worker_config: Optional[BuilderConfig] = None
+_worker_replay_state: Optional[ReplayState] = None
+
+
+def _init_parse_worker(config: BuilderConfig, replay_state: Optional[ReplayState]) -> None:
+    global _worker_config, _worker_replay_state
+    _worker_config = config
+    _worker_replay_state = replay_state
+
+
+def parse_or_skip(
+    row: Optional[Dict[str, str]],
+    config: BuilderConfig,
+    rejections: Counter[str],
+    replay_state: Optional[ReplayState] = None,
+    timings: Optional[Counter[str]] = None
+) -> Optional[PuzzleSeed]:
+    # A None row was skipped by the reader because its combo is already full.
+    if row is None:
+        rejections["combo_full"] += 1
+        return None
+    return parse_puzzle_seed(row, config, rejections, replay_state, timings)
+
+
+# Parse results, rejections, stage timings and the replay records the batch added.
+ParsedBatch = tuple[List[Optional[PuzzleSeed]], Counter[str], Optional[Counter[str]], Dict[str, ReplayRecord]]
+
+
+def _parse_batch(rows: List[Optional[Dict[str, str]]]) -> ParsedBatch:
+    assert _worker_config is not None
+    rejections: Counter[str] = Counter()
+    timings: Optional[Counter[str]] = Counter() if _worker_config.stats_json is not None else None
+    # New records land in ``replays`` and go back to the parent process.
+    replays: Dict[str, ReplayRecord] = {}
+    replay_state = ChainMap(replays, _worker_replay_state) if _worker_replay_state is not None else None
+    if _worker_config.vectorize:
+        results = parse_puzzle_batch(rows, _worker_config, rejections, replay_state, timings)
+    else:
+        results = [parse_or_skip(row, _worker_config, rejections, replay_state, timings) for row in rows]
+    return results, rejections, timings, replays
+
+
+_worker_index: Optional[LineIndex] = None
+_worker_mapped: Optional[mmap.mmap] = None
+_worker_row_filter: Optional[RowFilter] = None
+
 
-                key = combo_key(seed)
-                motif_bucket = candidates_by_combo[key][seed.motif]
-                combo_total = sum(len(items) for items in candidates_by_combo[key].values())
-                combo_cap = config.target_per_combo * config.candidate_multiplier
-                if combo_total >= combo_cap:
+def _init_range_worker(config: BuilderConfig, replay_state: Optional[ReplayState], index: LineIndex) -> None:
+    global _worker_index, _worker_mapped, _worker_row_filter
+    _init_parse_worker(config, replay_state)
+    _worker_index = index
+    _worker_row_filter = row_filter_for(config)
+    with open(index.csv_path, "rb") as handle:
+        _worker_mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+RangeBatch = tuple[List[tuple[int, Optional[PuzzleSeed]]], int, Counter[str], Optional[Counter[str]], Dict[str, ReplayRecord]]
+
+
+def _parse_row_range(start_row: int, stop_row: int) -> RangeBatch:
+    """Read and parse rows ``start_row``..``stop_row`` of the mapped CSV; number results by archive row."""
+    assert _worker_config is not None and _worker_index is not None and _worker_mapped is not None
+    rejections: Counter[str] = Counter()
+    reader_timings: Optional[Counter[str]] = Counter() if _worker_config.stats_json is not None else None
+    reader = ColumnarPuzzleReader(
+        _worker_index.range_stream(_worker_mapped, start_row, stop_row),
+        _worker_row_filter,
+        rejections,
+        max_rows=stop_row - start_row,
+        timings=reader_timings
+    )
+    rows: List[Optional[Dict[str, str]]] = []
+    row_numbers: List[int] = []
+    for row in reader:
+        rows.append(row)
+        row_numbers.append(start_row + reader.rows_scanned)
+    results, parse_rejections, timings, replays = _parse_batch(rows)
+    rejections.update(parse_rejections)
+    if timings is not None and reader_timings is not None:
+        timings.update(reader_timings)
+    return list(zip(row_numbers, results)), reader.rows_scanned, rejections, timings, replays
+
+
+class RowRangeScan:
+    """Read and parse an indexed CSV in disjoint row ranges, one worker process per range.
+
+    Yields (archive row number, parse result) for every row that passes the
+    row filter, in file order like the serial scan, so the caller's dedup and
+    caps see the same sequence. Workers cannot see which combos are full, so
+    rows the serial scan skips as ``combo_full`` are parsed here and dropped
+    by the caller instead; the candidates are the same, some rejection counts
+    differ. Row numbers are None unless ``timings`` is given.
+    """
+
+    def __init__(
+        self,
+        config: BuilderConfig,
+        index: LineIndex,
+        rejections: Counter[str],
+        replay_state: Optional[ReplayState] = None,
+        timings: Optional[Counter[str]] = None
+    ) -> None:
+        self.config = config
+        self.index = index
+        self.rejections = rejections
+        self.replay_state = replay_state
+        self.timings = timings
+        self.rows_scanned = 0
+
+    def __iter__(self) -> Iterator[tuple[Optional[int], Optional[PuzzleSeed]]]:
+        ranges = iter(self.index.row_ranges(self.config.max_rows))
+        max_in_flight = self.config.workers * 2
+        with ProcessPoolExecutor(
+            max_workers=self.config.workers,
+            initializer=_init_range_worker,
+            initargs=(self.config, dict(self.replay_state) if self.replay_state is not None else None, self.index)
+        ) as pool:
+            pending: Deque[Future[RangeBatch]] = deque(
+                pool.submit(_parse_row_range, *row_range) for row_range in itertools.islice(ranges, max_in_flight)
+            )
+            while pending:
+                results, scanned, rejections, timings, replays = pending.popleft().result()
+                next_range = next(ranges, None)
+                if next_range is not None:
+                    pending.append(pool.submit(_parse_row_range, *next_range))
+                self.rows_scanned += scanned
+                self.rejections.update(rejections)
+                if self.replay_state is not None:
+                    self.replay_state.update(replays)
+                if self.timings is not None and timings is not None:
+                    self.timings.update(timings)
+                for row_number, seed in results:
+                    yield (row_number if self.timings is not None else None), seed
+
+
+def iter_parsed_seeds(
+    config: BuilderConfig,
+    rows: Iterable[Optional[Dict[str, str]]],
+    rejections: Counter[str],
+    replay_state: Optional[ReplayState] = None,
+    timings: Optional[Counter[str]] = None
+) -> Iterator[Optional[PuzzleSeed]]:
+    """Yield one parse result per row, in file order, regardless of worker count.
+
+    With workers, ``timings`` receives the parser stage times summed over all
+    worker processes, and ``replay_state`` the replay records they added.
+    """
+    if config.workers <= 1 and config.vectorize:
+        for batch in batched(rows, config.batch_size):
+            yield from parse_puzzle_batch(batch, config, rejections, replay_state, timings)
+        return
+    if config.workers <= 1:
+        for row in rows:
+            yield parse_or_skip(row, config, rejections, replay_state, timings)
+        return
+
+    # Keep a bounded window of batches in flight so the reader never runs far
+    # ahead of the parsers, and drain it in submission order so the caller's
+    # dedup/cap logic sees exactly the serial row order.
+    max_in_flight = config.workers * 2
+    with ProcessPoolExecutor(
+        max_workers=config.workers,
+        initializer=_init_parse_worker,
+        initargs=(config, dict(replay_state) if replay_state is not None else None)
+    ) as pool:
+        pending: Deque[Future[ParsedBatch]] = deque()
+
+        def drain_one() -> List[Optional[PuzzleSeed]]:
+            results, batch_rejections, batch_timings, replays = pending.popleft().result()
+            rejections.update(batch_rejections)
+            if replay_state is not None:
+                replay_state.update(replays)
+            if timings is not None and batch_timings is not None:
+                timings.update(batch_timings)
+            return results
+
+        for batch in batched(rows, config.batch_size):
+            pending.append(pool.submit(_parse_batch, batch))
+            if len(pending) >= max_in_flight:
+                yield from drain_one()
+        while pending:
+            yield from drain_one()
+
+
+def replayed_line_of(seed: PuzzleSeed) -> ReplayedLine:
+    return ReplayedLine(
+        fen=seed.fen,
+        piece_count=seed.piece_count,
+        continuation_san=seed.continuation_san,
+        first_move_forcing=seed.first_move_forcing
+    )
+
+
+BUILD_STATE_VERSION = 3
+
+
+def replay_state_config(config: BuilderConfig) -> Dict[str, int]:
+    # Only these settings change the outcome of replay_line.
+    return {
+        "minPieceCount": config.min_piece_count,
+        "maxPieceCount": config.max_piece_count,
+        "maxPlies": config.max_plies
+    }
+
+
+def load_replay_state(config: BuilderConfig) -> ReplayState:
+    path = config.state_file
+    if path is None or not path.exists():
+        return {}
+    try:
+        with open(path, "rb") as handle:
+            payload = json.loads(zstandard.ZstdDecompressor().decompress(handle.read()))
+    except (OSError, ValueError, zstandard.ZstdError):
+        print(f"Ignoring unreadable build state: {path}")
+        return {}
+    if payload.get("version") != BUILD_STATE_VERSION or payload.get("config") != replay_state_config(config):
+        print(f"Ignoring build state from a different configuration: {path}")
+        return {}
+
+    state: ReplayState = {}
+    for puzzle_id, record in payload["puzzles"].items():
+        if len(record) == 2:
+            # A row the replay rejected: [fingerprint, stage].
+            state[puzzle_id] = (record[0], record[1])
+            continue
+        fingerprint, fen, piece_count, san, forcing = record
+        state[puzzle_id] = (fingerprint, ReplayedLine(
+            fen=fen,
+            piece_count=piece_count,
+            continuation_san=interned(san.split(" ")),
+            first_move_forcing=bool(forcing)
+        ))
+    return state
+
+
+def save_replay_state(config: BuilderConfig, state: ReplayState) -> None:
+    path = config.state_file
+    if path is None:
+        return
+    payload = {
+        "version": BUILD_STATE_VERSION,
+        "config": replay_state_config(config),
+        "puzzles": {
+            puzzle_id: [fingerprint, outcome] if isinstance(outcome, str) else [
+                fingerprint,
+                outcome.fen,
+                outcome.piece_count,
+                " ".join(outcome.continuation_san),
+                int(outcome.first_move_forcing)
+            ]
+            for puzzle_id, (fingerprint, outcome) in state.items()
+        }
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_suffix(path.suffix + ".part")
+    with open(temp_path, "wb") as handle:
+        handle.write(zstandard.ZstdCompressor(level=10).compress(json.dumps(payload).encode("utf-8")))
+    temp_path.replace(path)
+
+
+def seeded_rank(puzzle_id: str, seed: Optional[int]) -> int:
+    """Deterministic per-seed tie-break that does not depend on archive order."""
+    key = str(seed).encode("utf-8") if seed is not None else b""
+    return int.from_bytes(hashlib.blake2b(puzzle_id.encode("utf-8"), digest_size=8, key=key).digest(), "big")
+
+
+class BestCandidatePool:
+    """The best ``per_motif`` candidates of every (combo, motif) seen so far.
+
+    Each bucket is a min-heap on (simplicity_score, seeded_rank), so a better
+    candidate replaces the current worst in O(log K) and memory stays O(K) per
+    bucket however long the archive is. ``choose_balanced`` never takes more
+    than ``target_per_combo`` seeds of one motif, so that many per motif is
+    all the selector can use.
+
+    Duplicate ids are only detected among the kept candidates, so the pool
+    holds no per-row state: a repeat of a dropped puzzle is offered again and
+    ranked like any other row.
+    """
+
+    def __init__(self, per_motif: int, seed: Optional[int]) -> None:
+        self.per_motif = per_motif
+        self.seed = seed
+        self.buckets: Dict[tuple[str, str], List[tuple[float, int, int, PuzzleSeed]]] = defaultdict(list)
+        self.kept_ids: set[str] = set()
+        self.offered = 0
+
+    def holds(self, puzzle_id: str) -> bool:
+        return puzzle_id in self.kept_ids
+
+    def offer(self, candidate: PuzzleSeed) -> bool:
+        """Add ``candidate``; return False when it or a kept candidate was dropped."""
+        entry = (candidate.simplicity_score, seeded_rank(candidate.puzzle_id, self.seed), self.offered, candidate)
+        self.offered += 1
+        bucket = self.buckets[(combo_key(candidate), candidate.motif)]
+        if len(bucket) < self.per_motif:
+            heapq.heappush(bucket, entry)
+            self.kept_ids.add(candidate.puzzle_id)
+            return True
+        if self.per_motif > 0 and entry[:2] > bucket[0][:2]:
+            dropped = heapq.heapreplace(bucket, entry)
+            self.kept_ids.discard(dropped[3].puzzle_id)
+            self.kept_ids.add(candidate.puzzle_id)
+        return False
+
+    def candidates(self) -> List[PuzzleSeed]:
+        """Kept candidates in the order they were offered."""
+        entries = [entry for bucket in self.buckets.values() for entry in bucket]
+        entries.sort(key=operator.itemgetter(2))
+        return [entry[3] for entry in entries]
+
+
+def combo_cap_for(config: BuilderConfig) -> int:
+    if config.candidate_pool == "best":
+        return config.target_per_combo * len(MOTIF_PRIORITY)
+    return config.target_per_combo * config.candidate_multiplier
+
+
+class CandidateAcceptor:
+    """Dedup and per-combo caps for one config, fed parsed seeds in file order."""
+
+    def __init__(self, config: BuilderConfig) -> None:
+        self.config = config
+        self.combo_counts: Dict[str, int] = defaultdict(int)
+        self.full_combos: set[str] = set()
+        self.pending_combos = expected_combo_keys(config)
+        self.combo_cap = combo_cap_for(config)
+        self.best_pool = BestCandidatePool(config.target_per_combo, config.seed) if config.candidate_pool == "best" else None
+        # Ids of accepted candidates only, so it is bounded by the combo caps.
+        self.seen_ids: set[str] = set()
+        self.rejections: Counter[str] = Counter()
+        self.candidates: List[PuzzleSeed] = []
+        self.saturated = False
+        self.saturated_at_row: Dict[str, int] = {}
+
+    def skips(self, row: Dict[str, str]) -> bool:
+        """Whether the row's predicted combo is already full, so parsing it is wasted."""
+        return bool(self.full_combos) and predicted_combo_key(row, self.config) in self.full_combos
+
+    def offer(self, seed: PuzzleSeed, row_number: Optional[int]) -> None:
+        rejections = self.rejections
+        if self.best_pool is not None:
+            if self.best_pool.holds(seed.puzzle_id):
+                rejections["duplicate"] += 1
+                return
+            if not self.best_pool.offer(seed):
+                rejections["outranked"] += 1
+            return
+
+        if seed.puzzle_id in self.seen_ids:
+            rejections["duplicate"] += 1
+            return
+
+        key = combo_key(seed)
+        if self.combo_counts[key] >= self.combo_cap:
+            rejections["combo_full"] += 1
+            return
+
+        self.candidates.append(seed)
+        self.combo_counts[key] += 1
+        self.seen_ids.add(seed.puzzle_id)
+
+        if self.combo_counts[key] >= self.combo_cap:
+            self.full_combos.add(key)
+            self.pending_combos.discard(key)
+            if row_number is not None:
+                self.saturated_at_row[key] = row_number
+            if self.config.stop_when_saturated and not self.pending_combos:
+                self.saturated = True
+
+    def scan(self, scanned: int, shared_rejections: Counter[str], saturated: bool) -> CandidateScan:
+        return CandidateScan(
+            candidates=self.best_pool.candidates() if self.best_pool is not None else self.candidates,
+            combo_cap=self.combo_cap,
+            scanned=scanned,
+            rejections=shared_rejections + self.rejections,
+            saturated=saturated,
+            saturated_at_row=self.saturated_at_row
+        )
+
+
+def profile_seed(seed: PuzzleSeed, profile: BuilderConfig, rejections: Counter[str]) -> Optional[PuzzleSeed]:
+    """``seed``, parsed with a wider scan config, as parsing with ``profile`` would give it.
+
+    None when ``profile`` rejects it; the row is then counted under the stage
+    that checks the failing field, which is not always the stage a separate
+    build would have stopped at.
+    """
+    if seed.piece_count < profile.min_piece_count or seed.piece_count > profile.max_piece_count:
+        return _reject(rejections, "piece_count")
+    rating_bucket = rating_bucket_for(seed.rating, profile.bucket_size)
+    if rating_bucket < profile.min_rating or rating_bucket > profile.max_rating:
+        return _reject(rejections, "rating")
+    if seed.popularity < profile.min_popularity or seed.nb_plays < profile.min_nb_plays:
+        return _reject(rejections, "popularity")
+    if len(seed.continuation_san) > profile.max_plies:
+        return _reject(rejections, "line")
+    return replace(seed, rating_bucket=rating_bucket, simplicity_score=simplicity_score_for(
+        themes=seed.themes,
+        rating=seed.rating,
+        popularity=seed.popularity,
+        nb_plays=seed.nb_plays,
+        line_plies=len(seed.continuation_san),
+        first_move_forcing=seed.first_move_forcing,
+        config=profile
+    ))
+
+
+# Settings of the scan itself, which every profile of a --profiles build shares.
+SHARED_PROFILE_FIELDS = (
+    "input_path",
+    "input_url",
+    "tee_input",
+    "reader",
+    "max_rows",
+    "workers",
+    "batch_size",
+    "vectorize",
+    "incremental",
+    "state_file",
+    "cache_key",
+    "profiles",
+    "index_dir"
+)
+
+
+def load_profiles(config: BuilderConfig) -> Dict[str, BuilderConfig]:
+    """Named profiles from ``config.profiles``, each a set of overrides on ``config``.
+
+    Every override is type-checked and every profile is checked like the
+    CLI checks its flags, so a bad profile stops the build before the scan.
+    """
+    assert config.profiles is not None
+    try:
+        payload = json.loads(config.profiles.read_text(encoding="utf-8"))
+    except (OSError, ValueError) as error:
+        raise SystemExit(f"Cannot read profiles from {config.profiles}: {error}")
+    raw_profiles = payload.get("profiles") if isinstance(payload, dict) else None
+    if not isinstance(raw_profiles, dict) or not raw_profiles:
+        raise SystemExit(f"{config.profiles} must hold a non-empty \"profiles\" object")
+
+    known = {item.name: item for item in fields(BuilderConfig)}
+    profiles: Dict[str, BuilderConfig] = {}
+    for name, overrides in raw_profiles.items():
+        if not isinstance(overrides, dict):
+            raise SystemExit(f"Profile {name} must be an object of settings")
+        unknown = sorted(set(overrides).difference(known))
+        if unknown:
+            raise SystemExit(f"Profile {name}: unknown settings {', '.join(unknown)}")
+        shared = sorted(set(overrides).intersection(SHARED_PROFILE_FIELDS))
+        if shared:
+            raise SystemExit(f"Profile {name}: {', '.join(shared)} must be the same for every profile")
+        for key, value in overrides.items():
+            error = setting_error(key, value)
+            if error is not None:
+                raise SystemExit(f"Profile {name}: {error}")
+        values = {
+            key: Path(value).expanduser() if value is not None and key in PATH_FIELDS else value
+            for key, value in overrides.items()
+        }
+        profiles[name] = replace(config, **values)
+        error = config_error(profiles[name])
+        if error is not None:
+            raise SystemExit(f"Profile {name}: {error}")
+
+    for key in ("output_dir", "candidate_db", "stats_json"):
+        paths = Counter(getattr(profile, key).resolve() for profile in profiles.values() if getattr(profile, key) is not None)
+        clashing = sorted(str(path) for path, count in paths.items() if count > 1)
+        if clashing:
+            raise SystemExit(f"Profiles must not share a {key}: {', '.join(clashing)}")
+    return profiles
+
+
+def profile_scan_config(profiles: Sequence[BuilderConfig]) -> BuilderConfig:
+    """A config whose parse accepts every row that any of ``profiles`` accepts.
+
+    Ratings are filtered by value (bucket size 1) over the union of the
+    profiles' bucket ranges; the other filters take the loosest bound.
+    """
+    return replace(
+        profiles[0],
+        min_piece_count=min(profile.min_piece_count for profile in profiles),
+        max_piece_count=max(profile.max_piece_count for profile in profiles),
+        bucket_size=1,
+        min_rating=min(-(-profile.min_rating // profile.bucket_size) * profile.bucket_size for profile in profiles),
+        max_rating=max((profile.max_rating // profile.bucket_size + 1) * profile.bucket_size - 1 for profile in profiles),
+        max_plies=max(profile.max_plies for profile in profiles),
+        min_popularity=min(profile.min_popularity for profile in profiles),
+        min_nb_plays=min(profile.min_nb_plays for profile in profiles),
+        stop_when_saturated=all(profile.stop_when_saturated for profile in profiles),
+        stats_json=next((profile.stats_json for profile in profiles if profile.stats_json is not None), None)
+    )
+
+
+def scan_candidates(config: BuilderConfig, replay_state: Optional[ReplayState] = None) -> CandidateScan:
+    """Scan the archive; when ``replay_state`` is given, reuse and update it in place."""
+    return scan_profiles(config, [config], replay_state)[0]
+
+
+def scan_profiles(
+    scan_config: BuilderConfig,
+    profiles: Sequence[BuilderConfig],
+    replay_state: Optional[ReplayState] = None
+) -> List[CandidateScan]:
+    """Parse every row once with ``scan_config`` and fill one candidate pool per profile.
+
+    ``scan_config`` must accept every row any profile accepts (see
+    ``profile_scan_config``); a profile that is ``scan_config`` itself takes
+    the parsed seeds as they are.
+    """
+    acceptors = [CandidateAcceptor(profile) for profile in profiles]
+    stop_when_saturated = all(profile.stop_when_saturated for profile in profiles)
+    rejections: Counter[str] = Counter()
+    saturated = False
+    # Replays of this scan go into their own layer, so the ones it added can
+    # be counted; rows that reached the replay either left a seed or were
+    # rejected at one of REPLAY_STAGES.
+    new_replays: Dict[str, ReplayRecord] = {}
+    scan_state = ChainMap(new_replays, replay_state) if replay_state is not None else None
+    replayed_rows = 0
+    # --stats-json: parser stage times, reader-side times (decompression, raw
+    # row reading and the reader's theme filter), and the archive row number
+    # of every row handed to the parser, consumed in parse order.
+    timings: Optional[Counter[str]] = Counter() if scan_config.stats_json is not None else None
+    reader_timings: Counter[str] = Counter()
+    row_numbers: Optional[Deque[int]] = deque() if timings is not None else None
+    scan_started = time.perf_counter()
+
+    def rows_to_parse(rows: Iterable[Dict[str, str]]) -> Iterator[Optional[Dict[str, str]]]:
+        # Rows whose predicted combo is already full in every profile would be
+        # dropped after the replay anyway, so pass a placeholder instead of
+        # paying for it. The accept loop below stays authoritative, which keeps
+        # output identical.
+        for row in rows:
+            if row_numbers is not None:
+                row_numbers.append(reader.rows_scanned)
+            if all(acceptor.skips(row) for acceptor in acceptors):
+                yield None
+            else:
+                yield row
+
+    # With an index, workers read row ranges of the decompressed copy themselves
+    # instead of being fed rows that this process decompressed and split.
+    ranged = scan_config.index_dir is not None and scan_config.workers > 1 and scan_config.reader == "columnar"
+    with nullcontext() if ranged else open_puzzle_stream(scan_config) as stream:
+        reader: Union[ColumnarPuzzleReader, CsvPuzzleReader, RowRangeScan]
+        parsed: Iterable[tuple[Optional[int], Optional[PuzzleSeed]]]
+        if ranged:
+            reader = RowRangeScan(scan_config, ensure_line_index(scan_config), rejections, scan_state, timings)
+            parsed = reader
+        else:
+            if timings is not None:
+                stream = TimedStream(stream, reader_timings)
+            reader = make_row_reader(scan_config, stream, rejections, reader_timings if timings is not None else None)
+            rows: Iterable[Dict[str, str]] = reader if timings is None else timed_iter(reader, reader_timings, "read")
+            parsed = (
+                (row_numbers.popleft() if row_numbers is not None else None, seed)
+                for seed in iter_parsed_seeds(scan_config, rows_to_parse(rows), rejections, scan_state, timings)
+            )
+        for row_number, seed in parsed:
+            if seed is None:
+                continue
+            replayed_rows += 1
+            for acceptor in acceptors:
+                if acceptor.config is scan_config:
+                    acceptor.offer(seed, row_number)
                     continue
+                projected = profile_seed(seed, acceptor.config, acceptor.rejections)
+                if projected is not None:
+                    acceptor.offer(projected, row_number)
+            if stop_when_saturated and all(acceptor.saturated for acceptor in acceptors):
+                saturated = True
+                break
+        scanned = reader.rows_scanned
+
+    if replay_state is not None:
+        replay_state.update(new_replays)
+        replayed_rows += sum(rejections[stage] for stage in REPLAY_STAGES)
+        print(
+            f"Incremental: reused {replayed_rows - len(new_replays)} previous replays, "
+            f"replayed {len(new_replays)} new or changed puzzles"
+        )
+    scans = [acceptor.scan(scanned, rejections, saturated) for acceptor in acceptors]
+    if timings is not None:
+        # Reading a row covers decompressing it and the reader's theme filter;
+        # what is left is splitting and decoding the CSV itself.
+        timings["scan"] = time.perf_counter() - scan_started
+        timings["decompress"] += reader_timings["decompress"]
+        timings["themes"] += reader_timings["themes"]
+        timings["csv_parse"] += max(0.0, reader_timings["read"] - reader_timings["decompress"] - reader_timings["themes"])
+        for scan in scans:
+            scan.timings.update(timings)
+    return scans
+
+
+CANDIDATE_CACHE_VERSION = 3
+
+
+def input_fingerprint(config: BuilderConfig) -> Optional[Dict[str, object]]:
+    if config.input_url is not None:
+        # A streamed archive is identified by its HTTP validators; without
+        # them there is nothing safe to key the cache on.
+        with new_session() as session:
+            info = remote_info(session, config.input_url)
+        if not info.etag and not info.last_modified:
+            return None
+        return {"url": config.input_url, "etag": info.etag, "lastModified": info.last_modified, "size": info.size}
+    stat = config.input_path.stat()
+    if config.cache_key == "hash":
+        digest = hashlib.sha256()
+        with open(config.input_path, "rb") as handle:
+            for chunk in iter(lambda: handle.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return {"size": stat.st_size, "sha256": digest.hexdigest()}
+    return {"size": stat.st_size, "mtimeNs": stat.st_mtime_ns}
+
+
+def candidate_cache_path(config: BuilderConfig) -> Optional[Path]:
+    """Cache file for this input and parse-affecting config, if caching is enabled.
+
+    Selection settings (target, multiplier, motif shares, seed) are deliberately
+    not part of the key; see ``load_candidate_cache`` for how the cap is reused.
+    A ``best`` pool is the exception: which candidates it keeps depends on the
+    target and tie-break seed.
+    """
+    if config.cache_dir is None:
+        return None
+    fingerprint = input_fingerprint(config)
+    if fingerprint is None:
+        return None
+    key = {
+        "version": CANDIDATE_CACHE_VERSION,
+        "input": fingerprint,
+        "minPieceCount": config.min_piece_count,
+        "maxPieceCount": config.max_piece_count,
+        "minRating": config.min_rating,
+        "maxRating": config.max_rating,
+        "bucketSize": config.bucket_size,
+        "maxPlies": config.max_plies,
+        "minPopularity": config.min_popularity,
+        "minNbPlays": config.min_nb_plays,
+        "maxRows": config.max_rows,
+        # A saturated scan stops early, so its row count and rejections cover
+        # only part of the archive; keep it apart from a full scan's stats.
+        "stopWhenSaturated": config.stop_when_saturated,
+        "candidatePool": config.candidate_pool
+    }
+    if config.candidate_pool == "best":
+        key.update(targetPerCombo=config.target_per_combo, seed=config.seed)
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()[:24]
+    return config.cache_dir / f"candidates-{digest}.json.zst"
+
+
+def save_candidate_cache(path: Path, scan: CandidateScan) -> None:
+    payload = {
+        "version": CANDIDATE_CACHE_VERSION,
+        "comboCap": scan.combo_cap,
+        "scanned": scan.scanned,
+        "saturated": scan.saturated,
+        "rejections": dict(scan.rejections),
+        "candidates": [
+            [
+                seed.puzzle_id,
+                seed.fen,
+                seed.piece_count,
+                seed.rating_bucket,
+                " ".join(seed.continuation_san),
+                " ".join(seed.themes),
+                seed.rating,
+                seed.popularity,
+                seed.nb_plays,
+                int(seed.first_move_forcing),
+                seed.line_fingerprint
+            ]
+            for seed in scan.candidates
+        ]
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_suffix(path.suffix + ".part")
+    with open(temp_path, "wb") as handle:
+        handle.write(zstandard.ZstdCompressor(level=10).compress(json.dumps(payload).encode("utf-8")))
+    temp_path.replace(path)
+
+
+def load_candidate_cache(path: Path, config: BuilderConfig) -> Optional[CandidateScan]:
+    """Load cached candidates if they can reproduce a fresh scan for ``config``.
+
+    Candidates are stored in acceptance order, so a pool built with a larger
+    cap can be cut down per combo to the exact pool a smaller cap would have
+    accepted, as long as the scan never had to drop a duplicate puzzle id.
+    Motifs and simplicity scores are recomputed, so scoring changes apply
+    without a rescan. A ``best`` pool cannot be cut down this way, so it is
+    only reused for the same cap.
+    """
+    if not path.exists():
+        return None
+    try:
+        with open(path, "rb") as handle:
+            payload = json.loads(zstandard.ZstdDecompressor().decompress(handle.read()))
+    except (OSError, ValueError, zstandard.ZstdError):
+        return None
+    if payload.get("version") != CANDIDATE_CACHE_VERSION:
+        return None
 
-                motif_bucket.append(seed)
-                seen_ids.add(seed.puzzle_id)
-                accepted += 1
+    combo_cap = combo_cap_for(config)
+    rejections: Counter[str] = Counter(payload["rejections"])
+    cached_cap = payload["comboCap"]
+    if cached_cap < combo_cap or (cached_cap > combo_cap and rejections["duplicate"] > 0):
+        return None
+    if config.candidate_pool == "best" and cached_cap != combo_cap:
+        return None
 
-    if accepted == 0:
-        print("No candidate puzzles survived filters. Relax constraints and retry.", file=sys.stderr)
-        sys.exit(1)
+    combo_counts: Dict[str, int] = defaultdict(int)
+    candidates: List[PuzzleSeed] = []
+    for item in payload["candidates"]:
+        (puzzle_id, fen, piece_count, rating_bucket, san, themes_raw,
+         rating, popularity, nb_plays, forcing, fingerprint) = item
+        key = f"p{piece_count}-r{rating_bucket}"
+        if combo_counts[key] >= combo_cap:
+            continue
+        combo_counts[key] += 1
+        themes = interned(parse_themes(themes_raw))
+        san_line = interned(san.split(" "))
+        candidates.append(PuzzleSeed(
+            puzzle_id=puzzle_id,
+            fen=fen,
+            piece_count=piece_count,
+            rating_bucket=rating_bucket,
+            continuation_san=san_line,
+            themes=themes,
+            motif=motif_for(themes),
+            simplicity_score=simplicity_score_for(
+                themes=themes,
+                rating=rating,
+                popularity=popularity,
+                nb_plays=nb_plays,
+                line_plies=len(san_line),
+                first_move_forcing=bool(forcing),
+                config=config
+            ),
+            rating=rating,
+            popularity=popularity,
+            nb_plays=nb_plays,
+            first_move_forcing=bool(forcing),
+            line_fingerprint=fingerprint
+        ))
+
+    return CandidateScan(
+        candidates=candidates,
+        combo_cap=combo_cap,
+        scanned=payload["scanned"],
+        rejections=rejections,
+        saturated=payload["saturated"]
+    )
 
-    print(f"Scanned rows: {scanned}")
-    if config.max_rows is not None and scanned == config.max_rows:
-        print(f"Stopped early at row cap: {config.max_rows}")
-    print(f"Accepted candidates: {accepted}")
+
+CANDIDATE_DB_VERSION = 2
+
+CANDIDATE_DB_SCHEMA = """
+CREATE TABLE meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE candidates (
+    puzzle_id TEXT PRIMARY KEY,
+    accepted_order INTEGER NOT NULL,
+    fen TEXT NOT NULL,
+    piece_count INTEGER NOT NULL,
+    rating_bucket INTEGER NOT NULL,
+    rating INTEGER NOT NULL,
+    popularity INTEGER NOT NULL,
+    nb_plays INTEGER NOT NULL,
+    motif TEXT NOT NULL,
+    simplicity_score REAL NOT NULL,
+    first_move_forcing INTEGER NOT NULL,
+    continuation_san TEXT NOT NULL,
+    themes TEXT NOT NULL,
+    line_fingerprint TEXT NOT NULL
+);
+CREATE TABLE candidate_themes (
+    theme TEXT NOT NULL,
+    puzzle_id TEXT NOT NULL REFERENCES candidates (puzzle_id),
+    PRIMARY KEY (theme, puzzle_id)
+) WITHOUT ROWID;
+CREATE INDEX candidates_by_combo ON candidates (piece_count, rating_bucket, accepted_order);
+CREATE INDEX candidates_by_motif ON candidates (motif, piece_count, rating_bucket);
+CREATE INDEX candidates_by_rating_bucket ON candidates (rating_bucket);
+"""
+
+
+def config_as_json(config: BuilderConfig) -> str:
+    return json.dumps({key: str(value) if isinstance(value, Path) else value for key, value in asdict(config).items()})
+
+
+def config_from_json(raw: str) -> BuilderConfig:
+    values = json.loads(raw)
+    known = {item.name: item for item in fields(BuilderConfig)}
+    kwargs: Dict[str, object] = {}
+    for key, value in values.items():
+        if key not in known:
+            continue
+        if value is not None and key in PATH_FIELDS:
+            value = Path(value)
+        kwargs[key] = value
+    return BuilderConfig(**kwargs)
+
+
+def save_candidate_db(path: Path, config: BuilderConfig, scan: CandidateScan) -> None:
+    """Write the scan's candidate pool, capped per combo and in acceptance order, to a fresh SQLite store."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_suffix(path.suffix + ".part")
+    temp_path.unlink(missing_ok=True)
+    connection = sqlite3.connect(temp_path)
+    try:
+        connection.executescript(CANDIDATE_DB_SCHEMA)
+        connection.executemany("INSERT INTO meta (key, value) VALUES (?, ?)", [
+            ("version", str(CANDIDATE_DB_VERSION)),
+            ("generatedAt", datetime.now(timezone.utc).isoformat()),
+            ("config", config_as_json(config)),
+            ("comboCap", str(scan.combo_cap)),
+            ("scanned", str(scan.scanned))
+        ])
+        connection.executemany(
+            "INSERT INTO candidates VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                (
+                    seed.puzzle_id,
+                    order,
+                    seed.fen,
+                    seed.piece_count,
+                    seed.rating_bucket,
+                    seed.rating,
+                    seed.popularity,
+                    seed.nb_plays,
+                    seed.motif,
+                    seed.simplicity_score,
+                    int(seed.first_move_forcing),
+                    " ".join(seed.continuation_san),
+                    " ".join(seed.themes),
+                    seed.line_fingerprint
+                )
+                for order, seed in enumerate(scan.candidates)
+            )
+        )
+        connection.executemany(
+            "INSERT OR IGNORE INTO candidate_themes (theme, puzzle_id) VALUES (?, ?)",
+            ((theme, seed.puzzle_id) for seed in scan.candidates for theme in seed.themes)
+        )
+        connection.commit()
+    finally:
+        connection.close()
+    temp_path.replace(path)
+
+
+def select_by_combo(config: BuilderConfig, candidates: Iterable[PuzzleSeed]) -> Dict[str, List[PuzzleSeed]]:
+    """Group candidates by combo and motif and pick each combo's balanced selection."""
+    candidates_by_combo: Dict[str, Dict[str, List[PuzzleSeed]]] = defaultdict(lambda: defaultdict(list))
+    for seed in candidates:
+        candidates_by_combo[combo_key(seed)][seed.motif].append(seed)
 
     rng = random.Random(config.seed)
     selected_by_combo: Dict[str, List[PuzzleSeed]] = {}
@@ -543,45 +2260,477 @@ def build_dataset(config: BuilderConfig) -> tuple[Dict[str, List[PuzzleSeed]], i
         )
         if selected:
             selected_by_combo[key] = selected
+    return selected_by_combo
 
-    return selected_by_combo, scanned
 
+def require_input(config: BuilderConfig) -> None:
+    if config.input_url is None and not config.input_path.exists():
+        print(f"Input file not found: {config.input_path}", file=sys.stderr)
+        print("Run `npm run puzzles:download` first.", file=sys.stderr)
+        sys.exit(1)
 
-def write_outputs(config: BuilderConfig, selected_by_combo: Dict[str, List[PuzzleSeed]]) -> None:
-    output_dir = config.output_dir
-    lichess_dir = output_dir / "lichess"
 
-    if lichess_dir.exists():
+def scan_or_exit(scan_config: BuilderConfig, profiles: Sequence[BuilderConfig]) -> List[CandidateScan]:
+    replay_state = load_replay_state(scan_config) if scan_config.state_file is not None else None
+    try:
+        scans = scan_profiles(scan_config, profiles, replay_state)
+    except (requests.RequestException, ArchiveVerificationError) as error:
+        print(f"Streaming {scan_config.input_url} failed: {error}", file=sys.stderr)
+        sys.exit(1)
+    if replay_state is not None:
+        save_replay_state(scan_config, replay_state)
+    return scans
+
+
+def save_scan_to_cache(config: BuilderConfig, scan: CandidateScan) -> None:
+    cache_path = candidate_cache_path(config)
+    if cache_path is not None and scan.candidates:
+        save_candidate_cache(cache_path, scan)
+        print(f"Wrote candidate cache: {cache_path}")
+
+
+def build_dataset(config: BuilderConfig) -> tuple[Dict[str, List[PuzzleSeed]], int]:
+    require_input(config)
+    cache_path = candidate_cache_path(config)
+    scan = load_candidate_cache(cache_path, config) if cache_path is not None else None
+    from_cache = scan is not None
+    if scan is not None:
+        print(f"Loaded {len(scan.candidates)} candidates from cache: {cache_path}")
+    else:
+        scan = scan_or_exit(config, [config])[0]
+        save_scan_to_cache(config, scan)
+    return select_from_scan(config, scan, from_cache), scan.scanned
+
+
+def build_profiles(profiles: Dict[str, BuilderConfig]) -> Dict[str, Dict[str, List[PuzzleSeed]]]:
+    """Build every profile from one scan of the archive, unless all of them are cached."""
+    configs = list(profiles.values())
+    require_input(configs[0])
+    cached: List[Optional[CandidateScan]] = []
+    for config in configs:
+        cache_path = candidate_cache_path(config)
+        cached.append(load_candidate_cache(cache_path, config) if cache_path is not None else None)
+
+    from_cache = all(scan is not None for scan in cached)
+    if from_cache:
+        scans = [scan for scan in cached if scan is not None]
+        print("Loaded every profile's candidates from cache")
+    else:
+        scan_config = profile_scan_config(configs)
+        scans = scan_or_exit(scan_config, configs)
+        for config, scan in zip(configs, scans):
+            save_scan_to_cache(config, scan)
+
+    selected: Dict[str, Dict[str, List[PuzzleSeed]]] = {}
+    for (name, config), scan in zip(profiles.items(), scans):
+        print(f"Profile {name}:")
+        selected[name] = select_from_scan(config, scan, from_cache)
+    return selected
+
+
+def select_from_scan(config: BuilderConfig, scan: CandidateScan, from_cache: bool) -> Dict[str, List[PuzzleSeed]]:
+    """Report the scan, then store and select its candidates as ``config`` asks."""
+    if not scan.candidates:
+        print("No candidate puzzles survived filters. Relax constraints and retry.", file=sys.stderr)
+        sys.exit(1)
+
+    print(f"Scanned rows: {scan.scanned}")
+    if scan.saturated:
+        print("Stopped early: every expected combo reached its candidate cap")
+    elif config.max_rows is not None and scan.scanned == config.max_rows:
+        print(f"Stopped early at row cap: {config.max_rows}")
+    print(f"Accepted candidates: {len(scan.candidates)}")
+    print("Rejected rows by stage:")
+    for stage in REJECTION_STAGES:
+        print(f"  {stage}: {scan.rejections[stage]}")
+
+    if config.candidate_db is not None:
+        save_candidate_db(config.candidate_db, config, scan)
+        print(f"Wrote candidate database: {config.candidate_db}")
+
+    selection_started = time.perf_counter()
+    selected_by_combo = select_by_combo(config, scan.candidates)
+    scan.timings["selection"] += time.perf_counter() - selection_started
+
+    if config.stats_json is not None:
+        write_build_stats(config.stats_json, build_stats(config, scan, selected_by_combo, from_cache))
+        print(f"Wrote build stats: {config.stats_json}")
+    return selected_by_combo
+
+
+BUILD_STATS_VERSION = 1
+
+
+def build_stats(
+    config: BuilderConfig,
+    scan: CandidateScan,
+    selected_by_combo: Dict[str, List[PuzzleSeed]],
+    from_cache: bool
+) -> Dict[str, object]:
+    """The --stats-json report: where build time went and which filters bit.
+
+    Stage seconds for the parser stages (themes, board, replay) are summed
+    over worker processes when ``--workers`` is above 1. A cached scan has no
+    scan timings and no saturation rows.
+    """
+    candidate_counts = Counter(map(combo_key, scan.candidates))
+    combos: Dict[str, Dict[str, object]] = {}
+    for key in sorted(expected_combo_keys(config).union(candidate_counts)):
+        candidates = candidate_counts[key]
+        combos[key] = {
+            "candidates": candidates,
+            "fillRate": round(candidates / scan.combo_cap, 4) if scan.combo_cap else None,
+            "selected": len(selected_by_combo.get(key, ())),
+            "saturatedAtRow": scan.saturated_at_row.get(key)
+        }
+    return {
+        "version": BUILD_STATS_VERSION,
+        "generatedAt": datetime.now(timezone.utc).isoformat(),
+        "fromCache": from_cache,
+        "reader": config.reader,
+        "workers": config.workers,
+        "rowsScanned": scan.scanned,
+        "acceptedCandidates": len(scan.candidates),
+        "saturated": scan.saturated,
+        "comboCap": scan.combo_cap,
+        "scanSeconds": round(scan.timings["scan"], 6),
+        "stageSeconds": {stage: round(scan.timings[stage], 6) for stage in TIMING_STAGES},
+        "rejections": {stage: scan.rejections[stage] for stage in REJECTION_STAGES},
+        "combos": combos
+    }
+
+
+def write_build_stats(path: Path, stats: Dict[str, object]) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(stats, indent=2), encoding="utf-8")
+
+
+def fsync_directory(path: Path) -> None:
+    try:
+        descriptor = os.open(path, os.O_RDONLY)
+    except OSError:
+        # Directories cannot be opened on Windows; NTFS journals renames itself.
+        return
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def replace_file(path: Path, data: bytes) -> None:
+    """Write ``data`` to ``path`` through a fsynced temporary file and a rename."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(f".{path.name}.tmp")
+    try:
+        with open(temp_path, "wb") as handle:
+            handle.write(data)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(temp_path, path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+def manifest_files(manifest: Dict[str, object]) -> set[str]:
+    """Every shard, page and facets path ``manifest`` names, with their sibling names."""
+    named: set[str] = set()
+    if "pages" in manifest:
+        named.update(str(page["path"]) for pages in manifest["pages"].values() for page in pages)
+    elif "shards" in manifest:
+        named.update(str(entry["path"]) for entry in manifest["shards"].values())
+    else:
+        pattern = str(manifest.get("shardPattern", ""))
+        for key in manifest.get("countsByCombo", {}):
+            piece_count, rating_bucket = (int(part[1:]) for part in key.split("-"))
+            named.add(pattern.format(pieceCount=piece_count, ratingBucket=rating_bucket))
+    if isinstance(manifest.get("facets"), dict):
+        named.add(str(manifest["facets"]["path"]))
+    named.update([f"{path}.{suffix}" for path in named for suffix in PRECOMPRESSED_SUFFIXES])
+    return named
+
+
+class OutputGeneration:
+    """One build's files, written into ``output_dir`` beside the published ones.
+
+    Every changed file goes through ``replace_file``, so a reader never sees
+    it half written; unchanged files are left alone and keep their mtimes.
+    ``publish`` replaces manifest.json last. With --hash-shards a changed
+    shard or facets file gets a new name, so up to that point readers of the
+    old manifest find every file it names, and afterwards readers of the new
+    one do. Without it, shard names repeat and a rewritten shard replaces the
+    old one in place before the manifest does.
+
+    The replaced manifest is kept as manifest.previous.json, and the files it
+    names stay until the next build, for readers that fetched it just before
+    the swap. Only older files under lichess/ are removed.
+    """
+
+    def __init__(self, output_dir: Path) -> None:
+        self.output_dir = output_dir
+        self.manifest_path = output_dir / "manifest.json"
+        self.written: set[Path] = set()
+        # Manifest files, held back until every file they name is in place.
+        self.deferred: Dict[Path, bytes] = {}
         try:
-            shutil.rmtree(lichess_dir)
-        except PermissionError:
-            # On some Windows/OneDrive setups, removing folder trees can fail with
-            # transient permission errors; stale shards are harmless because
-            # manifest/countsByCombo controls which combos are selectable.
+            self.published_manifest: Optional[bytes] = self.manifest_path.read_bytes()
+        except FileNotFoundError:
+            self.published_manifest = None
+
+    def keep(self, *paths: Path) -> None:
+        """Make existing ``paths`` part of this generation as they are."""
+        self.written.update(paths)
+
+    def write(self, path: Path, data: bytes) -> bool:
+        """Write ``data`` to ``path`` unless it holds it already; return whether it changed."""
+        self.written.add(path)
+        try:
+            if path.read_bytes() == data:
+                return False
+        except FileNotFoundError:
+            pass
+        if path.parent == self.output_dir and path.name.startswith(self.manifest_path.name):
+            self.deferred[path] = data
+        else:
+            replace_file(path, data)
+        return True
+
+    def publish(self) -> int:
+        """Swap in the new manifest, then drop files older than the previous generation; return how many."""
+        for directory in sorted({path.parent for path in self.written}):
+            fsync_directory(directory)
+        if self.manifest_path in self.deferred and self.published_manifest is not None:
+            replace_file(self.output_dir / PREVIOUS_MANIFEST_NAME, self.published_manifest)
+        # Siblings first: a client that fetches manifest.json.br gets the same
+        # manifest as one that fetches manifest.json, or the previous one.
+        for path in sorted(self.deferred, key=lambda path: path == self.manifest_path):
+            replace_file(path, self.deferred[path])
+        fsync_directory(self.output_dir)
+
+        keep = {path.relative_to(self.output_dir).as_posix() for path in self.written}
+        try:
+            keep.update(manifest_files(json.loads((self.output_dir / PREVIOUS_MANIFEST_NAME).read_bytes())))
+        except (OSError, ValueError):
             pass
-    output_dir.mkdir(parents=True, exist_ok=True)
+        removed = 0
+        lichess_dir = self.output_dir / "lichess"
+        for path in sorted(lichess_dir.rglob("*"), reverse=True) if lichess_dir.is_dir() else ():
+            if path.is_dir():
+                if not any(path.iterdir()):
+                    path.rmdir()
+            elif path.relative_to(self.output_dir).as_posix() not in keep:
+                path.unlink()
+                removed += 1
+        # A sibling this build did not write holds an older manifest.
+        for path in self.output_dir.glob(f"{self.manifest_path.name}.*"):
+            if path not in self.written:
+                path.unlink()
+        return removed
+
+
+def hashed_shard_path(shard_path: Path, digest: str) -> Path:
+    # r1200.json -> r1200.<hash>.json, r1200.cols.json -> r1200.<hash>.cols.json
+    stem, _, suffixes = shard_path.name.partition(".")
+    return shard_path.with_name(f"{stem}.{digest[:HASHED_NAME_DIGITS]}.{suffixes}")
+
+
+def precompressed_variants(data: bytes) -> Dict[str, bytes]:
+    """``data`` encoded at maximum compression, keyed by sibling file suffix."""
+    variants = {
+        "gz": gzip.compress(data, compresslevel=9, mtime=0),
+        "zst": zstandard.ZstdCompressor(level=zstandard.MAX_COMPRESSION_LEVEL).compress(data)
+    }
+    if brotli is not None:
+        variants["br"] = brotli.compress(data, quality=11)
+    return variants
+
+
+def sibling_paths(path: Path) -> Dict[str, Path]:
+    siblings = {suffix: path.with_name(f"{path.name}.{suffix}") for suffix in PRECOMPRESSED_SUFFIXES}
+    if brotli is None:
+        siblings.pop("br")
+    return siblings
+
+
+def write_with_siblings(
+    path: Path,
+    data: bytes,
+    precompress: bool,
+    output: OutputGeneration,
+    variants: Optional[Dict[str, bytes]] = None
+) -> tuple[bool, Dict[str, int]]:
+    """Write ``path`` (and its precompressed siblings); return (rewritten, encoded sizes).
+
+    ``variants`` are the siblings' bytes when already compressed elsewhere.
+    """
+    rewritten = output.write(path, data)
+    encoded_bytes: Dict[str, int] = {}
+    if not precompress:
+        return rewritten, encoded_bytes
+
+    siblings = sibling_paths(path)
+    if not rewritten and all(sibling.exists() for sibling in siblings.values()):
+        # Unchanged content: the siblings on disk are still current.
+        encoded_bytes = {suffix: sibling.stat().st_size for suffix, sibling in siblings.items()}
+        output.keep(*siblings.values())
+    else:
+        for suffix, encoded in (variants or precompressed_variants(data)).items():
+            output.write(siblings[suffix], encoded)
+            encoded_bytes[suffix] = len(encoded)
+    return rewritten, encoded_bytes
+
+
+FACETS_VERSION = 1
+
+
+def combo_facets(seeds: Sequence[PuzzleSeed]) -> Dict[str, object]:
+    """Counts and offsets of every motif and theme among one combo's puzzles.
+
+    Offsets index the combo's puzzles in shard order, across pages when the
+    combo is paged (page ``offset // pageSize``, entry ``offset % pageSize``).
+    """
+    motifs: Dict[str, List[int]] = defaultdict(list)
+    themes: Dict[str, List[int]] = defaultdict(list)
+    for offset, seed in enumerate(seeds):
+        motifs[seed.motif].append(offset)
+        for theme in dict.fromkeys(seed.themes):
+            themes[theme].append(offset)
+    return {
+        "motifCounts": {motif: len(offsets) for motif, offsets in sorted(motifs.items())},
+        "themeCounts": {theme: len(offsets) for theme, offsets in sorted(themes.items())},
+        "motifs": dict(sorted(motifs.items())),
+        "themes": dict(sorted(themes.items()))
+    }
+
+
+@dataclass(frozen=True)
+class EncodedShard:
+    path: Path
+    data: bytes
+    digest: str
+    # None when the published siblings are current, or --precompress is off.
+    variants: Optional[Dict[str, bytes]]
+
+
+def encode_shard(config: BuilderConfig, seeds: Sequence[PuzzleSeed], page: Optional[int]) -> EncodedShard:
+    """Serialize (and compress) one shard or page; runs in a worker process with --workers above 1."""
+    lichess_dir = config.output_dir / "lichess"
+    shard_path = shard_path_for(lichess_dir, seeds[0].piece_count, seeds[0].rating_bucket, config.shard_format, page)
+    data = shard_bytes(seeds, config.shard_format)
+    digest = hashlib.sha256(data).hexdigest()
+    if config.hash_shards:
+        shard_path = hashed_shard_path(shard_path, digest)
+    variants = None
+    if config.precompress:
+        try:
+            current = shard_path.read_bytes() == data and all(sibling.exists() for sibling in sibling_paths(shard_path).values())
+        except FileNotFoundError:
+            current = False
+        if not current:
+            variants = precompressed_variants(data)
+    return EncodedShard(shard_path, data, digest, variants)
+
+
+def write_shard(
+    config: BuilderConfig,
+    output: OutputGeneration,
+    encoded: EncodedShard,
+    puzzles: Optional[int]
+) -> tuple[Dict[str, object], bool]:
+    """Write one encoded shard (or page); return its manifest entry and whether it changed."""
+    rewritten, encoded_bytes = write_with_siblings(encoded.path, encoded.data, config.precompress, output, encoded.variants)
+    entry: Dict[str, object] = {
+        "path": encoded.path.relative_to(config.output_dir).as_posix(),
+        "sha256": encoded.digest,
+        "bytes": len(encoded.data)
+    }
+    if puzzles is not None:
+        entry["puzzles"] = puzzles
+    if encoded_bytes:
+        entry["encodedBytes"] = encoded_bytes
+    return entry, rewritten
+
+
+def write_outputs(config: BuilderConfig, selected_by_combo: Dict[str, List[PuzzleSeed]]) -> None:
+    """Write shards, facets and manifest as one generation.
+
+    Shards and facets are written first and the manifest last (see
+    ``OutputGeneration``); with --hash-shards a reader of either manifest
+    finds the files it names. With --workers above 1, shards are serialized
+    and compressed in worker processes; the main process writes them.
+    Unchanged files keep their bytes and mtimes, which keeps deploy diffs and
+    CDN invalidations small.
+    """
+    output_dir = config.output_dir
+    lichess_dir = output_dir / "lichess"
+    output_dir.parent.mkdir(parents=True, exist_ok=True)
+    output = OutputGeneration(output_dir)
 
     counts_by_combo: Dict[str, int] = {}
     piece_counts: set[int] = set()
     rating_buckets: set[int] = set()
     total_count = 0
-
-    for key, seeds in sorted(selected_by_combo.items()):
-        if not seeds:
-            continue
-        piece_count = seeds[0].piece_count
-        rating_bucket = seeds[0].rating_bucket
-        shard_path = lichess_dir / f"p{piece_count}" / f"r{rating_bucket}.json"
-        shard_path.parent.mkdir(parents=True, exist_ok=True)
-
-        payload = [as_output(seed) for seed in seeds]
-        with open(shard_path, "w", encoding="utf-8") as handle:
-            json.dump(payload, handle, ensure_ascii=False)
-
-        counts_by_combo[key] = len(seeds)
-        piece_counts.add(piece_count)
-        rating_buckets.add(rating_bucket)
-        total_count += len(seeds)
+    shard_entries: Dict[str, Dict[str, object]] = {}
+    page_entries: Dict[str, List[Dict[str, object]]] = {}
+    facets: Dict[str, Dict[str, object]] = {}
+    shard_files = 0
+    rewritten = 0
+    paged = config.page_size > 0
+
+    combos = [(key, seeds) for key, seeds in sorted(selected_by_combo.items()) if seeds]
+    pages = [
+        [(page if paged else None, page_seeds) for page, page_seeds in enumerate(paginate(seeds, config.page_size))]
+        for _, seeds in combos
+    ]
+    pool_context: ContextManager[Optional[ProcessPoolExecutor]] = (
+        ProcessPoolExecutor(max_workers=config.workers) if config.workers > 1 else nullcontext()
+    )
+    with pool_context as pool:
+        # Every shard is queued at once, so workers stay busy across combos;
+        # results come back in submission order.
+        encoded_shards = (pool.map if pool is not None else map)(
+            encode_shard,
+            itertools.repeat(config),
+            [page_seeds for combo_pages in pages for _, page_seeds in combo_pages],
+            [page for combo_pages in pages for page, _ in combo_pages]
+        )
+        for (key, seeds), combo_pages in zip(combos, pages):
+            entries: List[Dict[str, object]] = []
+            for (_, page_seeds), encoded in zip(combo_pages, encoded_shards):
+                entry, shard_rewritten = write_shard(config, output, encoded, len(page_seeds) if paged else None)
+                entries.append(entry)
+                shard_files += 1
+                rewritten += int(shard_rewritten)
+            if paged:
+                page_entries[key] = entries
+            elif config.hash_shards:
+                shard_entries[key] = entries[0]
+
+            piece_count = seeds[0].piece_count
+            rating_bucket = seeds[0].rating_bucket
+            counts_by_combo[key] = len(seeds)
+            facets[key] = combo_facets(seeds)
+            piece_counts.add(piece_count)
+            rating_buckets.add(rating_bucket)
+            total_count += len(seeds)
+
+    # Motif and theme offsets per combo, so a filtered pick needs this file and
+    # the one shard (or page) holding the chosen puzzle, not every shard.
+    facets_data = json.dumps(
+        {"version": FACETS_VERSION, "pageSize": config.page_size, "combos": facets},
+        ensure_ascii=False
+    ).encode("utf-8")
+    facets_digest = hashlib.sha256(facets_data).hexdigest()
+    facets_path = lichess_dir / "facets.json"
+    if config.hash_shards:
+        facets_path = hashed_shard_path(facets_path, facets_digest)
+    _, facets_encoded_bytes = write_with_siblings(facets_path, facets_data, config.precompress, output)
+    facets_entry: Dict[str, object] = {
+        "path": facets_path.relative_to(output_dir).as_posix(),
+        "sha256": facets_digest,
+        "bytes": len(facets_data)
+    }
+    if facets_encoded_bytes:
+        facets_entry["encodedBytes"] = facets_encoded_bytes
 
     manifest = {
         "version": MANIFEST_VERSION,
@@ -591,20 +2740,56 @@ def write_outputs(config: BuilderConfig, selected_by_combo: Dict[str, List[Puzzl
         "pieceCounts": sorted(piece_counts),
         "ratingBuckets": sorted(rating_buckets),
         "countsByCombo": counts_by_combo,
-        "shardPattern": "lichess/p{pieceCount}/r{ratingBucket}.json",
-        "totalCount": total_count
+        "shardPattern": (PAGED_SHARD_PATTERNS if paged else SHARD_PATTERNS)[config.shard_format],
+        "totalCount": total_count,
+        "facets": facets_entry
     }
-
-    with open(output_dir / "manifest.json", "w", encoding="utf-8") as handle:
-        json.dump(manifest, handle, ensure_ascii=False)
-
-    print(f"Wrote {total_count} puzzles across {len(counts_by_combo)} combo shards")
+    if config.shard_format != "json":
+        # The web client rejects anything but JSON shards; other readers key off this.
+        manifest["shardFormat"] = config.shard_format
+    if paged:
+        # Each combo's pages in order, so a client can pick one page at
+        # random (weighted by "puzzles") and fetch only that file.
+        manifest["pageSize"] = config.page_size
+        manifest["pages"] = page_entries
+    elif config.hash_shards:
+        # Hashed filenames can't be derived from shardPattern; clients look
+        # each combo up here, and the names can be cached as immutable.
+        manifest["shards"] = shard_entries
+
+    manifest_path = output_dir / "manifest.json"
+    if config.incremental:
+        # Keep the previous generatedAt when nothing else changed, so an
+        # unchanged build leaves the manifest byte-identical too.
+        try:
+            previous = json.loads(manifest_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            previous = None
+        if isinstance(previous, dict) and {**previous, "generatedAt": manifest["generatedAt"]} == manifest:
+            manifest["generatedAt"] = previous["generatedAt"]
+    write_with_siblings(
+        manifest_path,
+        json.dumps(manifest, ensure_ascii=False).encode("utf-8"),
+        config.precompress,
+        output
+    )
+    removed = output.publish()
+
+    if paged:
+        print(f"Wrote {total_count} puzzles across {len(counts_by_combo)} combos in {shard_files} pages of up to {config.page_size}")
+    else:
+        print(f"Wrote {total_count} puzzles across {len(counts_by_combo)} combo shards")
+    if config.precompress and brotli is None:
+        print("Warning: brotli is not installed; skipped .br siblings (python -m pip install brotli)")
+    if config.incremental:
+        unchanged = shard_files - rewritten
+        print(f"Incremental: rewrote {rewritten} shards, kept {unchanged} unchanged, removed {removed} stale")
     expected_piece_counts = set(range(config.min_piece_count, config.max_piece_count + 1))
     missing_piece_counts = sorted(expected_piece_counts.difference(piece_counts))
     if missing_piece_counts:
         print(f"Warning: no puzzles found for piece counts: {missing_piece_counts}")
 
-    expected_buckets = set(range(config.min_rating, config.max_rating + 1, config.bucket_size))
+    expected_buckets = set(expected_rating_buckets(config))
     missing_rating_buckets = sorted(expected_buckets.difference(rating_buckets))
     if missing_rating_buckets:
         print(f"Warning: no puzzles found for rating buckets: {missing_rating_buckets}")
@@ -612,6 +2797,11 @@ def write_outputs(config: BuilderConfig, selected_by_combo: Dict[str, List[Puzzl
 
 def main() -> None:
     config = parse_args()
+    if config.profiles is not None:
+        profiles = load_profiles(config)
+        for name, selected_by_combo in build_profiles(profiles).items():
+            write_outputs(profiles[name], selected_by_combo)
+        return
     selected_by_combo, _ = build_dataset(config)
     write_outputs(config, selected_by_combo)
 
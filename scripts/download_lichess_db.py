@@ -4,13 +4,30 @@
 from __future__ import annotations
 
 import argparse
+import hashlib
+import io
+import json
+import queue
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
 from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, List, Optional, Union
 
 import requests
+import zstandard
 from tqdm import tqdm
 
 PUZZLE_DB_URL = "https://database.lichess.org/lichess_db_puzzle.csv.zst"
+USER_AGENT = "BlindfoldExercises/2.0 (Lichess DB downloader)"
+CHUNK_SIZE = 1024 * 1024
+PREFETCH_CHUNKS = 16
+# Segment progress is persisted after this many bytes or seconds, whichever comes first.
+SEGMENTS_SAVE_BYTES = 16 * CHUNK_SIZE
+SEGMENTS_SAVE_SECONDS = 2.0
 
 
 def parse_args() -> argparse.Namespace:
@@ -25,53 +42,585 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="Redownload even if the target file already exists"
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--connections",
+        type=int,
+        default=1,
+        help="Fetch byte ranges over this many concurrent connections (needs server Range support)"
+    )
+    parser.add_argument("--url", default=PUZZLE_DB_URL, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.connections < 1:
+        parser.error("--connections must be at least 1")
+    return args
+
+
+class ArchiveVerificationError(Exception):
+    """The downloaded bytes are not a complete, intact zstd archive."""
+
+
+@dataclass(frozen=True)
+class RemoteInfo:
+    size: Optional[int]
+    accepts_ranges: bool
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    not_modified: bool = False
+
+    @property
+    def validator(self) -> Optional[str]:
+        """Value for If-Range: a strong ETag if there is one, else Last-Modified."""
+        if self.etag and not self.etag.startswith("W/"):
+            return self.etag
+        return self.last_modified
+
+
+@dataclass(frozen=True)
+class ArchiveMeta:
+    """Sidecar metadata recorded next to a verified archive."""
+
+    url: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    size: int
+    sha256: str
+    # mtime of the archive when it was verified; sidecars from before this
+    # field have None and are re-verified once.
+    mtime_ns: Optional[int] = None
+
+
+def verified_meta(output_path: Path, url: str, etag: Optional[str], last_modified: Optional[str], sha256: str) -> ArchiveMeta:
+    """Sidecar for ``output_path``, just verified with ``sha256``."""
+    stat = output_path.stat()
+    return ArchiveMeta(url, etag, last_modified, stat.st_size, sha256, stat.st_mtime_ns)
+
 
+def meta_path_for(output_path: Path) -> Path:
+    return output_path.with_suffix(output_path.suffix + ".meta.json")
 
-def remote_size(session: requests.Session, url: str) -> int | None:
+
+def load_meta(path: Path) -> Optional[ArchiveMeta]:
     try:
-        response = session.head(url, timeout=30)
+        return ArchiveMeta(**json.loads(path.read_text(encoding="utf-8")))
+    except (OSError, ValueError, TypeError):
+        return None
+
+
+def save_meta(path: Path, meta: ArchiveMeta) -> None:
+    temp_path = path.with_suffix(path.suffix + ".tmp")
+    temp_path.write_text(json.dumps(asdict(meta), indent=2), encoding="utf-8")
+    temp_path.replace(path)
+
+
+def conditional_headers(meta: Optional[ArchiveMeta]) -> Dict[str, str]:
+    headers: Dict[str, str] = {}
+    if meta is None:
+        return headers
+    if meta.etag:
+        headers["If-None-Match"] = meta.etag
+    if meta.last_modified:
+        headers["If-Modified-Since"] = meta.last_modified
+    return headers
+
+
+def remote_info(session: requests.Session, url: str, meta: Optional[ArchiveMeta] = None) -> RemoteInfo:
+    try:
+        response = session.head(url, headers=conditional_headers(meta), timeout=30, allow_redirects=True)
+        if response.status_code == 304:
+            return RemoteInfo(size=None, accepts_ranges=False, not_modified=True)
         if response.status_code >= 400:
-            return None
+            return RemoteInfo(size=None, accepts_ranges=False)
         value = response.headers.get("Content-Length")
-        return int(value) if value else None
+        return RemoteInfo(
+            size=int(value) if value else None,
+            accepts_ranges=response.headers.get("Accept-Ranges", "").lower() == "bytes",
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified")
+        )
     except requests.RequestException:
+        return RemoteInfo(size=None, accepts_ranges=False)
+
+
+def unchanged_since(meta: ArchiveMeta, info: RemoteInfo) -> bool:
+    # For servers that ignore conditional requests: compare validators ourselves.
+    if info.etag and meta.etag:
+        return info.etag == meta.etag
+    if info.last_modified and meta.last_modified:
+        return info.last_modified == meta.last_modified and info.size == meta.size
+    return False
+
+
+def verify_archive(path: Path) -> str:
+    """Decompress every zstd frame in ``path`` and return the file's SHA-256.
+
+    libzstd checks each frame's content checksum when the frame carries one.
+    Truncation is caught by requiring the last frame to be complete.
+    """
+    digest = hashlib.sha256()
+    dctx = zstandard.ZstdDecompressor()
+    decompressor = dctx.decompressobj()
+    frames = 0
+    mid_frame = False
+    try:
+        with open(path, "rb") as handle:
+            for chunk in iter(lambda: handle.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+                while chunk:
+                    decompressor.decompress(chunk)
+                    mid_frame = True
+                    if not decompressor.eof:
+                        break
+                    frames += 1
+                    mid_frame = False
+                    chunk = decompressor.unused_data
+                    decompressor = dctx.decompressobj()
+    except zstandard.ZstdError as error:
+        raise ArchiveVerificationError(f"{path.name}: {error}") from error
+    if mid_frame:
+        raise ArchiveVerificationError(f"{path.name}: archive ends in the middle of a zstd frame")
+    if frames == 0:
+        raise ArchiveVerificationError(f"{path.name}: no zstd frame found")
+    return digest.hexdigest()
+
+
+def new_session() -> requests.Session:
+    session = requests.Session()
+    session.headers.update({"User-Agent": USER_AGENT})
+    return session
+
+
+def content_range_start(response: requests.Response) -> Optional[int]:
+    # "Content-Range: bytes 100-199/1000" -> 100
+    value = response.headers.get("Content-Range", "")
+    if not value.startswith("bytes ") or "-" not in value:
+        return None
+    try:
+        return int(value[len("bytes "):].split("-", 1)[0])
+    except ValueError:
         return None
 
 
-def main() -> None:
-    args = parse_args()
-    output_path = Path(args.output).expanduser().resolve()
-    output_path.parent.mkdir(parents=True, exist_ok=True)
+def download_resumable(
+    session: requests.Session,
+    url: str,
+    temp_path: Path,
+    expected_size: Optional[int],
+    show_progress: bool = True,
+    if_range: Optional[str] = None
+) -> None:
+    """Stream ``url`` into ``temp_path``, continuing an existing partial file when the server allows it.
 
-    with requests.Session() as session:
-        session.headers.update({"User-Agent": "BlindfoldExercises/2.0 (Lichess DB downloader)"})
-        expected_size = remote_size(session, PUZZLE_DB_URL)
+    ``if_range`` makes the server send the whole file instead of a range when
+    the remote archive changed since the partial file was started.
+    """
+    offset = temp_path.stat().st_size if temp_path.exists() else 0
+    if expected_size is not None and offset > expected_size:
+        offset = 0
+    if expected_size is not None and offset == expected_size:
+        return
 
-        if output_path.exists() and not args.force and expected_size is not None and output_path.stat().st_size == expected_size:
-            print(f"Skipping download; already up to date: {output_path}")
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    if offset and if_range:
+        headers["If-Range"] = if_range
+    with session.get(url, headers=headers, stream=True, timeout=60) as response:
+        if offset and response.status_code == 416:
+            # Nothing left past our offset: the partial file is already complete.
             return
+        if offset and response.status_code == 206 and content_range_start(response) == offset:
+            mode = "ab"
+        else:
+            # No (usable) range support: start over from the first byte.
+            response.raise_for_status()
+            offset = 0
+            mode = "wb"
+        length = int(response.headers.get("Content-Length") or 0)
+        total = expected_size or (offset + length if length else 0)
+        with open(temp_path, mode) as handle:
+            with tqdm(
+                total=total,
+                initial=offset,
+                unit="B",
+                unit_scale=True,
+                desc=temp_path.name,
+                disable=not show_progress
+            ) as progress:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    if not chunk:
+                        continue
+                    handle.write(chunk)
+                    progress.update(len(chunk))
 
-        temp_path = output_path.with_suffix(output_path.suffix + ".part")
-        try:
-            with session.get(PUZZLE_DB_URL, stream=True, timeout=60) as response:
-                response.raise_for_status()
-                total = int(response.headers.get("Content-Length") or 0)
-                with open(temp_path, "wb") as handle:
-                    with tqdm(total=total, unit="B", unit_scale=True, desc=output_path.name) as progress:
-                        for chunk in response.iter_content(chunk_size=1024 * 1024):
+
+@dataclass
+class Segment:
+    start: int
+    end: int  # inclusive
+    done: int = 0
+
+    @property
+    def remaining(self) -> int:
+        return self.end - self.start + 1 - self.done
+
+
+def plan_segments(start: int, total_size: int, connections: int) -> List[Segment]:
+    span = total_size - start
+    if span <= 0:
+        return []
+    step = -(-span // connections)
+    return [
+        Segment(start=offset, end=min(offset + step, total_size) - 1)
+        for offset in range(start, total_size, step)
+    ]
+
+
+def segments_path_for(temp_path: Path) -> Path:
+    return temp_path.with_suffix(temp_path.suffix + ".segments")
+
+
+def load_segments(path: Path, total_size: int) -> Optional[List[Segment]]:
+    try:
+        payload = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    if payload.get("totalSize") != total_size:
+        return None
+    return [Segment(start=start, end=end, done=done) for start, end, done in payload["segments"]]
+
+
+def save_segments(path: Path, total_size: int, segments: List[Segment]) -> None:
+    payload = {
+        "totalSize": total_size,
+        "segments": [[segment.start, segment.end, segment.done] for segment in segments]
+    }
+    temp_path = path.with_suffix(path.suffix + ".tmp")
+    temp_path.write_text(json.dumps(payload), encoding="utf-8")
+    temp_path.replace(path)
+
+
+def download_ranges(
+    url: str,
+    temp_path: Path,
+    total_size: int,
+    connections: int,
+    show_progress: bool = True,
+    if_range: Optional[str] = None
+) -> None:
+    """Fetch ``url`` as concurrent byte ranges into a preallocated ``temp_path``.
+
+    Per-segment progress is persisted next to the partial file every
+    ``SEGMENTS_SAVE_BYTES`` or ``SEGMENTS_SAVE_SECONDS``, when a segment
+    finishes and when the download stops, so an interrupted run resumes
+    every segment close to where it stopped. A partial file left by a
+    single-connection download is kept as a finished prefix.
+    """
+    segments_path = segments_path_for(temp_path)
+    segments = load_segments(segments_path, total_size) if temp_path.exists() else None
+    if segments is None:
+        prefix = temp_path.stat().st_size if temp_path.exists() else 0
+        prefix = prefix if prefix <= total_size else 0
+        segments = plan_segments(prefix, total_size, connections)
+        with open(temp_path, "r+b" if prefix else "wb") as handle:
+            handle.truncate(total_size)
+        save_segments(segments_path, total_size, segments)
+
+    lock = threading.Lock()
+    unsaved_bytes = 0
+    saved_at = time.monotonic()
+    already_done = total_size - sum(segment.remaining for segment in segments)
+
+    with tqdm(
+        total=total_size,
+        initial=already_done,
+        unit="B",
+        unit_scale=True,
+        desc=temp_path.name,
+        disable=not show_progress
+    ) as progress:
+
+        def record(segment: Segment, size: int) -> None:
+            nonlocal unsaved_bytes, saved_at
+            with lock:
+                segment.done += size
+                unsaved_bytes += size
+                now = time.monotonic()
+                if segment.remaining == 0 or unsaved_bytes >= SEGMENTS_SAVE_BYTES or now - saved_at >= SEGMENTS_SAVE_SECONDS:
+                    save_segments(segments_path, total_size, segments)
+                    unsaved_bytes = 0
+                    saved_at = now
+
+        def fetch(segment: Segment) -> None:
+            first_byte = segment.start + segment.done
+            headers = {"Range": f"bytes={first_byte}-{segment.end}"}
+            if if_range:
+                headers["If-Range"] = if_range
+            with new_session() as session:
+                with session.get(url, headers=headers, stream=True, timeout=60) as response:
+                    if response.status_code != 206 or content_range_start(response) != first_byte:
+                        raise requests.HTTPError(
+                            f"Server ignored range request (HTTP {response.status_code})",
+                            response=response
+                        )
+                    with open(temp_path, "r+b") as handle:
+                        handle.seek(first_byte)
+                        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
                             if not chunk:
                                 continue
+                            chunk = chunk[:segment.remaining]
                             handle.write(chunk)
+                            handle.flush()
+                            record(segment, len(chunk))
                             progress.update(len(chunk))
-        except requests.RequestException as error:
-            print(f"Download failed: {error}", file=sys.stderr)
-            if temp_path.exists():
-                temp_path.unlink(missing_ok=True)
-            sys.exit(1)
+                            if segment.remaining == 0:
+                                break
+            if segment.remaining > 0:
+                raise requests.ConnectionError(f"Range {segment.start}-{segment.end} ended early")
+
+        pending = [segment for segment in segments if segment.remaining > 0]
+        try:
+            with ThreadPoolExecutor(max_workers=connections) as pool:
+                for future in [pool.submit(fetch, segment) for segment in pending]:
+                    future.result()
+        finally:
+            if unsaved_bytes:
+                save_segments(segments_path, total_size, segments)
+
+    segments_path.unlink(missing_ok=True)
+
+
+class ResponseStream(io.RawIOBase):
+    """Read-only file view of a streamed response body.
+
+    A background thread fetches up to ``PREFETCH_CHUNKS`` chunks ahead of the
+    reader, so the network transfer overlaps with whatever consumes the
+    stream. Fetched bytes are optionally copied to ``tee`` and hashed.
+    """
+
+    def __init__(self, response: requests.Response, tee: Optional[BinaryIO] = None) -> None:
+        super().__init__()
+        self.response = response
+        self.tee = tee
+        self.sha256 = hashlib.sha256()
+        self.bytes_fetched = 0
+        self.complete = False
+        self._chunks: queue.Queue[Union[bytes, BaseException, None]] = queue.Queue(maxsize=PREFETCH_CHUNKS)
+        self._stop = threading.Event()
+        self._buffer = memoryview(b"")
+        self._eof = False
+        self._thread = threading.Thread(target=self._fetch, daemon=True)
+        self._thread.start()
+
+    def _put(self, item: Union[bytes, BaseException, None]) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fetch(self) -> None:
+        try:
+            for chunk in self.response.iter_content(chunk_size=CHUNK_SIZE):
+                if not chunk:
+                    continue
+                if self.tee is not None:
+                    self.tee.write(chunk)
+                self.sha256.update(chunk)
+                self.bytes_fetched += len(chunk)
+                if not self._put(chunk):
+                    return
+            expected = self.response.headers.get("Content-Length")
+            if expected is not None and int(expected) != self.bytes_fetched:
+                raise requests.ConnectionError(f"Response ended after {self.bytes_fetched} of {expected} bytes")
+        except BaseException as error:
+            self._put(error)
+            return
+        self.complete = True
+        self._put(None)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: memoryview) -> int:  # type: ignore[override]
+        while not self._buffer and not self._eof:
+            item = self._chunks.get()
+            if isinstance(item, BaseException):
+                self._eof = True
+                raise item
+            if item is None:
+                self._eof = True
+            else:
+                self._buffer = memoryview(item)
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    def drain(self) -> None:
+        """Consume the rest of the body without returning it (e.g. to finish a tee)."""
+        while self.read(CHUNK_SIZE):
+            pass
+
+    def close(self) -> None:
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+        super().close()
+
+
+@contextmanager
+def stream_archive(url: str, tee_path: Optional[Path] = None) -> Iterator[ResponseStream]:
+    """Yield the compressed archive at ``url`` as a stream, without storing it first.
+
+    With ``tee_path``, the fetched bytes are also written to its ``.part`` file.
+    If the body is read to the end, the copy is verified and moved into place
+    with a ``.meta.json`` sidecar, exactly as ``download`` would leave it; the
+    remainder of the body is drained first when the caller stops early.
+    Otherwise the ``.part`` file is kept for ``download`` to resume.
+    """
+    with new_session() as session:
+        with session.get(url, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            if tee_path is None:
+                with ResponseStream(response) as stream:
+                    yield stream
+                return
+
+            tee_path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = tee_path.with_suffix(tee_path.suffix + ".part")
+            discard_partial(temp_path)
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+            validator = RemoteInfo(size=None, accepts_ranges=False, etag=etag, last_modified=last_modified).validator
+            if validator:
+                validator_path_for(temp_path).write_text(validator, encoding="utf-8")
+            with open(temp_path, "wb") as tee:
+                with ResponseStream(response, tee) as stream:
+                    yield stream
+                    stream.drain()
+                    complete = stream.complete
 
-        temp_path.replace(output_path)
+    if not complete:
+        return
+    try:
+        sha256 = verify_archive(temp_path)
+    except ArchiveVerificationError:
+        discard_partial(temp_path)
+        raise
+    temp_path.replace(tee_path)
+    validator_path_for(temp_path).unlink(missing_ok=True)
+    save_meta(meta_path_for(tee_path), verified_meta(tee_path, url, etag, last_modified, sha256))
+
+
+def validator_path_for(temp_path: Path) -> Path:
+    return temp_path.with_suffix(temp_path.suffix + ".validator")
+
+
+def discard_partial(temp_path: Path) -> None:
+    for path in (temp_path, segments_path_for(temp_path), validator_path_for(temp_path)):
+        path.unlink(missing_ok=True)
+
+
+def download(
+    url: str,
+    output_path: Path,
+    force: bool = False,
+    connections: int = 1,
+    show_progress: bool = True
+) -> bool:
+    """Download ``url`` to ``output_path``; return False when it was already up to date.
+
+    The archive's ETag, Last-Modified, SHA-256, size and mtime are kept in a
+    sidecar ``.meta.json``. Later runs send a conditional request, so an
+    unchanged archive costs a single 304 and a ``stat``; the local archive is
+    only hashed again when its size or mtime no longer match the sidecar (or
+    there is none) and the server answers 200. Every download is decompressed
+    end to end before it atomically replaces the previous archive.
+
+    Raises ``requests.RequestException`` on network failure and leaves the
+    ``.part`` file (and its resume state) in place so the next run resumes.
+    Raises ``ArchiveVerificationError`` if the downloaded bytes are corrupt.
+    """
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    meta_path = meta_path_for(output_path)
+    temp_path = output_path.with_suffix(output_path.suffix + ".part")
+
+    recorded = load_meta(meta_path) if output_path.exists() and not force else None
+    meta = recorded
+    if meta is not None:
+        stat = output_path.stat()
+        if meta.url != url or meta.size != stat.st_size or meta.mtime_ns != stat.st_mtime_ns:
+            # The local archive may have changed since it was verified; it is
+            # re-verified below if the server's copy has the same size.
+            meta = None
+
+    with new_session() as session:
+        info = remote_info(session, url, meta)
+        if info.not_modified or (meta is not None and unchanged_since(meta, info)):
+            return False
+
+        if output_path.exists() and not force and meta is None and info.size == output_path.stat().st_size:
+            # Archive from before the sidecar existed, or touched since it was
+            # verified: adopt it if it verifies and still holds the bytes the
+            # sidecar recorded for this release.
+            try:
+                sha256 = verify_archive(output_path)
+            except ArchiveVerificationError:
+                pass
+            else:
+                if recorded is None or (recorded.url == url and recorded.sha256 == sha256 and unchanged_since(recorded, info)):
+                    save_meta(meta_path, verified_meta(output_path, url, info.etag, info.last_modified, sha256))
+                    return False
+
+        # A partial file is only resumed against the release it was started from.
+        validator_path = validator_path_for(temp_path)
+        started_from = validator_path.read_text(encoding="utf-8") if validator_path.exists() else None
+        if force or (started_from is not None and started_from != info.validator):
+            discard_partial(temp_path)
+        if info.validator:
+            validator_path.write_text(info.validator, encoding="utf-8")
+
+        if connections > 1 and info.accepts_ranges and info.size:
+            download_ranges(url, temp_path, info.size, connections, show_progress, info.validator)
+        else:
+            segments_path_for(temp_path).unlink(missing_ok=True)
+            download_resumable(session, url, temp_path, info.size, show_progress, info.validator)
+
+        size = temp_path.stat().st_size
+        if info.size is not None and size != info.size:
+            raise requests.ConnectionError(f"Downloaded {size} bytes, expected {info.size}")
+
+    try:
+        sha256 = verify_archive(temp_path)
+    except ArchiveVerificationError:
+        # Resuming corrupt bytes cannot help; the next run starts clean.
+        discard_partial(temp_path)
+        raise
+
+    temp_path.replace(output_path)
+    validator_path.unlink(missing_ok=True)
+    save_meta(meta_path, verified_meta(output_path, url, info.etag, info.last_modified, sha256))
+    return True
+
+
+def main() -> None:
+    args = parse_args()
+    output_path = Path(args.output).expanduser().resolve()
+
+    try:
+        downloaded = download(args.url, output_path, force=args.force, connections=args.connections)
+    except requests.RequestException as error:
+        print(f"Download failed: {error}", file=sys.stderr)
+        print("The partial download was kept; rerun the same command to resume.", file=sys.stderr)
+        sys.exit(1)
+    except ArchiveVerificationError as error:
+        print(f"Downloaded archive failed verification: {error}", file=sys.stderr)
+        print("The existing archive was left untouched; rerun to download again.", file=sys.stderr)
+        sys.exit(1)
 
+    if not downloaded:
+        print(f"Skipping download; already up to date: {output_path}")
+        return
     print(f"Downloaded {output_path}")
 
 
@@ -0,0 +1,295 @@
+"""Fixtures shared by the script tests and benchmarks: builder settings, synthetic data, reference implementations and an archive server."""
+
+from __future__ import annotations
+
+import math
+import random
+import re
+import threading
+from collections import Counter, defaultdict
+from dataclasses import replace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import chess
+
+import build_lichess_puzzles
+from build_lichess_puzzles import MOTIF_PRIORITY, BuilderConfig, PuzzleSeed, ReplayedLine, interned, row_fields
+from lichess_reader import CsvPuzzleReader
+
+LAST_MODIFIED = "Tue, 01 Sep 2026 00:00:00 GMT"
+
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    """Serves ``server.payload`` with validators, optional Range support and a one-shot mid-body disconnect."""
+
+    server: "ArchiveServer"
+
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+    def _not_modified(self) -> bool:
+        etag = self.headers.get("If-None-Match")
+        if etag is not None:
+            return etag == self.server.etag
+        return self.headers.get("If-Modified-Since") == LAST_MODIFIED
+
+    def _range(self) -> Optional[tuple[int, int]]:
+        header = self.headers.get("Range")
+        if not header or not self.server.support_ranges:
+            return None
+        if_range = self.headers.get("If-Range")
+        if if_range is not None and if_range not in (self.server.etag, LAST_MODIFIED):
+            return None
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", header)
+        assert match, header
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else len(self.server.payload) - 1
+        return start, min(end, len(self.server.payload) - 1)
+
+    def _send_headers(self) -> tuple[int, int]:
+        payload = self.server.payload
+        if self._not_modified():
+            self.send_response(304)
+            self.end_headers()
+            return 0, -1
+        byte_range = self._range()
+        if byte_range is not None and byte_range[0] >= len(payload):
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{len(payload)}")
+            self.end_headers()
+            return 0, -1
+        if byte_range is not None:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(payload)}")
+        else:
+            start, end = 0, len(payload) - 1
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start + 1))
+        if self.server.support_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", self.server.etag)
+        self.send_header("Last-Modified", LAST_MODIFIED)
+        self.end_headers()
+        return start, end
+
+    def do_HEAD(self) -> None:
+        self.server.methods.append("HEAD")
+        self._send_headers()
+
+    def do_GET(self) -> None:
+        self.server.methods.append("GET")
+        self.server.range_headers.append(self.headers.get("Range"))
+        start, end = self._send_headers()
+        body = self.server.payload[start:end + 1]
+        with self.server.lock:
+            cut = self.server.fail_after
+            self.server.fail_after = None
+        if cut is not None:
+            self.wfile.write(body[:cut])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+class ArchiveServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, payload: bytes, support_ranges: bool = True) -> None:
+        super().__init__(("127.0.0.1", 0), ArchiveHandler)
+        self.payload = payload
+        self.etag = '"v1"'
+        self.support_ranges = support_ranges
+        self.fail_after: Optional[int] = None
+        self.methods: List[str] = []
+        self.range_headers: List[Optional[str]] = []
+        self.lock = threading.Lock()
+
+
+def default_config() -> BuilderConfig:
+    # Filters as configured by a default `npm run puzzles:build`.
+    return BuilderConfig(
+        input_path=Path("."),
+        output_dir=Path("."),
+        min_piece_count=3,
+        max_piece_count=8,
+        min_rating=800,
+        max_rating=2200,
+        bucket_size=200,
+        max_plies=4,
+        target_per_combo=80,
+        candidate_multiplier=6,
+        min_popularity=65,
+        min_nb_plays=250,
+        backrank_max_share=0.2,
+        max_single_motif_share=0.45,
+        max_rows=None,
+        seed=None
+    )
+
+
+def choose_balanced_reference(
+    seeds_by_motif: Dict[str, List[PuzzleSeed]],
+    target: int,
+    backrank_max_share: float,
+    max_single_motif_share: float,
+    rng: random.Random
+) -> List[PuzzleSeed]:
+    """The selector before the deque rewrite, kept verbatim as the reference."""
+    motif_buckets: Dict[str, List[PuzzleSeed]] = {}
+    for motif, seeds in seeds_by_motif.items():
+        copy = list(seeds)
+        copy.sort(key=lambda seed: (seed.simplicity_score, rng.random()), reverse=True)
+        motif_buckets[motif] = copy
+
+    selected: List[PuzzleSeed] = []
+    backrank_limit = max(1, math.floor(target * backrank_max_share)) if target > 0 else 0
+    motif_limit = max(1, math.floor(target * max_single_motif_share)) if target > 0 else 0
+    motif_counts: Dict[str, int] = defaultdict(int)
+
+    while len(selected) < target:
+        progressed = False
+        for motif in MOTIF_PRIORITY:
+            bucket = motif_buckets.get(motif)
+            if not bucket:
+                continue
+            current = motif_counts[motif]
+            if motif == "backrank":
+                if current >= backrank_limit:
+                    continue
+            elif current >= motif_limit:
+                continue
+            selected.append(bucket.pop(0))
+            motif_counts[motif] += 1
+            progressed = True
+            if len(selected) >= target:
+                break
+        if not progressed:
+            break
+
+    if len(selected) < target:
+        leftovers: List[PuzzleSeed] = []
+        for bucket in motif_buckets.values():
+            leftovers.extend(bucket)
+        leftovers.sort(key=lambda seed: (seed.simplicity_score, rng.random()), reverse=True)
+        for seed in leftovers:
+            if len(selected) >= target:
+                break
+            current = motif_counts[seed.motif]
+            if seed.motif == "backrank":
+                if current >= backrank_limit:
+                    continue
+            elif current >= motif_limit:
+                continue
+            selected.append(seed)
+            motif_counts[seed.motif] += 1
+
+    if len(selected) < target:
+        leftovers = []
+        for bucket in motif_buckets.values():
+            leftovers.extend(bucket)
+        leftovers.sort(key=lambda seed: (seed.simplicity_score, rng.random()), reverse=True)
+        for seed in leftovers:
+            if len(selected) >= target:
+                break
+            selected.append(seed)
+
+    return selected
+
+
+def synthetic_pool(size: int, rng: random.Random, motif_weights: Dict[str, float]) -> Dict[str, List[PuzzleSeed]]:
+    """Candidates grouped by motif in acceptance order, as build_dataset passes them."""
+    motifs = list(motif_weights)
+    weights = list(motif_weights.values())
+    pool: Dict[str, List[PuzzleSeed]] = defaultdict(list)
+    for index in range(size):
+        motif = rng.choices(motifs, weights)[0]
+        pool[motif].append(PuzzleSeed(
+            puzzle_id=f"s{index:07d}",
+            fen="",
+            piece_count=5,
+            rating_bucket=1200,
+            continuation_san=(),
+            themes=(),
+            motif=motif,
+            # Coarse scores, like the real ones, so the random tie-break matters.
+            simplicity_score=round(rng.uniform(0.5, 5.0), 1),
+            rating=1200,
+            popularity=90,
+            nb_plays=1000,
+            first_move_forcing=False
+        ))
+    return pool
+
+
+def replay_line_reference(
+    fen: str,
+    moves_uci: Sequence[str],
+    config: BuilderConfig,
+    rejections: Optional[Counter[str]] = None
+) -> Optional[ReplayedLine]:
+    """The replay before play_line, kept verbatim (minus timing) as the reference."""
+    def reject(stage: str) -> None:
+        if rejections is not None:
+            rejections[stage] += 1
+
+    try:
+        board = chess.Board(fen)
+    except ValueError:
+        return reject("board")
+
+    working = board.copy(stack=False)
+    try:
+        setup_move = chess.Move.from_uci(moves_uci[0])
+    except ValueError:
+        return reject("board")
+    if setup_move not in working.legal_moves:
+        return reject("board")
+    working.push(setup_move)
+
+    piece_count = chess.popcount(working.occupied)
+    if piece_count < config.min_piece_count or piece_count > config.max_piece_count:
+        return reject("piece_count")
+    puzzle_fen = working.fen()
+
+    continuation_uci = moves_uci[1:]
+    if len(continuation_uci) == 0 or len(continuation_uci) > config.max_plies:
+        return reject("line")
+
+    san_line: List[str] = []
+    first_move_forcing = False
+    for index, uci in enumerate(continuation_uci):
+        try:
+            move = chess.Move.from_uci(uci)
+        except ValueError:
+            return reject("line")
+        if move not in working.legal_moves:
+            return reject("line")
+        if index == 0:
+            first_move_forcing = working.is_capture(move) or working.gives_check(move)
+        san_line.append(working.san(move))
+        working.push(move)
+
+    if not san_line or len(san_line) > config.max_plies:
+        return reject("line")
+
+    return ReplayedLine(
+        fen=puzzle_fen,
+        piece_count=piece_count,
+        continuation_san=interned(san_line),
+        first_move_forcing=first_move_forcing
+    )
+
+
+def lines_to_replay(archive: Path, config: BuilderConfig) -> List[tuple[str, List[str]]]:
+    """(FEN, UCI moves) of every row that passes the string-level checks."""
+    lines: List[tuple[str, List[str]]] = []
+    with build_lichess_puzzles.open_puzzle_stream(replace(config, input_path=archive)) as stream:
+        for row in CsvPuzzleReader(stream):
+            fields = row_fields(row, config)
+            if fields is not None:
+                lines.append((fields[1], fields[3]))
+    return lines
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""Row readers for the decompressed lichess_db_puzzle CSV stream."""
+
+from __future__ import annotations
+
+import csv
+import io
+import json
+import mmap
+import operator
+import os
+import time
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, Dict, FrozenSet, Iterator, List, Optional, Sequence, Tuple
+
+NEEDED_COLUMNS = ("PuzzleId", "FEN", "Moves", "Rating", "Popularity", "NbPlays", "Themes")
+READ_SIZE = 16 * 1024 * 1024
+LINE_INDEX_VERSION = 1
+ROWS_PER_OFFSET = 4096
+
+_NON_PIECE_BYTES = b"12345678/"
+
+
+@dataclass(frozen=True)
+class RowFilter:
+    """Cheap row filters evaluated on raw bytes, before any decoding.
+
+    Each filter mirrors a stage in ``parse_puzzle_seed`` and counts its
+    rejections under the same stage name.
+    """
+
+    min_rating: int
+    max_rating: int
+    bucket_size: int
+    min_popularity: int
+    min_nb_plays: int
+    min_piece_count: int
+    max_piece_count: int
+    excluded_themes: FrozenSet[bytes]
+    advanced_themes: FrozenSet[bytes]
+    tactical_themes: FrozenSet[bytes]
+    simple_themes: FrozenSet[bytes]
+
+    def reject_stage(self, values: Sequence[bytes]) -> Optional[str]:
+        """Return the rejecting stage for ``values`` (in ``NEEDED_COLUMNS`` order)."""
+        return self.reject_fields(values) or self.reject_themes(values[6])
+
+    def reject_fields(self, values: Sequence[bytes]) -> Optional[str]:
+        """Every check of ``reject_stage`` except the theme filter."""
+        puzzle_id, fen, moves, rating, popularity, nb_plays, _ = values
+        if not puzzle_id or not fen or len(moves.split()) < 2:
+            return "fields"
+        try:
+            rating_value = int(rating)
+        except ValueError:
+            return "fields"
+
+        # The FEN piece count is the cheapest and by far the most selective
+        # check on real data, so it runs before the numeric and theme filters.
+        pieces_before_setup = len(fen.split(b" ", 1)[0].translate(None, _NON_PIECE_BYTES))
+        if pieces_before_setup - 1 > self.max_piece_count or pieces_before_setup < self.min_piece_count:
+            return "fen_prefilter"
+
+        rating_bucket = (rating_value // self.bucket_size) * self.bucket_size
+        if rating_bucket < self.min_rating or rating_bucket > self.max_rating:
+            return "rating"
+        if _int_or_zero(popularity) < self.min_popularity or _int_or_zero(nb_plays) < self.min_nb_plays:
+            return "popularity"
+        return None
+
+    def reject_themes(self, themes: bytes) -> Optional[str]:
+        theme_set = set(themes.split())
+        if (
+            not theme_set.isdisjoint(self.excluded_themes)
+            or not theme_set.isdisjoint(self.advanced_themes)
+            or theme_set.isdisjoint(self.tactical_themes)
+            or theme_set.isdisjoint(self.simple_themes)
+        ):
+            return "themes"
+        return None
+
+
+def _int_or_zero(raw: bytes) -> int:
+    try:
+        return int(raw) if raw else 0
+    except ValueError:
+        return 0
+
+
+class ColumnarPuzzleReader:
+    """Split decompressed blocks on bytes and decode only the needed columns.
+
+    Rows rejected by ``row_filter`` are counted in ``rejections`` and never
+    decoded; survivors are yielded as small dicts keyed by ``NEEDED_COLUMNS``.
+    When ``timings`` is given, seconds spent in the theme filter are added to
+    its ``"themes"`` entry.
+    """
+
+    def __init__(
+        self,
+        stream: BinaryIO,
+        row_filter: Optional[RowFilter] = None,
+        rejections: Optional[Counter[str]] = None,
+        max_rows: Optional[int] = None,
+        read_size: int = READ_SIZE,
+        timings: Optional[Counter[str]] = None
+    ) -> None:
+        self.stream = stream
+        self.row_filter = row_filter
+        self.rejections = rejections if rejections is not None else Counter()
+        self.max_rows = max_rows
+        self.read_size = read_size
+        self.timings = timings
+        self.rows_scanned = 0
+
+    def _timed_reject_stage(self, values: Sequence[bytes]) -> Optional[str]:
+        assert self.row_filter is not None and self.timings is not None
+        stage = self.row_filter.reject_fields(values)
+        if stage is not None:
+            return stage
+        started = time.perf_counter()
+        stage = self.row_filter.reject_themes(values[6])
+        self.timings["themes"] += time.perf_counter() - started
+        return stage
+
+    def _lines(self) -> Iterator[bytes]:
+        remainder = b""
+        while True:
+            block = self.stream.read(self.read_size)
+            if not block:
+                break
+            lines = (remainder + block).split(b"\n")
+            remainder = lines.pop()
+            yield from lines
+        if remainder:
+            yield remainder
+
+    def __iter__(self) -> Iterator[Dict[str, str]]:
+        lines = self._lines()
+        header_line = next(lines, b"")
+        strip_cr = header_line.endswith(b"\r")
+        header = header_line.rstrip(b"\r").decode("utf-8").split(",")
+        try:
+            indexes = [header.index(column) for column in NEEDED_COLUMNS]
+        except ValueError as error:
+            raise ValueError(f"Puzzle CSV header is missing a required column: {error}") from error
+        width = max(indexes) + 1
+        pick = operator.itemgetter(*indexes)
+        reject_stage = self.row_filter.reject_stage if self.row_filter is not None else None
+        if reject_stage is not None and self.timings is not None:
+            reject_stage = self._timed_reject_stage
+        rejections = self.rejections
+        remaining = self.max_rows if self.max_rows is not None else -1
+        scanned = self.rows_scanned
+
+        try:
+            for line in lines:
+                if strip_cr:
+                    line = line.rstrip(b"\r")
+                if not line:
+                    continue
+                if remaining == 0:
+                    return
+                remaining -= 1
+                scanned += 1
+
+                fields: List[bytes]
+                if b'"' in line:
+                    # Quoted fields never appear in the Lichess export today;
+                    # keep the csv module as a correct fallback if they ever do.
+                    fields = [field.encode("utf-8") for field in next(csv.reader([line.decode("utf-8")]))]
+                else:
+                    fields = line.split(b",", width)
+                if len(fields) < width:
+                    rejections["fields"] += 1
+                    continue
+
+                values = pick(fields)
+                if reject_stage is not None:
+                    stage = reject_stage(values)
+                    if stage is not None:
+                        rejections[stage] += 1
+                        continue
+
+                self.rows_scanned = scanned
+                yield dict(zip(NEEDED_COLUMNS, [value.decode("utf-8") for value in values]))
+        finally:
+            self.rows_scanned = scanned
+
+
+class CsvPuzzleReader:
+    """Reference reader built on ``csv.DictReader``; applies no filters."""
+
+    def __init__(self, stream: BinaryIO, max_rows: Optional[int] = None) -> None:
+        self.stream = stream
+        self.max_rows = max_rows
+        self.rows_scanned = 0
+
+    def __iter__(self) -> Iterator[Dict[str, str]]:
+        text_stream = io.TextIOWrapper(self.stream, encoding="utf-8")
+        for row in csv.DictReader(text_stream):
+            if self.max_rows is not None and self.rows_scanned >= self.max_rows:
+                return
+            self.rows_scanned += 1
+            yield row
+
+
+@dataclass(frozen=True)
+class LineIndex:
+    """Byte offsets into a decompressed puzzle CSV, one per ``stride`` rows.
+
+    Rows are counted the way ``ColumnarPuzzleReader`` counts them: non-empty
+    lines after the header. ``offsets[k]`` is where row ``k * stride`` starts
+    and the last offset is the file size, so any range of whole strides maps
+    to one byte range that a reader can start on without reading the prefix.
+    """
+
+    csv_path: Path
+    header: bytes
+    rows: int
+    stride: int
+    offsets: Tuple[int, ...]
+    # Identifies the archive the CSV was decompressed from.
+    source: Dict[str, object]
+
+    def byte_range(self, start_row: int, stop_row: int) -> Tuple[int, int]:
+        """Bytes holding rows ``start_row`` up to ``stop_row``, rounded out to whole strides."""
+        return self.offsets[start_row // self.stride], self.offsets[-(-stop_row // self.stride)]
+
+    def row_ranges(self, max_rows: Optional[int] = None) -> List[Tuple[int, int]]:
+        """Consecutive (start, stop) row ranges of one stride each, up to ``max_rows``."""
+        rows = self.rows if max_rows is None else min(self.rows, max_rows)
+        return [(start, min(start + self.stride, rows)) for start in range(0, rows, self.stride)]
+
+    def range_stream(self, mapped: mmap.mmap, start_row: int, stop_row: int) -> BinaryIO:
+        """The header plus rows ``start_row`` onwards, as a stream for a row reader.
+
+        ``stop_row`` must end a stride or the file; cap the reader with
+        ``max_rows=stop_row - start_row`` to stop inside the last stride.
+        """
+        start, stop = self.byte_range(start_row, stop_row)
+        return io.BytesIO(self.header + mapped[start:stop])
+
+
+def write_line_index(
+    stream: BinaryIO,
+    csv_path: Path,
+    index_path: Path,
+    source: Dict[str, object],
+    stride: int = ROWS_PER_OFFSET,
+    read_size: int = READ_SIZE
+) -> LineIndex:
+    """Decompress ``stream`` into ``csv_path`` once and write its row offsets to ``index_path``."""
+    csv_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = csv_path.with_name(csv_path.name + ".part")
+    header: Optional[bytes] = None
+    offsets: List[int] = []
+    rows = 0
+    position = 0
+    remainder = b""
+    with open(temp_path, "wb") as output:
+        while True:
+            block = stream.read(read_size)
+            if block:
+                output.write(block)
+            lines = (remainder + block).split(b"\n")
+            # Without more input the last piece is a final line with no newline.
+            remainder = lines.pop() if block else b""
+            for line in lines:
+                if header is None:
+                    header = line + b"\n"
+                elif line.rstrip(b"\r"):
+                    if rows % stride == 0:
+                        offsets.append(position)
+                    rows += 1
+                position += len(line) + 1
+            if not block:
+                break
+        output.flush()
+        os.fsync(output.fileno())
+    # The loop counted a newline after the final line even when there is none.
+    size = temp_path.stat().st_size
+    offsets.append(size)
+    os.replace(temp_path, csv_path)
+
+    index = LineIndex(
+        csv_path=csv_path,
+        header=header or b"",
+        rows=rows,
+        stride=stride,
+        offsets=tuple(offsets),
+        source=source
+    )
+    index_path.write_text(json.dumps({
+        "version": LINE_INDEX_VERSION,
+        "source": source,
+        "csvBytes": size,
+        "header": index.header.decode("utf-8"),
+        "rows": rows,
+        "stride": stride,
+        "offsets": offsets
+    }), encoding="utf-8")
+    return index
+
+
+def read_line_index(csv_path: Path, index_path: Path) -> Optional[LineIndex]:
+    """The index of ``csv_path``, or None when it is missing, unreadable or does not match the file."""
+    try:
+        payload = json.loads(index_path.read_text(encoding="utf-8"))
+        size = csv_path.stat().st_size
+    except (OSError, ValueError):
+        return None
+    if not isinstance(payload, dict) or payload.get("version") != LINE_INDEX_VERSION or payload.get("csvBytes") != size:
+        return None
+    return LineIndex(
+        csv_path=csv_path,
+        header=payload["header"].encode("utf-8"),
+        rows=payload["rows"],
+        stride=payload["stride"],
+        offsets=tuple(payload["offsets"]),
+        source=payload["source"]
+    )
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""Query, export and re-shard the candidates stored by build_lichess_puzzles.py --candidate-db."""
+
+from __future__ import annotations
+
+import argparse
+import json
+import sqlite3
+import sys
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import build_lichess_puzzles
+from build_lichess_puzzles import CANDIDATE_DB_VERSION, SHARD_FORMATS, BuilderConfig, PuzzleSeed, interned
+
+GROUP_COLUMNS = {
+    "piece": "c.piece_count",
+    "bucket": "c.rating_bucket",
+    "motif": "c.motif",
+    "theme": "t.theme"
+}
+
+CANDIDATE_COLUMNS = (
+    "puzzle_id, fen, piece_count, rating_bucket, rating, popularity, nb_plays, motif, "
+    "simplicity_score, first_move_forcing, continuation_san, themes, line_fingerprint"
+)
+
+
+@dataclass(frozen=True)
+class CandidateFilter:
+    """Subset of the store; empty sequences match everything, themes must all be present."""
+
+    piece_counts: Sequence[int] = ()
+    rating_buckets: Sequence[int] = ()
+    motifs: Sequence[str] = ()
+    themes: Sequence[str] = ()
+
+    def where(self) -> Tuple[str, List[object]]:
+        clauses: List[str] = []
+        params: List[object] = []
+        for column, values in (
+            ("c.piece_count", self.piece_counts),
+            ("c.rating_bucket", self.rating_buckets),
+            ("c.motif", self.motifs)
+        ):
+            if values:
+                clauses.append(f"{column} IN ({', '.join('?' * len(values))})")
+                params.extend(values)
+        for theme in self.themes:
+            clauses.append("EXISTS (SELECT 1 FROM candidate_themes ct WHERE ct.theme = ? AND ct.puzzle_id = c.puzzle_id)")
+            params.append(theme)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+
+def open_store(path: Path) -> sqlite3.Connection:
+    if not path.exists():
+        raise SystemExit(f"Candidate database not found: {path}")
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    version = read_meta(connection).get("version")
+    if version != str(CANDIDATE_DB_VERSION):
+        connection.close()
+        raise SystemExit(f"Unsupported candidate database version {version} in {path}; rebuild it with --candidate-db")
+    return connection
+
+
+def read_meta(connection: sqlite3.Connection) -> Dict[str, str]:
+    return dict(connection.execute("SELECT key, value FROM meta"))
+
+
+def stored_config(connection: sqlite3.Connection) -> BuilderConfig:
+    """The builder config the store was written with."""
+    return build_lichess_puzzles.config_from_json(read_meta(connection)["config"])
+
+
+def load_candidates(connection: sqlite3.Connection, candidate_filter: CandidateFilter) -> List[PuzzleSeed]:
+    """Matching candidates in the order the build accepted them."""
+    where, params = candidate_filter.where()
+    rows = connection.execute(f"SELECT {CANDIDATE_COLUMNS} FROM candidates c{where} ORDER BY c.accepted_order", params)
+    candidates: List[PuzzleSeed] = []
+    for (puzzle_id, fen, piece_count, rating_bucket, rating, popularity, nb_plays, motif,
+         simplicity_score, forcing, san, themes, fingerprint) in rows:
+        candidates.append(PuzzleSeed(
+            puzzle_id=puzzle_id,
+            fen=fen,
+            piece_count=piece_count,
+            rating_bucket=rating_bucket,
+            continuation_san=interned(san.split(" ")),
+            themes=interned(build_lichess_puzzles.parse_themes(themes)),
+            motif=motif,
+            simplicity_score=simplicity_score,
+            rating=rating,
+            popularity=popularity,
+            nb_plays=nb_plays,
+            first_move_forcing=bool(forcing),
+            line_fingerprint=fingerprint
+        ))
+    return candidates
+
+
+def count_candidates(
+    connection: sqlite3.Connection,
+    candidate_filter: CandidateFilter,
+    group_by: Sequence[str]
+) -> List[Tuple[object, ...]]:
+    """Candidate counts per group, as rows of (*group values, count)."""
+    where, params = candidate_filter.where()
+    columns = [GROUP_COLUMNS[name] for name in group_by]
+    source = "candidates c JOIN candidate_themes t ON t.puzzle_id = c.puzzle_id" if "theme" in group_by else "candidates c"
+    select = ", ".join([*columns, "COUNT(*)"])
+    group = f" GROUP BY {', '.join(columns)} ORDER BY {', '.join(columns)}" if columns else ""
+    return list(connection.execute(f"SELECT {select} FROM {source}{where}{group}", params))
+
+
+def capped_combos(connection: sqlite3.Connection) -> Tuple[int, int]:
+    """The per-combo candidate cap the store was built with and how many combos reached it."""
+    cap = int(read_meta(connection)["comboCap"])
+    (full,) = connection.execute(
+        "SELECT COUNT(*) FROM (SELECT 1 FROM candidates GROUP BY piece_count, rating_bucket HAVING COUNT(*) >= ?)",
+        (cap,)
+    ).fetchone()
+    return cap, full
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Query the candidate database written by build_lichess_puzzles.py --candidate-db")
+    parser.add_argument("--db", default=".cache/puzzles/candidates.sqlite", help="Candidate database path")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def add_filters(command: argparse.ArgumentParser) -> None:
+        command.add_argument("--piece-count", type=int, action="append", default=[], help="Keep this piece count (repeatable)")
+        command.add_argument("--rating-bucket", type=int, action="append", default=[], help="Keep this rating bucket (repeatable)")
+        command.add_argument("--motif", action="append", default=[], help="Keep this motif (repeatable)")
+        command.add_argument("--theme", action="append", default=[], help="Require this Lichess theme (repeatable, all must match)")
+
+    count = commands.add_parser("count", help="Print stored candidate counts (capped per combo)")
+    add_filters(count)
+    count.add_argument(
+        "--group-by",
+        default="piece,bucket",
+        help=f"Comma-separated grouping columns from: {', '.join(GROUP_COLUMNS)} (empty for a total)"
+    )
+
+    export = commands.add_parser("export", help="Export matching candidates as a JSON array of shard entries")
+    add_filters(export)
+    export.add_argument("--limit", type=int, default=None, help="Export at most this many candidates")
+    export.add_argument("--output", default=None, help="Output file (default: stdout)")
+
+    shards = commands.add_parser("shards", help="Select and write puzzle shards from the stored candidates")
+    add_filters(shards)
+    shards.add_argument("--output", default="public/puzzles", help="Output directory for static puzzle assets")
+    shards.add_argument("--target-per-combo", type=int, default=None, help="Desired puzzles per combo (default: as built)")
+    shards.add_argument("--backrank-max-share", type=float, default=None, help="Max back-rank motif share per combo")
+    shards.add_argument("--max-single-motif-share", type=float, default=None, help="Max share for any non-backrank motif")
+    shards.add_argument("--seed", type=int, default=None, help="Random seed (default: as built)")
+    shards.add_argument("--shard-format", choices=SHARD_FORMATS, default=None, help="Shard encoding (default: as built)")
+    shards.add_argument("--page-size", type=int, default=None, help="Puzzles per shard page (0 = one shard per combo)")
+    shards.add_argument(
+        "--hash-shards",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help="Content-hashed shard filenames (default: as built)"
+    )
+    shards.add_argument(
+        "--precompress",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help="Also write .gz, .br and .zst siblings (default: as built)"
+    )
+
+    args = parser.parse_args(argv)
+    if args.command == "count":
+        args.group_by = [name for name in args.group_by.split(",") if name]
+        unknown = sorted(set(args.group_by).difference(GROUP_COLUMNS))
+        if unknown:
+            parser.error(f"Unknown --group-by columns: {', '.join(unknown)}")
+    return args
+
+
+def filter_from_args(args: argparse.Namespace) -> CandidateFilter:
+    return CandidateFilter(
+        piece_counts=args.piece_count,
+        rating_buckets=args.rating_bucket,
+        motifs=args.motif,
+        themes=args.theme
+    )
+
+
+def shard_config(connection: sqlite3.Connection, args: argparse.Namespace) -> BuilderConfig:
+    """The stored build config with the output and selection overrides from ``args``."""
+    config = stored_config(connection)
+    overrides: Dict[str, object] = {
+        "output_dir": Path(args.output).expanduser(),
+        "incremental": False
+    }
+    for key in (
+        "target_per_combo",
+        "backrank_max_share",
+        "max_single_motif_share",
+        "seed",
+        "shard_format",
+        "page_size",
+        "hash_shards",
+        "precompress"
+    ):
+        value = getattr(args, key)
+        if value is not None:
+            overrides[key] = value
+    return replace(config, **overrides)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    args = parse_args(argv)
+    connection = open_store(Path(args.db).expanduser())
+    try:
+        candidate_filter = filter_from_args(args)
+        if args.command == "count":
+            cap, full = capped_combos(connection)
+            print(
+                f"Counts cover the stored candidates only: at most {cap} per piece count and rating bucket. "
+                f"{full} combos reached that cap, so their counts undercount the archive.",
+                file=sys.stderr
+            )
+            for row in count_candidates(connection, candidate_filter, args.group_by):
+                print("\t".join(str(value) for value in row))
+        elif args.command == "export":
+            candidates = load_candidates(connection, candidate_filter)
+            if args.limit is not None:
+                candidates = candidates[:args.limit]
+            data = json.dumps([build_lichess_puzzles.as_output(seed) for seed in candidates], ensure_ascii=False)
+            if args.output is None:
+                print(data)
+            else:
+                Path(args.output).expanduser().write_text(data, encoding="utf-8")
+                print(f"Exported {len(candidates)} candidates to {args.output}", file=sys.stderr)
+        else:
+            config = shard_config(connection, args)
+            if config.precompress and build_lichess_puzzles.brotli is None:
+                raise SystemExit("--precompress needs brotli for the .br siblings: python -m pip install brotli, or pass --no-precompress")
+            candidates = load_candidates(connection, candidate_filter)
+            if not candidates:
+                raise SystemExit("No stored candidates match the filters")
+            build_lichess_puzzles.write_outputs(config, build_lichess_puzzles.select_by_combo(config, candidates))
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
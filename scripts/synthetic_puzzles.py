@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""Generate synthetic lichess_db_puzzle.csv.zst archives for benchmarks and tests."""
+
+from __future__ import annotations
+
+import argparse
+import io
+import random
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import chess
+import zstandard
+
+HEADER = "PuzzleId,FEN,Moves,Rating,RatingDeviation,Popularity,NbPlays,Themes,GameUrl,OpeningTags"
+ID_ALPHABET = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+MALFORMED_KINDS = ("fields", "rating", "fen", "moves")
+
+# Piece counts (incl. kings, before the setup move) weighted so that, as in
+# the real export, most rows are middlegame positions the builder rejects.
+DEFAULT_PIECE_COUNTS: Dict[int, float] = {
+    3: 1.0, 4: 2.0, 5: 3.0, 6: 3.0, 7: 3.0, 8: 3.0, 9: 3.0,
+    12: 8.0, 16: 12.0, 20: 18.0, 26: 23.0, 32: 21.0
+}
+
+# Theme names with the weight they are drawn with; rows get 1-4 of them.
+DEFAULT_THEMES: Dict[str, float] = {
+    "endgame": 8.0, "short": 8.0, "crushing": 6.0, "advantage": 5.0, "middlegame": 4.0,
+    "mate": 5.0, "mateIn1": 3.0, "mateIn2": 3.0, "oneMove": 2.0, "backRankMate": 1.5,
+    "fork": 3.0, "pin": 2.0, "skewer": 1.5, "hangingPiece": 2.0, "discoveredAttack": 1.0,
+    "deflection": 1.0, "attraction": 0.5, "sacrifice": 1.0, "kingsideAttack": 1.0,
+    "long": 3.0, "veryLong": 1.0, "master": 0.5, "quietMove": 1.0, "zugzwang": 0.5, "defensiveMove": 0.5
+}
+
+
+@dataclass(frozen=True)
+class PuzzleMix:
+    """What a synthetic archive contains, besides its row count and seed."""
+
+    piece_counts: Dict[int, float] = field(default_factory=lambda: dict(DEFAULT_PIECE_COUNTS))
+    themes: Dict[str, float] = field(default_factory=lambda: dict(DEFAULT_THEMES))
+    malformed_rate: float = 0.01
+    illegal_rate: float = 0.01
+    max_line_plies: int = 6
+    positions_per_piece_count: int = 300
+
+
+def random_board(rng: random.Random, piece_count: int) -> chess.Board:
+    pieces = (chess.QUEEN, chess.ROOK, chess.ROOK, chess.BISHOP, chess.KNIGHT, chess.PAWN, chess.PAWN, chess.PAWN)
+    while True:
+        board = chess.Board(None)
+        squares = rng.sample(chess.SQUARES, piece_count)
+        board.set_piece_at(squares[0], chess.Piece(chess.KING, chess.WHITE))
+        board.set_piece_at(squares[1], chess.Piece(chess.KING, chess.BLACK))
+        for square in squares[2:]:
+            piece_type = rng.choice(pieces)
+            if piece_type == chess.PAWN and chess.square_rank(square) in (0, 7):
+                piece_type = chess.KNIGHT
+            board.set_piece_at(square, chess.Piece(piece_type, rng.random() < 0.5))
+        board.turn = rng.random() < 0.5
+        board.fullmove_number = rng.randint(20, 80)
+        if board.is_valid() and any(board.legal_moves):
+            return board
+
+
+def random_line(rng: random.Random, board: chess.Board, max_plies: int) -> List[str]:
+    """A setup move plus 1..max_plies-1 legal replies, in UCI."""
+    board = board.copy(stack=False)
+    moves: List[str] = []
+    for _ in range(rng.randint(2, max(2, max_plies))):
+        legal = list(board.legal_moves)
+        if not legal:
+            break
+        move = rng.choice(legal)
+        moves.append(move.uci())
+        board.push(move)
+    return moves
+
+
+def illegal_move(rng: random.Random, board: chess.Board) -> str:
+    """A well-formed UCI move that is not legal in ``board``."""
+    while True:
+        move = chess.Move(rng.choice(chess.SQUARES), rng.choice(chess.SQUARES))
+        if move.from_square != move.to_square and not board.is_legal(move):
+            return move.uci()
+
+
+class SyntheticPuzzleWriter:
+    """Produces rows for one archive; the same (rows, seed, mix) always gives the same bytes."""
+
+    def __init__(self, seed: int, mix: PuzzleMix) -> None:
+        self.rng = random.Random(seed)
+        self.mix = mix
+        self.positions: Dict[int, List[tuple[str, List[str], chess.Board]]] = {}
+        self.piece_counts = list(mix.piece_counts)
+        self.piece_weights = list(mix.piece_counts.values())
+        self.theme_names = list(mix.themes)
+        self.theme_weights = list(mix.themes.values())
+
+    def position(self, piece_count: int) -> tuple[str, List[str], chess.Board]:
+        # A fixed pool per piece count keeps generation fast at millions of rows.
+        pool = self.positions.setdefault(piece_count, [])
+        if len(pool) < self.mix.positions_per_piece_count:
+            board = random_board(self.rng, piece_count)
+            line = random_line(self.rng, board, self.mix.max_line_plies)
+            pool.append((board.fen(), line, board))
+            return pool[-1]
+        return self.rng.choice(pool)
+
+    def themes(self) -> str:
+        picked = set(self.rng.choices(self.theme_names, self.theme_weights, k=self.rng.randint(1, 4)))
+        return " ".join(sorted(picked))
+
+    def row(self, index: int) -> str:
+        rng = self.rng
+        puzzle_id = "".join(rng.choice(ID_ALPHABET) for _ in range(5)) + format(index, "x")
+        piece_count = rng.choices(self.piece_counts, self.piece_weights)[0]
+        fen, line, board = self.position(piece_count)
+        moves = list(line)
+        rating = str(max(400, min(3200, int(rng.gauss(1500, 450)))))
+        popularity = str(rng.randint(-30, 100))
+        nb_plays = str(int(rng.lognormvariate(6.5, 1.5)))
+
+        roll = rng.random()
+        if roll < self.mix.malformed_rate:
+            kind = rng.choice(MALFORMED_KINDS)
+            if kind == "fields":
+                return f"{puzzle_id},{fen}"
+            if kind == "rating":
+                rating = "n/a"
+            elif kind == "fen":
+                # Few enough "pieces" to pass the prefilter, but unparseable.
+                fen = "k7/8/8/8/8/8/8/KQ5x w - - 0 1"
+            else:
+                moves = moves[:1]
+        elif roll < self.mix.malformed_rate + self.mix.illegal_rate:
+            after_setup = board.copy(stack=False)
+            after_setup.push_uci(moves[0])
+            moves = [moves[0], illegal_move(rng, after_setup)]
+
+        return (
+            f"{puzzle_id},{fen},{' '.join(moves)},{rating},75,{popularity},{nb_plays},{self.themes()},"
+            f"https://lichess.org/synthetic{index}#1,"
+        )
+
+
+def write_synthetic_archive(path: Path, rows: int, seed: int = 1, mix: Optional[PuzzleMix] = None, level: int = 3) -> Path:
+    """Write ``rows`` synthetic puzzles (plus the header) to a zstd-compressed CSV."""
+    writer = SyntheticPuzzleWriter(seed, mix or PuzzleMix())
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_suffix(path.suffix + ".part")
+    with open(temp_path, "wb") as handle:
+        with zstandard.ZstdCompressor(level=level).stream_writer(handle) as compressed:
+            text = io.TextIOWrapper(compressed, encoding="utf-8", newline="\n", write_through=False)
+            text.write(HEADER + "\n")
+            for index in range(rows):
+                text.write(writer.row(index) + "\n")
+            text.flush()
+            text.detach()
+    temp_path.replace(path)
+    return path
+
+
+def parse_weights(raw: str, key_type: Callable[[str], Any]) -> Dict[Any, float]:
+    # "3:1,4:2.5" -> {3: 1.0, 4: 2.5}
+    weights: Dict[Any, float] = {}
+    for item in raw.split(","):
+        key, _, weight = item.partition(":")
+        weights[key_type(key.strip())] = float(weight) if weight else 1.0
+    return weights
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Generate a synthetic lichess_db_puzzle.csv.zst")
+    parser.add_argument("--output", default="synthetic_puzzles.csv.zst", help="Target archive")
+    parser.add_argument("--rows", type=int, default=100000, help="Puzzle rows to generate")
+    parser.add_argument("--seed", type=int, default=1, help="Generator seed")
+    parser.add_argument("--piece-counts", default=None, help="Piece-count weights, e.g. 3:1,8:2,32:10")
+    parser.add_argument("--themes", default=None, help="Theme weights, e.g. fork:2,mate:1,long:1")
+    parser.add_argument("--malformed-rate", type=float, default=0.01, help="Share of malformed rows")
+    parser.add_argument("--illegal-rate", type=float, default=0.01, help="Share of rows with an illegal move")
+    return parser.parse_args(argv)
+
+
+def mix_from_args(args: argparse.Namespace) -> PuzzleMix:
+    mix = PuzzleMix(malformed_rate=args.malformed_rate, illegal_rate=args.illegal_rate)
+    if args.piece_counts:
+        mix = replace(mix, piece_counts=parse_weights(args.piece_counts, int))
+    if args.themes:
+        mix = replace(mix, themes=parse_weights(args.themes, str))
+    return mix
+
+
+def main() -> None:
+    args = parse_args()
+    path = write_synthetic_archive(Path(args.output).expanduser(), args.rows, args.seed, mix_from_args(args))
+    print(f"Wrote {args.rows} synthetic puzzles to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1134 @@
+"""Tests for build_lichess_puzzles.py on a handful of puzzle rows."""
+
+from __future__ import annotations
+
+import contextlib
+import csv
+import gzip
+import hashlib
+import io
+import json
+import mmap
+import random
+import re
+import sys
+import tempfile
+import threading
+import typing
+import unittest
+from collections import Counter, defaultdict
+from dataclasses import replace
+from pathlib import Path
+from typing import Dict, List, Optional
+from unittest import mock
+
+import chess
+import zstandard
+
+import build_lichess_puzzles
+from build_lichess_puzzles import BuilderConfig, PuzzleSeed, ReplayState
+from fixtures import ArchiveServer, choose_balanced_reference, default_config, lines_to_replay, replay_line_reference, synthetic_pool
+from lichess_reader import NEEDED_COLUMNS, CsvPuzzleReader, read_line_index, write_line_index
+from synthetic_puzzles import PuzzleMix, random_board, write_synthetic_archive
+
+PUZZLE_CSV = """PuzzleId,FEN,Moves,Rating,RatingDeviation,Popularity,NbPlays,Themes,GameUrl,OpeningTags
+JKP4G,8/8/4R3/2p5/4p3/6k1/8/4K3 b - - 0 77,g3g4 e1d2 g4g3,2231,75,84,22485,discoveredAttack,https://lichess.org/x5,
+OSc2m,8/P2k4/8/8/K5P1/8/8/1Rr1n1R1 w - - 0 80,a4b4 d7e7 b1b3 c1c8 g1g2,971,75,32,29750,advantage mate,https://lichess.org/x7,
+BKKF0,k7/1P4R1/8/1p6/3K4/8/8/8 b - - 0 67,a8a7 b7b8r a7a6,2003,75,39,19586,deflection mateIn2 oneMove,https://lichess.org/x11,
+Kjouy,8/N7/5K2/r2R4/8/3B4/8/1k2N3 b - - 0 45,b1b2 d3c2 a5a3 c2g6,2083,75,27,33172,mate,https://lichess.org/x26,
+"""
+# The shards committed under public/, written by the replay before play_line.
+COMMITTED_PUZZLES = Path(__file__).resolve().parent.parent / "public" / "puzzles"
+ARCHIVE = zstandard.ZstdCompressor(write_checksum=True).compress(PUZZLE_CSV.encode("utf-8"))
+# Default filters, loosened so that all four sample puzzles are kept.
+SAMPLE_CONFIG = replace(
+    default_config(),
+    target_per_combo=2,
+    candidate_multiplier=2,
+    min_popularity=0,
+    min_nb_plays=0,
+    seed=7
+)
+
+
+def sample_rows() -> List[Dict[str, str]]:
+    return list(csv.DictReader(io.StringIO(PUZZLE_CSV)))
+
+
+# One row per parse stage, each a copy of the first sample puzzle that only
+# that stage rejects (popularity with a minimum of 30).
+STAGE_VARIANTS: Dict[str, Dict[str, str]] = {
+    "accepted": {},
+    "fields": {"Moves": "g3g4"},
+    "fen_prefilter": {"FEN": "rnbqkbnr/p7/8/8/8/8/8/4K3 b - - 0 1", "Moves": "a7a6 e1e2"},
+    "rating": {"Rating": "500"},
+    "popularity": {"Popularity": "10"},
+    "themes": {"Themes": "zzz"},
+    "board": {"Moves": "a1a8 e1d2"},
+    "piece_count": {"FEN": "8/8/8/8/8/2k5/2R5/K7 b - - 0 1", "Moves": "c3c2 a1a2"},
+    "line": {"Moves": "g3g4 e1d2 g4g3 d2e3 g3g2 e3e4"}
+}
+
+
+def stage_rows() -> List[Dict[str, str]]:
+    base = sample_rows()[0]
+    return [{**base, "PuzzleId": stage, **overrides} for stage, overrides in STAGE_VARIANTS.items()]
+
+
+def copied_rows(copies: int) -> List[Dict[str, str]]:
+    return [{**row, "PuzzleId": f"{row['PuzzleId']}{copy}"} for copy in range(copies) for row in sample_rows()]
+
+
+def selected_ids(selected_by_combo: Dict[str, List[PuzzleSeed]]) -> Dict[str, List[str]]:
+    return {key: [seed.puzzle_id for seed in seeds] for key, seeds in selected_by_combo.items()}
+
+
+def write_archive(path: Path, rows: List[Dict[str, str]]) -> Path:
+    text = io.StringIO()
+    writer = csv.DictWriter(text, fieldnames=list(rows[0]), lineterminator="\n")
+    writer.writeheader()
+    writer.writerows(rows)
+    path.write_bytes(zstandard.ZstdCompressor().compress(text.getvalue().encode("utf-8")))
+    return path
+
+
+class PuzzleSeedTests(unittest.TestCase):
+    def test_derived_fields_match_the_replayed_position(self) -> None:
+        row = dict(zip(
+            ("PuzzleId", "FEN", "Moves", "Rating", "Popularity", "NbPlays", "Themes"),
+            ("OSc2m", "8/P2k4/8/8/K5P1/8/8/1Rr1n1R1 w - - 0 80", "a4b4 d7e7 b1b3 c1c8 g1g2", "971", "32", "29750", "advantage mate")
+        ))
+        seed = build_lichess_puzzles.parse_puzzle_seed(row, SAMPLE_CONFIG)
+        assert seed is not None
+        self.assertFalse(hasattr(seed, "__dict__"))
+        self.assertEqual(build_lichess_puzzles.as_output(seed), {
+            "puzzleId": "OSc2m",
+            "fen": "8/P2k4/8/8/1K4P1/8/8/1Rr1n1R1 b - - 1 80",
+            "sideToMove": "b",
+            "pieceCount": 8,
+            "ratingBucket": 800,
+            "whitePieces": ["Kb4", "Rb1", "Rg1", "Pa7", "Pg4"],
+            "blackPieces": ["Kd7", "Rc1", "Ne1"],
+            "continuationSan": ["Ke7", "Rb3", "Rc8", "Rg2"],
+            "continuationText": "80... Ke7 81. Rb3 Rc8 82. Rg2",
+            "themes": ["advantage", "mate"],
+            "source": "lichess_static"
+        })
+
+
+class ParallelParseTests(unittest.TestCase):
+    def test_worker_processes_match_the_serial_parse(self) -> None:
+        rows: List[Optional[Dict[str, str]]] = []
+        for copy in range(50):
+            for row in sample_rows():
+                rows.append({**row, "PuzzleId": f"{row['PuzzleId']}{copy}"})
+                # An illegal setup move, rejected after the board is built.
+                rows.append({**row, "PuzzleId": f"x{row['PuzzleId']}{copy}", "Moves": "a1a8 e1d2"})
+            # A row skipped as combo_full before parsing.
+            rows.append(None)
+
+        def parse(workers: int, batch_size: int, replay_state: Optional[ReplayState]) -> tuple[List[Optional[PuzzleSeed]], Counter[str]]:
+            rejections: Counter[str] = Counter()
+            config = replace(SAMPLE_CONFIG, workers=workers, batch_size=batch_size)
+            return list(build_lichess_puzzles.iter_parsed_seeds(config, rows, rejections, replay_state)), rejections
+
+        serial, serial_rejections = parse(1, 1, None)
+        self.assertEqual(sum(seed is not None for seed in serial), 200)
+        self.assertEqual(serial_rejections, Counter(board=200, combo_full=50))
+        replay_state = {
+            seed.puzzle_id: (seed.line_fingerprint, build_lichess_puzzles.replayed_line_of(seed))
+            for seed in serial[::2]
+            if seed is not None
+        }
+        for batch_size in (1, 7, 5000):
+            for state in (None, replay_state):
+                with self.subTest(batch_size=batch_size, replay_state=state is not None):
+                    self.assertEqual(parse(2, batch_size, state), (serial, serial_rejections))
+
+
+class RejectionStageTests(unittest.TestCase):
+    def test_fen_prefilter_only_rejects_rows_the_parser_rejects(self) -> None:
+        config = replace(default_config(), min_popularity=0, min_nb_plays=0)
+        row_filter = build_lichess_puzzles.row_filter_for(config)
+        rng = random.Random(11)
+        outcomes: Counter[tuple[int, bool, str]] = Counter()
+        for pieces in range(config.min_piece_count - 1, config.max_piece_count + 3):
+            for _ in range(40):
+                board = random_board(rng, pieces)
+                moves = list(board.legal_moves)
+                # Captures in the setup move are what make the boundaries tricky.
+                captures = [move for move in moves if board.is_capture(move)]
+                setup = rng.choice(captures if captures and rng.random() < 0.5 else moves)
+                board.push(setup)
+                replies = list(board.legal_moves)
+                if not replies:
+                    continue
+                reply = rng.choice(replies)
+                in_range = config.min_piece_count <= len(board.piece_map()) <= config.max_piece_count
+                board.pop()
+                row = {
+                    "PuzzleId": f"p{pieces}x{sum(outcomes.values())}",
+                    "FEN": board.fen(),
+                    "Moves": f"{setup.uci()} {reply.uci()}",
+                    "Rating": "1500",
+                    "Popularity": "90",
+                    "NbPlays": "1000",
+                    "Themes": "advantage mate"
+                }
+                rejections: Counter[str] = Counter()
+                seed = build_lichess_puzzles.parse_puzzle_seed(row, config, rejections)
+                if rejections["fen_prefilter"]:
+                    self.assertFalse(in_range, row)
+                # The columnar reader's byte-level prefilter agrees with the parser's.
+                byte_stage = row_filter.reject_stage([row[column].encode("utf-8") for column in NEEDED_COLUMNS])
+                self.assertEqual(byte_stage == "fen_prefilter", bool(rejections["fen_prefilter"]), row)
+                stage = "accepted" if seed is not None else next(iter(rejections))
+                outcomes[(pieces, board.is_capture(setup), stage)] += 1
+        # Both boundaries are hit from both sides: a capture brings max + 1
+        # pieces into range, and min pieces stay in range without one.
+        max_pieces, min_pieces = config.max_piece_count, config.min_piece_count
+        self.assertGreater(outcomes[(max_pieces + 1, True, "accepted")], 0)
+        self.assertGreater(outcomes[(max_pieces + 1, False, "piece_count")], 0)
+        self.assertGreater(outcomes[(max_pieces + 2, True, "fen_prefilter")], 0)
+        self.assertGreater(outcomes[(min_pieces, False, "accepted")], 0)
+        self.assertGreater(outcomes[(min_pieces - 1, False, "fen_prefilter")], 0)
+
+    def test_each_rejection_stage_is_counted_once(self) -> None:
+        rows = stage_rows()
+        expected = Counter({stage: 1 for stage in STAGE_VARIANTS if stage != "accepted"})
+        for workers in (1, 2):
+            with self.subTest(workers=workers):
+                config = replace(SAMPLE_CONFIG, min_popularity=30, workers=workers, batch_size=2)
+                rejections: Counter[str] = Counter()
+                seeds = list(build_lichess_puzzles.iter_parsed_seeds(config, rows, rejections))
+                self.assertEqual([seed.puzzle_id for seed in seeds if seed is not None], ["accepted"])
+                self.assertEqual(rejections, expected)
+
+
+class StreamedBuildTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = ArchiveServer(ARCHIVE)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/lichess_db_puzzle.csv.zst"
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def build(self, config: BuilderConfig) -> Dict[str, List[str]]:
+        with contextlib.redirect_stdout(io.StringIO()):
+            selected_by_combo, _ = build_lichess_puzzles.build_dataset(config)
+        return selected_ids(selected_by_combo)
+
+    def test_streamed_build_matches_local_build(self) -> None:
+        local_path = self.root / "local.csv.zst"
+        local_path.write_bytes(ARCHIVE)
+        local = self.build(replace(SAMPLE_CONFIG, input_path=local_path, output_dir=self.root / "out"))
+        self.assertEqual(sum(len(ids) for ids in local.values()), 4)
+
+        streamed_config = replace(
+            SAMPLE_CONFIG,
+            input_path=self.root / "missing.csv.zst",
+            output_dir=self.root / "out",
+            input_url=self.url
+        )
+        self.assertEqual(self.build(streamed_config), local)
+        self.assertFalse(streamed_config.input_path.exists())
+
+    def test_tee_saves_the_streamed_archive(self) -> None:
+        config = replace(
+            SAMPLE_CONFIG,
+            input_path=self.root / "tee" / "lichess_db_puzzle.csv.zst",
+            output_dir=self.root / "out",
+            input_url=self.url,
+            tee_input=True,
+            max_rows=1
+        )
+        self.build(config)
+        # The body is drained past the row cap so the saved archive is complete.
+        self.assertEqual(config.input_path.read_bytes(), ARCHIVE)
+
+
+class RowReaderTests(unittest.TestCase):
+    def test_csv_and_columnar_readers_reject_the_same_rows(self) -> None:
+        with tempfile.TemporaryDirectory() as temp:
+            archive = write_archive(Path(temp) / "stages.csv.zst", [*stage_rows(), stage_rows()[0]])
+            with archive.open("ab") as handle:
+                # Malformed rows: a short row, a non-numeric rating and an empty id.
+                handle.write(zstandard.ZstdCompressor().compress(
+                    b"SHORT,8/8/4R3/2p5/4p3/6k1/8/4K3 b - - 0 77\n"
+                    b"NOINT,8/8/4R3/2p5/4p3/6k1/8/4K3 b - - 0 77,g3g4 e1d2,high,75,84,22485,mate,https://lichess.org/x,\n"
+                    b",8/8/4R3/2p5/4p3/6k1/8/4K3 b - - 0 77,g3g4 e1d2,1500,75,84,22485,mate,https://lichess.org/x,\n"
+                ))
+            config = replace(SAMPLE_CONFIG, input_path=archive, min_popularity=30)
+            builds = []
+            for reader in ("columnar", "csv"):
+                with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                    selected_by_combo, scanned = build_lichess_puzzles.build_dataset(replace(config, reader=reader))
+                builds.append((selected_by_combo, scanned, stdout.getvalue()))
+        self.assertEqual(builds[0], builds[1])
+        selected_by_combo, scanned, console = builds[0]
+        self.assertEqual([seed.puzzle_id for seeds in selected_by_combo.values() for seed in seeds], ["accepted"])
+        self.assertEqual(scanned, len(STAGE_VARIANTS) + 4)
+        expected = Counter({stage: 1 for stage in STAGE_VARIANTS if stage != "accepted"}, fields=3, duplicate=1)
+        rejections = Counter({stage: int(count) for stage, count in re.findall(r"^  (\w+): (\d+)$", console, re.MULTILINE)})
+        self.assertEqual(+rejections, expected)
+
+
+class ShardFormatTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        self.input_path = self.root / "lichess_db_puzzle.csv.zst"
+        self.input_path.write_bytes(ARCHIVE)
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def write(self, shard_format: str, **options: object) -> Path:
+        output_dir = self.root / shard_format
+        config = replace(SAMPLE_CONFIG, input_path=self.input_path, output_dir=output_dir, shard_format=shard_format, **options)
+        with contextlib.redirect_stdout(io.StringIO()):
+            selected_by_combo, _ = build_lichess_puzzles.build_dataset(config)
+            build_lichess_puzzles.write_outputs(config, selected_by_combo)
+        return output_dir
+
+    def test_columnar_shards_decode_to_the_json_shards(self) -> None:
+        json_dir = self.write("json")
+        columnar_dir = self.write("columnar")
+        manifest = json.loads((columnar_dir / "manifest.json").read_text(encoding="utf-8"))
+        self.assertEqual(manifest["shardFormat"], "columnar")
+        self.assertNotIn("shardFormat", json.loads((json_dir / "manifest.json").read_text(encoding="utf-8")))
+
+        for key in manifest["countsByCombo"]:
+            piece_count, rating_bucket = (int(part[1:]) for part in key.split("-"))
+            relative = manifest["shardPattern"].format(pieceCount=piece_count, ratingBucket=rating_bucket)
+            payload = json.loads((columnar_dir / relative).read_text(encoding="utf-8"))
+            expected = json.loads((json_dir / "lichess" / f"p{piece_count}" / f"r{rating_bucket}.json").read_text(encoding="utf-8"))
+            self.assertEqual(build_lichess_puzzles.decode_columnar_shard(payload, piece_count, rating_bucket), expected)
+
+    def test_hashed_shards_are_listed_with_integrity_fields(self) -> None:
+        output_dir = self.write("json", hash_shards=True, precompress=True)
+        manifest = json.loads((output_dir / "manifest.json").read_text(encoding="utf-8"))
+        self.assertEqual(set(manifest["shards"]), set(manifest["countsByCombo"]))
+
+        for key, entry in manifest["shards"].items():
+            data = (output_dir / entry["path"]).read_bytes()
+            self.assertEqual(hashlib.sha256(data).hexdigest(), entry["sha256"])
+            self.assertEqual(len(data), entry["bytes"])
+            self.assertIn(entry["sha256"][:16], entry["path"])
+            self.assertEqual(len(json.loads(data)), manifest["countsByCombo"][key])
+
+            shard_path = output_dir / entry["path"]
+            gz_path = shard_path.with_name(shard_path.name + ".gz")
+            zst_path = shard_path.with_name(shard_path.name + ".zst")
+            self.assertEqual(gzip.decompress(gz_path.read_bytes()), data)
+            self.assertEqual(zstandard.ZstdDecompressor().decompress(zst_path.read_bytes()), data)
+            self.assertEqual(entry["encodedBytes"]["gz"], gz_path.stat().st_size)
+        self.assertTrue((output_dir / "manifest.json.gz").exists())
+
+    def test_precompress_needs_brotli(self) -> None:
+        argv = ["build_lichess_puzzles.py", "--input", str(self.input_path), "--precompress"]
+        with mock.patch.object(build_lichess_puzzles, "brotli", None), mock.patch.object(sys, "argv", argv):
+            with contextlib.redirect_stderr(io.StringIO()) as stderr, self.assertRaises(SystemExit):
+                build_lichess_puzzles.parse_args()
+        self.assertIn("--precompress needs brotli", stderr.getvalue())
+
+    def test_paged_shards_concatenate_to_the_whole_shard(self) -> None:
+        archive = write_synthetic_archive(self.root / "synthetic.csv.zst", 1500, seed=2)
+        whole_dir = self.root / "whole"
+        paged_dir = self.root / "paged"
+        config = replace(
+            SAMPLE_CONFIG,
+            input_path=archive,
+            output_dir=paged_dir,
+            target_per_combo=6,
+            candidate_multiplier=1,
+            page_size=4,
+            hash_shards=True
+        )
+        whole_config = replace(config, output_dir=whole_dir, page_size=0, hash_shards=False)
+        with contextlib.redirect_stdout(io.StringIO()):
+            selected_by_combo, _ = build_lichess_puzzles.build_dataset(config)
+            build_lichess_puzzles.write_outputs(config, selected_by_combo)
+            build_lichess_puzzles.write_outputs(whole_config, selected_by_combo)
+
+        manifest = json.loads((paged_dir / "manifest.json").read_text(encoding="utf-8"))
+        self.assertEqual(manifest["pageSize"], 4)
+        self.assertNotIn("shards", manifest)
+        self.assertEqual(set(manifest["pages"]), set(manifest["countsByCombo"]))
+        self.assertGreater(max(len(pages) for pages in manifest["pages"].values()), 1)
+        for key, pages in manifest["pages"].items():
+            self.assertEqual(sum(page["puzzles"] for page in pages), manifest["countsByCombo"][key])
+            entries: List[Dict[str, object]] = []
+            for page in pages:
+                data = (paged_dir / page["path"]).read_bytes()
+                self.assertEqual(len(data), page["bytes"])
+                self.assertEqual(hashlib.sha256(data).hexdigest(), page["sha256"])
+                entries.extend(json.loads(data))
+            piece_count, rating_bucket = (int(part[1:]) for part in key.split("-"))
+            whole = whole_dir / "lichess" / f"p{piece_count}" / f"r{rating_bucket}.json"
+            self.assertEqual(entries, json.loads(whole.read_text(encoding="utf-8")))
+
+    def test_facets_point_at_the_page_holding_each_puzzle(self) -> None:
+        archive = write_synthetic_archive(self.root / "synthetic.csv.zst", 1500, seed=2)
+        output_dir = self.root / "faceted"
+        config = replace(SAMPLE_CONFIG, input_path=archive, output_dir=output_dir, target_per_combo=6, candidate_multiplier=1, page_size=4, hash_shards=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            selected_by_combo, _ = build_lichess_puzzles.build_dataset(config)
+            build_lichess_puzzles.write_outputs(config, selected_by_combo)
+
+        manifest = json.loads((output_dir / "manifest.json").read_text(encoding="utf-8"))
+        data = (output_dir / manifest["facets"]["path"]).read_bytes()
+        self.assertEqual(hashlib.sha256(data).hexdigest(), manifest["facets"]["sha256"])
+        facets = json.loads(data)
+        self.assertEqual(facets["pageSize"], 4)
+        self.assertEqual(set(facets["combos"]), set(manifest["countsByCombo"]))
+        for key, combo in facets["combos"].items():
+            self.assertEqual(sum(combo["motifCounts"].values()), manifest["countsByCombo"][key])
+            pages = [json.loads((output_dir / page["path"]).read_bytes()) for page in manifest["pages"][key]]
+            for theme, offsets in combo["themes"].items():
+                self.assertEqual(combo["themeCounts"][theme], len(offsets))
+                for offset in offsets:
+                    self.assertIn(theme, pages[offset // 4][offset % 4]["themes"])
+            for motif, offsets in combo["motifs"].items():
+                for offset in offsets:
+                    self.assertEqual(build_lichess_puzzles.motif_for(pages[offset // 4][offset % 4]["themes"]), motif)
+            entries = [entry for page in pages for entry in page]
+            for offset, entry in enumerate(entries):
+                for theme in entry["themes"]:
+                    self.assertIn(offset, combo["themes"][theme])
+
+    def test_rebuilds_keep_the_previous_generation_for_one_more_build(self) -> None:
+        output_dir = self.root / "published"
+        previous_manifest = output_dir / build_lichess_puzzles.PREVIOUS_MANIFEST_NAME
+        config = replace(SAMPLE_CONFIG, input_path=self.input_path, output_dir=output_dir, hash_shards=True, precompress=True)
+
+        def write(config: BuilderConfig) -> None:
+            with contextlib.redirect_stdout(io.StringIO()):
+                build_lichess_puzzles.write_outputs(config, selected_by_combo)
+
+        def published() -> Dict[Path, int]:
+            return {path: path.stat().st_mtime_ns for path in output_dir.rglob("*") if path.is_file()}
+
+        def named(manifest_path: Path) -> set[str]:
+            files = build_lichess_puzzles.manifest_files(json.loads(manifest_path.read_bytes()))
+            return {name for name in files if build_lichess_puzzles.brotli is not None or not name.endswith(".br")}
+
+        def lichess_files() -> set[str]:
+            return {path.relative_to(output_dir).as_posix() for path in (output_dir / "lichess").rglob("*") if path.is_file()}
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            selected_by_combo, _ = build_lichess_puzzles.build_dataset(config)
+        write(config)
+        first = published()
+        first_manifest = (output_dir / "manifest.json").read_bytes()
+        write(replace(config, incremental=True))
+        self.assertEqual(published(), first)
+        self.assertFalse(previous_manifest.exists())
+
+        # An interrupted build adds its new files but leaves the manifest alone.
+        with mock.patch.object(build_lichess_puzzles.OutputGeneration, "publish", side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                write(replace(config, page_size=1))
+        self.assertEqual((output_dir / "manifest.json").read_bytes(), first_manifest)
+        self.assertLess(named(output_dir / "manifest.json"), lichess_files())
+
+        write(replace(config, page_size=1))
+        self.assertEqual(previous_manifest.read_bytes(), first_manifest)
+        self.assertLessEqual(named(previous_manifest), lichess_files())
+        self.assertEqual(lichess_files(), named(output_dir / "manifest.json") | named(previous_manifest))
+
+        paged_manifest = (output_dir / "manifest.json").read_bytes()
+        write(replace(config, page_size=2))
+        self.assertEqual(previous_manifest.read_bytes(), paged_manifest)
+        self.assertEqual(lichess_files(), named(output_dir / "manifest.json") | named(previous_manifest))
+
+    def test_worker_processes_publish_the_same_tree_and_keep_foreign_files(self) -> None:
+        config = replace(SAMPLE_CONFIG, input_path=self.input_path, output_dir=self.root / "serial", precompress=True, page_size=2)
+        with contextlib.redirect_stdout(io.StringIO()):
+            selected_by_combo, _ = build_lichess_puzzles.build_dataset(config)
+            build_lichess_puzzles.write_outputs(config, selected_by_combo)
+        parallel_dir = self.root / "parallel"
+        parallel_dir.mkdir()
+        (parallel_dir / "NOTICE.txt").write_text("kept", encoding="utf-8")
+        (parallel_dir / "manifest.json.br").write_bytes(b"stale")
+        with contextlib.redirect_stdout(io.StringIO()):
+            build_lichess_puzzles.write_outputs(replace(config, output_dir=parallel_dir, workers=2), selected_by_combo)
+
+        def tree(root: Path) -> Dict[str, bytes]:
+            files = {path.relative_to(root).as_posix(): path.read_bytes() for path in root.rglob("*") if path.is_file()}
+            manifest = json.loads(files.pop("manifest.json"))
+            manifest.pop("generatedAt")
+            files["manifest.json"] = json.dumps(manifest).encode("utf-8")
+            return {name: data for name, data in files.items() if not name.startswith("manifest.json.")}
+
+        parallel = tree(parallel_dir)
+        self.assertEqual(parallel.pop("NOTICE.txt"), b"kept")
+        self.assertEqual(parallel, tree(self.root / "serial"))
+        # A stale manifest sibling is replaced, or dropped when brotli is missing.
+        brotli_sibling = parallel_dir / "manifest.json.br"
+        if build_lichess_puzzles.brotli is None:
+            self.assertFalse(brotli_sibling.exists())
+        else:
+            self.assertNotEqual(brotli_sibling.read_bytes(), b"stale")
+
+
+class BuildStatsTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        mix = PuzzleMix(malformed_rate=0.05, illegal_rate=0.05)
+        archive = write_synthetic_archive(self.root / "synthetic.csv.zst", 3000, seed=3, mix=mix)
+        self.config = replace(
+            default_config(),
+            input_path=archive,
+            output_dir=self.root / "out",
+            min_popularity=0,
+            min_nb_plays=0,
+            target_per_combo=4,
+            candidate_multiplier=2,
+            seed=7
+        )
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def build(self, config: BuilderConfig) -> Dict[str, List[str]]:
+        with contextlib.redirect_stdout(io.StringIO()):
+            selected_by_combo, _ = build_lichess_puzzles.build_dataset(config)
+        return selected_ids(selected_by_combo)
+
+    def test_stats_account_for_every_row_without_changing_output(self) -> None:
+        plain = self.build(self.config)
+        serial_path = self.root / "serial.json"
+        self.assertEqual(self.build(replace(self.config, stats_json=serial_path)), plain)
+        stats = json.loads(serial_path.read_text(encoding="utf-8"))
+
+        accepted = sum(combo["candidates"] for combo in stats["combos"].values())
+        self.assertEqual(accepted, stats["acceptedCandidates"])
+        self.assertEqual(accepted + sum(stats["rejections"].values()), stats["rowsScanned"])
+        self.assertEqual(set(stats["stageSeconds"]), set(build_lichess_puzzles.TIMING_STAGES))
+        self.assertGreater(stats["stageSeconds"]["board"], 0)
+        for key, combo in stats["combos"].items():
+            self.assertEqual(combo["selected"], len(plain.get(key, [])))
+            if combo["fillRate"] == 1.0:
+                self.assertLessEqual(combo["saturatedAtRow"], stats["rowsScanned"])
+            else:
+                self.assertIsNone(combo["saturatedAtRow"])
+
+        parallel_path = self.root / "parallel.json"
+        self.assertEqual(self.build(replace(self.config, stats_json=parallel_path, workers=2, batch_size=100)), plain)
+        parallel = json.loads(parallel_path.read_text(encoding="utf-8"))
+        self.assertEqual(parallel["rejections"], stats["rejections"])
+        self.assertEqual(parallel["combos"], stats["combos"])
+
+
+class SaturationTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        # Copies of the one sample puzzle in this range: its only combo fills
+        # up on the first copy.
+        self.archive = write_archive(self.root / "copies.csv.zst", copied_rows(20))
+        self.config = replace(
+            SAMPLE_CONFIG,
+            input_path=self.archive,
+            min_piece_count=5,
+            max_piece_count=5,
+            min_rating=2200,
+            max_rating=2200,
+            target_per_combo=1,
+            candidate_multiplier=1
+        )
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_predicted_combo_matches_the_parsed_seed(self) -> None:
+        config = replace(default_config(), min_popularity=0, min_nb_plays=0)
+        rng = random.Random(5)
+        parsed = 0
+        for pieces in range(config.min_piece_count, config.max_piece_count + 2):
+            for index in range(40):
+                board = random_board(rng, pieces)
+                moves = list(board.legal_moves)
+                captures = [move for move in moves if board.is_capture(move)]
+                setup = rng.choice(captures if captures and rng.random() < 0.5 else moves)
+                board.push(setup)
+                replies = list(board.legal_moves)
+                if not replies:
+                    continue
+                moves_uci = f"{setup.uci()} {rng.choice(replies).uci()}"
+                board.pop()
+                row = {**sample_rows()[0], "PuzzleId": f"p{pieces}x{index}", "FEN": board.fen(), "Moves": moves_uci, "Rating": "1500"}
+                seed = build_lichess_puzzles.parse_puzzle_seed(row, config)
+                if seed is not None:
+                    parsed += 1
+                    self.assertEqual(build_lichess_puzzles.predicted_combo_key(row, config), build_lichess_puzzles.combo_key(seed))
+        self.assertGreater(parsed, 0)
+
+    def test_stopping_when_saturated_selects_the_same_puzzles_as_a_full_scan(self) -> None:
+        selected: Dict[bool, Dict[str, List[PuzzleSeed]]] = {}
+        scanned: Dict[bool, int] = {}
+        combo_full: Dict[bool, int] = {}
+        for stop in (False, True):
+            config = replace(self.config, stats_json=self.root / f"stats-{stop}.json", stop_when_saturated=stop)
+            with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                selected[stop], scanned[stop] = build_lichess_puzzles.build_dataset(config)
+            match = re.search(r"^  combo_full: (\d+)$", stdout.getvalue(), re.MULTILINE)
+            assert match is not None
+            combo_full[stop] = int(match.group(1))
+            self.assertEqual(stop, "every expected combo reached its candidate cap" in stdout.getvalue())
+            stats = json.loads(config.stats_json.read_text(encoding="utf-8"))
+            self.assertEqual(stats["saturated"], stop)
+            self.assertEqual(stats["rejections"].get("combo_full", 0), combo_full[stop])
+            # Rows skipped as combo_full before parsing are still accounted for.
+            self.assertEqual(stats["acceptedCandidates"] + sum(stats["rejections"].values()), stats["rowsScanned"])
+
+        self.assertEqual(selected[True], selected[False])
+        self.assertEqual(list(selected[False]), ["p5-r2200"])
+        # The full scan skips every later copy; the saturated one stops at the first.
+        self.assertEqual((scanned[True], combo_full[True]), (1, 0))
+        self.assertEqual(combo_full[False], 19)
+
+
+class CandidateCacheTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        self.archive = write_archive(self.root / "copies.csv.zst", copied_rows(12))
+        self.config = replace(
+            SAMPLE_CONFIG,
+            input_path=self.archive,
+            output_dir=self.root / "out",
+            cache_dir=self.root / "cache",
+            target_per_combo=2,
+            candidate_multiplier=2
+        )
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def build(self, config: BuilderConfig) -> tuple[Dict[str, List[str]], bool]:
+        """Selected ids, and whether they came from the cache."""
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            selected_by_combo, _ = build_lichess_puzzles.build_dataset(config)
+        return selected_ids(selected_by_combo), "from cache" in stdout.getvalue()
+
+    def test_input_and_filter_changes_force_a_rescan(self) -> None:
+        key = build_lichess_puzzles.candidate_cache_path(self.config)
+        self.assertIsNotNone(key)
+        for name, value in {
+            "min_piece_count": 4,
+            "max_piece_count": 7,
+            "min_rating": 1000,
+            "max_rating": 2000,
+            "bucket_size": 100,
+            "max_plies": 3,
+            "min_popularity": 10,
+            "min_nb_plays": 10,
+            "max_rows": 20,
+            "stop_when_saturated": True
+        }.items():
+            with self.subTest(name=name):
+                self.assertNotEqual(build_lichess_puzzles.candidate_cache_path(replace(self.config, **{name: value})), key)
+        # Selection settings reuse the same scan.
+        self.assertEqual(build_lichess_puzzles.candidate_cache_path(replace(self.config, target_per_combo=1, seed=8)), key)
+
+        first, from_cache = self.build(self.config)
+        self.assertFalse(from_cache)
+        self.assertEqual(self.build(self.config), (first, True))
+        self.assertFalse(self.build(replace(self.config, max_plies=3))[1])
+
+        write_archive(self.archive, copied_rows(13))
+        self.assertNotEqual(build_lichess_puzzles.candidate_cache_path(self.config), key)
+        self.assertFalse(self.build(self.config)[1])
+
+    def test_larger_cap_cut_down_equals_a_fresh_scan(self) -> None:
+        with contextlib.redirect_stdout(io.StringIO()):
+            wide = build_lichess_puzzles.scan_candidates(replace(self.config, candidate_multiplier=5))
+        path = build_lichess_puzzles.candidate_cache_path(self.config)
+        build_lichess_puzzles.save_candidate_cache(path, wide)
+
+        for target in (1, 2, 5):
+            config = replace(self.config, target_per_combo=target)
+            with self.subTest(target=target):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    fresh = build_lichess_puzzles.scan_candidates(config)
+                cached = build_lichess_puzzles.load_candidate_cache(path, config)
+                self.assertIsNotNone(cached)
+                self.assertEqual(cached.candidates, fresh.candidates)
+                self.assertEqual(cached.combo_cap, fresh.combo_cap)
+
+    def test_mismatched_or_corrupt_caches_are_rejected(self) -> None:
+        with contextlib.redirect_stdout(io.StringIO()):
+            scan = build_lichess_puzzles.scan_candidates(self.config)
+        path = build_lichess_puzzles.candidate_cache_path(self.config)
+        load = build_lichess_puzzles.load_candidate_cache
+
+        build_lichess_puzzles.save_candidate_cache(path, scan)
+        self.assertIsNotNone(load(path, self.config))
+        # Too small a cap, and a cut-down pool that had to drop duplicates.
+        self.assertIsNone(load(path, replace(self.config, candidate_multiplier=3)))
+        build_lichess_puzzles.save_candidate_cache(path, replace(scan, rejections=scan.rejections + Counter(duplicate=1)))
+        self.assertIsNone(load(path, replace(self.config, target_per_combo=1)))
+
+        path.write_bytes(zstandard.ZstdCompressor().compress(json.dumps({"version": 0}).encode("utf-8")))
+        self.assertIsNone(load(path, self.config))
+        path.write_bytes(b"not zstd")
+        self.assertIsNone(load(path, self.config))
+        path.write_bytes(b"")
+        self.assertIsNone(load(path, self.config))
+        # A build over a corrupt cache rescans and replaces it.
+        self.assertFalse(self.build(self.config)[1])
+        self.assertIsNotNone(load(path, self.config))
+
+
+class ReplayStateTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        self.archive = write_archive(self.root / "copies.csv.zst", copied_rows(3))
+        self.config = replace(
+            SAMPLE_CONFIG,
+            input_path=self.archive,
+            output_dir=self.root / "out",
+            state_file=self.root / "state.json.zst"
+        )
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def build(self, config: BuilderConfig) -> tuple[Dict[str, List[str]], int, int]:
+        """Selected ids, and how many replays were reused and how many rerun."""
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            selected_by_combo, _ = build_lichess_puzzles.build_dataset(config)
+        counts = re.search(r"reused (\d+) previous replays, replayed (\d+) new", stdout.getvalue())
+        assert counts is not None
+        return selected_ids(selected_by_combo), int(counts.group(1)), int(counts.group(2))
+
+    def test_unchanged_rows_reuse_their_replays(self) -> None:
+        first, reused, replayed = self.build(self.config)
+        self.assertEqual((reused, replayed), (0, 12))
+        state = build_lichess_puzzles.load_replay_state(self.config)
+        self.assertEqual(len(state), 12)
+        self.assertEqual(self.build(self.config), (first, 12, 0))
+
+        rows = copied_rows(3)
+        rows[0]["Moves"] = "g3g4 e1d1"
+        write_archive(self.archive, [*rows, {**rows[1], "PuzzleId": "NEW"}])
+        self.assertEqual(self.build(self.config)[1:], (11, 2))
+
+    def test_unchanged_archive_replays_nothing(self) -> None:
+        write_archive(self.archive, [*stage_rows(), *copied_rows(3)])
+        first, reused, replayed = self.build(self.config)
+        self.assertEqual(reused, 0)
+        state = build_lichess_puzzles.load_replay_state(self.config)
+        self.assertEqual(len(state), replayed)
+        # Rows the replay rejects are recorded with their stage.
+        for stage in build_lichess_puzzles.REPLAY_STAGES:
+            self.assertEqual(state[stage][1], stage)
+
+        self.assertEqual(self.build(self.config), (first, replayed, 0))
+        # Workers parse ahead of the combo_full check, so their first build may
+        # reach rows the serial scan skipped; the next one replays nothing.
+        for options in ({"workers": 2, "batch_size": 3}, {"workers": 2, "index_dir": self.root / "index"}):
+            with self.subTest(**options):
+                config = replace(self.config, **options)
+                self.build(config)
+                selected, _, replayed_again = self.build(config)
+                self.assertEqual((selected, replayed_again), (first, 0))
+
+    def test_replay_settings_invalidate_the_state(self) -> None:
+        self.build(self.config)
+        for name, value in {"min_piece_count": 4, "max_piece_count": 7, "max_plies": 3}.items():
+            with self.subTest(name=name):
+                config = replace(self.config, **{name: value})
+                with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                    self.assertEqual(build_lichess_puzzles.load_replay_state(config), {})
+                self.assertIn("different configuration", stdout.getvalue())
+                self.assertEqual(self.build(config)[1], 0)
+                # The state now belongs to ``config``; restore the baseline.
+                self.build(self.config)
+
+
+class CandidatePoolTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        archive = write_synthetic_archive(self.root / "synthetic.csv.zst", 3000, seed=5)
+        self.config = replace(
+            default_config(),
+            input_path=archive,
+            output_dir=self.root / "out",
+            min_popularity=0,
+            min_nb_plays=0,
+            target_per_combo=2,
+            seed=9,
+            candidate_pool="best"
+        )
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def scan(self, config: BuilderConfig) -> build_lichess_puzzles.CandidateScan:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return build_lichess_puzzles.scan_candidates(config)
+
+    def test_best_pool_keeps_top_scores_of_the_whole_archive(self) -> None:
+        every = self.scan(replace(self.config, candidate_pool="first", candidate_multiplier=10 ** 6)).candidates
+        groups: Dict[tuple[str, str], List[PuzzleSeed]] = defaultdict(list)
+        for seed in every:
+            groups[(build_lichess_puzzles.combo_key(seed), seed.motif)].append(seed)
+        kept: set[str] = set()
+        for group in groups.values():
+            group.sort(key=lambda seed: (seed.simplicity_score, build_lichess_puzzles.seeded_rank(seed.puzzle_id, 9)), reverse=True)
+            kept.update(seed.puzzle_id for seed in group[:2])
+
+        best = self.scan(self.config)
+        self.assertEqual(best.candidates, [seed for seed in every if seed.puzzle_id in kept])
+        self.assertEqual(len(best.candidates) + sum(best.rejections.values()), best.scanned)
+        self.assertEqual(best.rejections["outranked"], len(every) - len(kept))
+
+        parallel = self.scan(replace(self.config, workers=2, batch_size=100))
+        self.assertEqual(parallel.candidates, best.candidates)
+
+    def test_best_pool_state_is_bounded_by_the_kept_candidates(self) -> None:
+        every = self.scan(replace(self.config, candidate_pool="first", candidate_multiplier=10 ** 6)).candidates
+        acceptor = build_lichess_puzzles.CandidateAcceptor(self.config)
+        for row_number, seed in enumerate(every):
+            acceptor.offer(seed, row_number)
+        kept = acceptor.scan(len(every), Counter(), False).candidates
+        self.assertLess(len(kept), len(every))
+        self.assertEqual(acceptor.best_pool.kept_ids, {seed.puzzle_id for seed in kept})
+        self.assertEqual(acceptor.seen_ids, set())
+
+        # Repeats of kept puzzles are duplicates; the pool does not change.
+        for seed in every:
+            acceptor.offer(seed, None)
+        self.assertEqual(acceptor.rejections["duplicate"], len(kept))
+        self.assertEqual(acceptor.scan(0, Counter(), False).candidates, kept)
+
+
+@unittest.skipIf(build_lichess_puzzles.numpy is None, "NumPy is not installed")
+class VectorizedScoringTests(unittest.TestCase):
+    def test_scores_are_bit_identical_to_the_scalar_scores(self) -> None:
+        numpy = build_lichess_puzzles.numpy
+        config = default_config()
+        rng = random.Random(19)
+        theme_pool = ["oneMove", "mateIn1", "mateIn2", "mateIn3", "fork", "skewer", "hangingPiece", "pin", "short", "endgame"]
+        rows = [
+            (
+                rng.sample(theme_pool, rng.randint(0, 4)),
+                rng.randint(-100, 4000),
+                rng.randint(-10, 120),
+                rng.choice([0, 1, 9, 10, 250, 99999, 100000, 100001, rng.randint(0, 10 ** 7)]),
+                rng.randint(0, 6),
+                rng.random() < 0.5
+            )
+            for _ in range(5000)
+        ]
+        expected = [
+            build_lichess_puzzles.simplicity_score_for(themes, rating, popularity, plays, plies, forcing, config)
+            for themes, rating, popularity, plays, plies, forcing in rows
+        ]
+        scores = build_lichess_puzzles.simplicity_scores_for(
+            themes=[row[0] for row in rows],
+            ratings=numpy.array([row[1] for row in rows]),
+            popularities=numpy.array([row[2] for row in rows]),
+            nb_plays=numpy.array([row[3] for row in rows]),
+            line_plies=numpy.array([row[4] for row in rows]),
+            first_move_forcing=numpy.array([row[5] for row in rows]),
+            config=config
+        ).tolist()
+        self.assertEqual([score.hex() for score in scores], [score.hex() for score in expected])
+
+    def test_vectorized_scan_matches_the_per_row_scan(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            archive = write_synthetic_archive(Path(tmp) / "synthetic.csv.zst", 3000, seed=6)
+            # The csv reader applies no filters, so the numeric checks all run in the parser.
+            config = replace(default_config(), input_path=archive, reader="csv", candidate_multiplier=10 ** 6, batch_size=97)
+            with contextlib.redirect_stdout(io.StringIO()):
+                scalar = build_lichess_puzzles.scan_candidates(config)
+                vectorized = build_lichess_puzzles.scan_candidates(replace(config, vectorize=True))
+                parallel = build_lichess_puzzles.scan_candidates(replace(config, vectorize=True, workers=2))
+        self.assertTrue(scalar.candidates)
+        self.assertGreater(scalar.rejections["popularity"], 0)
+        self.assertGreater(scalar.rejections["fields"], 0)
+        for scan in (vectorized, parallel):
+            self.assertEqual(scan.candidates, scalar.candidates)
+            self.assertEqual(scan.rejections, scalar.rejections)
+
+
+class ReplayLineTests(unittest.TestCase):
+    def test_replay_matches_the_python_chess_reference(self) -> None:
+        config = replace(default_config(), min_piece_count=2, max_piece_count=32)
+        with tempfile.TemporaryDirectory() as tmp:
+            mix = PuzzleMix(illegal_rate=0.05)
+            archive = write_synthetic_archive(Path(tmp) / "synthetic.csv.zst", 2000, seed=8, mix=mix)
+            lines = lines_to_replay(archive, config)
+
+        # Positions from random games add castling, en passant and promotions.
+        rng = random.Random(12)
+        castles = 0
+        for _ in range(400):
+            board = chess.Board()
+            for _ in range(rng.randint(0, 80)):
+                moves = list(board.legal_moves)
+                if not moves:
+                    break
+                board.push(rng.choice(moves))
+            fen = board.fen()
+            played: List[str] = []
+            for _ in range(rng.randint(2, 6)):
+                moves = list(board.legal_moves)
+                if not moves:
+                    break
+                move = rng.choice(moves)
+                castles += board.is_castling(move)
+                played.append(move.uci())
+                board.push(move)
+            if rng.random() < 0.1:
+                played.append("a1a1")
+            if len(played) >= 2:
+                lines.append((fen, played))
+
+        expected_rejections: Counter[str] = Counter()
+        rejections: Counter[str] = Counter()
+        for fen, moves in lines:
+            expected = replay_line_reference(fen, moves, config, expected_rejections)
+            self.assertEqual(build_lichess_puzzles.replay_line(fen, moves, config, rejections), expected, fen)
+        self.assertEqual(rejections, expected_rejections)
+        self.assertGreater(rejections["line"], 0)
+        self.assertGreater(castles, 0)
+
+    def test_replay_matches_the_committed_shards(self) -> None:
+        config = replace(default_config(), min_piece_count=2, max_piece_count=32)
+        kinds: Counter[str] = Counter()
+        entries = [
+            entry
+            for path in sorted((COMMITTED_PUZZLES / "lichess").rglob("r*.json"))
+            for entry in json.loads(path.read_text(encoding="utf-8"))
+        ]
+        self.assertTrue(entries)
+        for entry in entries:
+            board = chess.Board(entry["fen"])
+            moves: List[str] = []
+            for san in entry["continuationSan"]:
+                move = board.parse_san(san)
+                kinds["promotion"] += move.promotion is not None
+                kinds["en_passant"] += board.is_en_passant(move)
+                moves.append(move.uci())
+                board.push(move)
+            kinds["checkmate"] += board.is_checkmate()
+
+            played = build_lichess_puzzles.play_line(chess.Board(entry["fen"]), moves)
+            self.assertIsNotNone(played, entry["puzzleId"])
+            self.assertEqual(played[0], entry["continuationSan"], entry["puzzleId"])
+            if len(moves) >= 2:
+                # The first move stands in for the setup move, so the rest replay from a real position.
+                self.assertEqual(
+                    build_lichess_puzzles.replay_line(entry["fen"], moves, config),
+                    replay_line_reference(entry["fen"], moves, config),
+                    entry["puzzleId"]
+                )
+        # No committed line castles; the random games above cover it.
+        self.assertGreater(kinds["promotion"], 0)
+        self.assertGreater(kinds["en_passant"], 0)
+        self.assertGreater(kinds["checkmate"], 0)
+
+
+class LineIndexTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        archive = write_synthetic_archive(self.root / "synthetic.csv.zst", 5000, seed=6)
+        self.config = replace(
+            default_config(),
+            input_path=archive,
+            output_dir=self.root / "out",
+            min_popularity=0,
+            min_nb_plays=0,
+            target_per_combo=4,
+            candidate_multiplier=2,
+            seed=9
+        )
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_row_ranges_start_on_the_indexed_rows(self) -> None:
+        config = replace(self.config, index_dir=self.root / "index")
+        csv_path, index_path = build_lichess_puzzles.line_index_paths(config)
+        with build_lichess_puzzles.open_puzzle_stream(self.config) as stream:
+            index = write_line_index(stream, csv_path, index_path, build_lichess_puzzles.input_fingerprint(config), stride=700)
+        self.assertEqual(read_line_index(csv_path, index_path), index)
+        lines = [line for line in csv_path.read_bytes().split(b"\n")[1:] if line.rstrip(b"\r")]
+        self.assertEqual(index.rows, len(lines))
+
+        with open(csv_path, "rb") as handle, mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            ranged: List[Dict[str, str]] = []
+            for start, stop in index.row_ranges(max_rows=3333):
+                ranged.extend(CsvPuzzleReader(index.range_stream(mapped, start, stop), max_rows=stop - start))
+        with build_lichess_puzzles.open_puzzle_stream(self.config) as stream:
+            expected = list(CsvPuzzleReader(stream, max_rows=3333))
+        self.assertEqual(ranged, expected)
+
+        # The index is reused while the archive is unchanged.
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            self.assertEqual(build_lichess_puzzles.ensure_line_index(config), index)
+        self.assertEqual(stdout.getvalue(), "")
+
+    def test_indexed_builds_match_builds_from_the_archive(self) -> None:
+        config = replace(self.config, index_dir=self.root / "index")
+        csv_path, index_path = build_lichess_puzzles.line_index_paths(config)
+        with build_lichess_puzzles.open_puzzle_stream(self.config) as stream:
+            write_line_index(stream, csv_path, index_path, build_lichess_puzzles.input_fingerprint(config), stride=500)
+
+        for options in ({}, {"workers": 2}, {"workers": 3, "max_rows": 2222}, {"workers": 2, "stop_when_saturated": True}):
+            with self.subTest(**options):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    expected = build_lichess_puzzles.scan_candidates(replace(self.config, **options))
+                    scan = build_lichess_puzzles.scan_candidates(replace(config, **options))
+                self.assertEqual(scan.candidates, expected.candidates)
+                self.assertEqual(scan.scanned, expected.scanned)
+                self.assertEqual(scan.saturated, expected.saturated)
+
+
+class ProfileBuildTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        archive = write_synthetic_archive(self.root / "synthetic.csv.zst", 3000, seed=2)
+        self.profiles_path = self.root / "profiles.json"
+        self.profiles_path.write_text(json.dumps({"profiles": {
+            "default": {"output_dir": str(self.root / "default")},
+            "bucket100": {"output_dir": str(self.root / "bucket100"), "bucket_size": 100, "min_rating": 900},
+            "extended": {"output_dir": str(self.root / "extended"), "max_plies": 6, "max_piece_count": 9, "candidate_multiplier": 5}
+        }}), encoding="utf-8")
+        self.config = replace(
+            default_config(),
+            input_path=archive,
+            min_popularity=0,
+            min_nb_plays=0,
+            target_per_combo=3,
+            candidate_multiplier=2,
+            seed=5,
+            profiles=self.profiles_path
+        )
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_one_scan_builds_every_profile_like_separate_runs(self) -> None:
+        profiles = build_lichess_puzzles.load_profiles(self.config)
+        self.assertEqual(list(profiles), ["default", "bucket100", "extended"])
+        with contextlib.redirect_stdout(io.StringIO()):
+            built = build_lichess_puzzles.build_profiles(profiles)
+            scans = build_lichess_puzzles.scan_profiles(
+                build_lichess_puzzles.profile_scan_config(list(profiles.values())),
+                list(profiles.values())
+            )
+            for name, profile in profiles.items():
+                build_lichess_puzzles.write_outputs(profile, built[name])
+
+        for (name, profile), scan in zip(profiles.items(), scans):
+            separate_dir = self.root / f"{name}-separate"
+            separate_config = replace(profile, output_dir=separate_dir, profiles=None)
+            with contextlib.redirect_stdout(io.StringIO()):
+                separate_scan = build_lichess_puzzles.scan_candidates(separate_config)
+                selected_by_combo, _ = build_lichess_puzzles.build_dataset(separate_config)
+                build_lichess_puzzles.write_outputs(separate_config, selected_by_combo)
+            self.assertEqual(scan.candidates, separate_scan.candidates, name)
+            self.assertEqual(len(scan.candidates) + sum(scan.rejections.values()), scan.scanned)
+            self.assertEqual(selected_ids(built[name]), selected_ids(selected_by_combo))
+
+            shards = sorted(path.relative_to(separate_dir) for path in separate_dir.rglob("r*.json"))
+            self.assertTrue(shards)
+            self.assertEqual(sorted(path.relative_to(profile.output_dir) for path in profile.output_dir.rglob("r*.json")), shards)
+            for relative in shards:
+                self.assertEqual((profile.output_dir / relative).read_bytes(), (separate_dir / relative).read_bytes())
+
+    def test_profiles_cannot_change_scan_settings(self) -> None:
+        self.profiles_path.write_text(json.dumps({"profiles": {
+            "a": {"output_dir": str(self.root / "a")},
+            "b": {"output_dir": str(self.root / "b"), "workers": 4}
+        }}), encoding="utf-8")
+        with self.assertRaisesRegex(SystemExit, "workers"):
+            build_lichess_puzzles.load_profiles(self.config)
+
+    def test_profiles_are_checked_like_the_cli(self) -> None:
+        cases = {
+            "must be an object of settings": ["not an object"],
+            "target_per_combo must be an integer": {"target_per_combo": "60"},
+            "hash_shards must be true or false": {"hash_shards": 1},
+            "seed must be an integer or null": {"seed": 1.5},
+            "output_dir must be a path string": {"output_dir": 3},
+            "shard_format must be one of json, columnar": {"shard_format": "msgpack"},
+            "--page-size must not be negative": {"page_size": -1},
+            "--stop-when-saturated needs --candidate-pool first": {"candidate_pool": "best", "stop_when_saturated": True}
+        }
+        for message, overrides in cases.items():
+            self.profiles_path.write_text(json.dumps({"profiles": {"bad": overrides}}), encoding="utf-8")
+            with self.assertRaisesRegex(SystemExit, re.escape(f"Profile bad{':' if isinstance(overrides, dict) else ''} {message}")):
+                build_lichess_puzzles.load_profiles(self.config)
+
+        # The global flag applies to every profile, so a best-pool profile cannot inherit it either.
+        self.profiles_path.write_text(json.dumps({"profiles": {"best": {"candidate_pool": "best"}}}), encoding="utf-8")
+        with self.assertRaisesRegex(SystemExit, "Profile best: --stop-when-saturated"):
+            build_lichess_puzzles.load_profiles(replace(self.config, stop_when_saturated=True))
+
+    def test_path_fields_are_read_back_as_paths(self) -> None:
+        hints = typing.get_type_hints(BuilderConfig)
+        self.assertEqual(
+            set(build_lichess_puzzles.PATH_FIELDS),
+            {name for name, hint in hints.items() if hint in (Path, Optional[Path])}
+        )
+
+        self.profiles_path.write_text(json.dumps({"profiles": {
+            "a": {"output_dir": "~/a", "stats_json": str(self.root / "a.json"), "seed": None, "shard_format": "columnar"}
+        }}), encoding="utf-8")
+        profile = build_lichess_puzzles.load_profiles(self.config)["a"]
+        self.assertEqual(profile.output_dir, Path("~/a").expanduser())
+        self.assertEqual(profile.stats_json, self.root / "a.json")
+        self.assertEqual(profile.shard_format, "columnar")
+        self.assertIsNone(profile.seed)
+
+        config = replace(self.config, **{name: self.root / name for name in build_lichess_puzzles.PATH_FIELDS}, input_url="https://example.org/a")
+        restored = build_lichess_puzzles.config_from_json(build_lichess_puzzles.config_as_json(config))
+        self.assertEqual(restored, config)
+        self.assertIsInstance(restored.input_url, str)
+
+
+class ChooseBalancedTests(unittest.TestCase):
+    def assert_same_as_reference(self, pool: Dict[str, List[PuzzleSeed]], target: int, shares: tuple[float, float]) -> None:
+        rng = random.Random(target)
+        reference_rng = random.Random(target)
+        selected = build_lichess_puzzles.choose_balanced(pool, target, *shares, rng)
+        expected = choose_balanced_reference(pool, target, *shares, reference_rng)
+        self.assertEqual([seed.puzzle_id for seed in selected], [seed.puzzle_id for seed in expected])
+        # The next combo must see the same random draws too.
+        self.assertEqual(rng.random(), reference_rng.random())
+
+    def test_matches_sort_and_scan_selector(self) -> None:
+        scenarios = [
+            {motif: 1.0 for motif in build_lichess_puzzles.MOTIF_PRIORITY},
+            {"backrank": 20.0, "mate": 2.0, "fork": 1.0},
+            {"other": 1.0}
+        ]
+        for weights in scenarios:
+            for size in (1, 7, 60, 480):
+                pool = synthetic_pool(size, random.Random(size), weights)
+                for target in sorted({1, size // 6 or 1, size // 2 or 1, size}):
+                    for shares in ((0.2, 0.45), (0.0, 0.1), (1.0, 1.0)):
+                        with self.subTest(weights=weights, size=size, target=target, shares=shares):
+                            self.assert_same_as_reference(pool, target, shares)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,270 @@
+"""Tests for download_lichess_db.py against a local HTTP stand-in for database.lichess.org."""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from typing import Optional
+from unittest import mock
+
+import requests
+import zstandard
+
+import download_lichess_db
+from fixtures import LAST_MODIFIED, ArchiveServer
+
+# Incompressible content keeps the archive larger than a few download chunks.
+CONTENT = os.urandom(3 * download_lichess_db.CHUNK_SIZE + 12345)
+PAYLOAD = zstandard.ZstdCompressor(write_checksum=True).compress(CONTENT)
+
+
+class DownloadTestCase(unittest.TestCase):
+    support_ranges = True
+
+    def setUp(self) -> None:
+        self.server = ArchiveServer(PAYLOAD, support_ranges=self.support_ranges)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/lichess_db_puzzle.csv.zst"
+        self.tmp = tempfile.TemporaryDirectory()
+        self.output = Path(self.tmp.name) / "lichess_db_puzzle.csv.zst"
+        self.part = self.output.with_suffix(self.output.suffix + ".part")
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def download(self, connections: int = 1) -> bool:
+        return download_lichess_db.download(self.url, self.output, connections=connections, show_progress=False)
+
+    def meta(self) -> Optional[download_lichess_db.ArchiveMeta]:
+        return download_lichess_db.load_meta(download_lichess_db.meta_path_for(self.output))
+
+
+class ResumeTests(DownloadTestCase):
+    def test_full_download(self) -> None:
+        self.assertTrue(self.download())
+        self.assertEqual(self.output.read_bytes(), PAYLOAD)
+        self.assertFalse(self.part.exists())
+
+    def test_legacy_file_without_meta_is_verified_and_kept(self) -> None:
+        self.output.write_bytes(PAYLOAD)
+        self.assertFalse(self.download())
+        self.assertEqual(self.server.range_headers, [])
+        self.assertEqual(self.meta().sha256, hashlib.sha256(PAYLOAD).hexdigest())
+
+    def test_resumes_existing_part_file(self) -> None:
+        offset = len(PAYLOAD) // 3
+        self.part.write_bytes(PAYLOAD[:offset])
+        self.assertTrue(self.download())
+        self.assertEqual(self.server.range_headers, [f"bytes={offset}-"])
+        self.assertEqual(self.output.read_bytes(), PAYLOAD)
+
+    def test_dropped_connection_keeps_part_and_next_run_resumes(self) -> None:
+        self.server.fail_after = download_lichess_db.CHUNK_SIZE + 100
+        with self.assertRaises(requests.RequestException):
+            self.download()
+        self.assertTrue(self.part.exists())
+        kept = self.part.stat().st_size
+        self.assertGreater(kept, 0)
+
+        self.assertTrue(self.download())
+        self.assertEqual(self.server.range_headers[-1], f"bytes={kept}-")
+        self.assertEqual(self.output.read_bytes(), PAYLOAD)
+
+
+class ConditionalRequestTests(DownloadTestCase):
+    def test_meta_sidecar_records_validators_and_hash(self) -> None:
+        self.assertTrue(self.download())
+        meta = self.meta()
+        self.assertEqual(meta.etag, '"v1"')
+        self.assertEqual(meta.last_modified, LAST_MODIFIED)
+        self.assertEqual(meta.size, len(PAYLOAD))
+        self.assertEqual(meta.sha256, hashlib.sha256(PAYLOAD).hexdigest())
+
+    def test_unchanged_archive_costs_one_conditional_head(self) -> None:
+        self.assertTrue(self.download())
+        self.server.methods.clear()
+        self.assertFalse(self.download())
+        self.assertEqual(self.server.methods, ["HEAD"])
+
+    def test_unchanged_archive_is_not_hashed_again(self) -> None:
+        self.assertTrue(self.download())
+        self.assertEqual(self.meta().mtime_ns, self.output.stat().st_mtime_ns)
+        with mock.patch.object(download_lichess_db, "verify_archive", side_effect=AssertionError("hashed")):
+            self.assertFalse(self.download())
+
+    def test_touched_archive_is_verified_without_downloading(self) -> None:
+        self.assertTrue(self.download())
+        stat = self.output.stat()
+        os.utime(self.output, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.server.methods.clear()
+        with mock.patch.object(download_lichess_db, "verify_archive", wraps=download_lichess_db.verify_archive) as verify:
+            self.assertFalse(self.download())
+        verify.assert_called_once_with(self.output)
+        # The unconditional HEAD answers 200; no body is fetched.
+        self.assertEqual(self.server.methods, ["HEAD"])
+        self.assertEqual(self.meta().mtime_ns, stat.st_mtime_ns + 10 ** 9)
+
+    def test_sidecar_without_mtime_is_verified_once(self) -> None:
+        self.assertTrue(self.download())
+        meta_path = download_lichess_db.meta_path_for(self.output)
+        legacy = json.loads(meta_path.read_text(encoding="utf-8"))
+        del legacy["mtime_ns"]
+        meta_path.write_text(json.dumps(legacy), encoding="utf-8")
+        self.assertIsNone(self.meta().mtime_ns)
+        self.assertFalse(self.download())
+        self.assertEqual(self.meta().mtime_ns, self.output.stat().st_mtime_ns)
+
+    def test_rewritten_archive_with_the_same_size_is_downloaded_again(self) -> None:
+        self.assertTrue(self.download())
+        other = zstandard.ZstdCompressor(write_checksum=True).compress(CONTENT[::-1])
+        self.assertEqual(len(other), len(PAYLOAD))
+        self.output.write_bytes(other)
+        self.assertTrue(self.download())
+        self.assertEqual(self.output.read_bytes(), PAYLOAD)
+
+    def test_new_release_is_downloaded(self) -> None:
+        self.assertTrue(self.download())
+        self.server.etag = '"v2"'
+        self.server.payload = zstandard.ZstdCompressor(write_checksum=True).compress(b"PuzzleId,FEN\n")
+        self.assertTrue(self.download())
+        self.assertEqual(self.output.read_bytes(), self.server.payload)
+        self.assertEqual(self.meta().etag, '"v2"')
+
+    def test_corrupted_local_archive_is_downloaded_again(self) -> None:
+        self.assertTrue(self.download())
+        corrupted = bytearray(PAYLOAD)
+        corrupted[len(corrupted) // 2] ^= 0xFF
+        self.output.write_bytes(bytes(corrupted))
+        self.assertTrue(self.download())
+        self.assertEqual(self.output.read_bytes(), PAYLOAD)
+
+    def test_part_file_from_old_release_is_not_resumed(self) -> None:
+        self.server.fail_after = download_lichess_db.CHUNK_SIZE + 100
+        with self.assertRaises(requests.RequestException):
+            self.download()
+        self.assertTrue(self.part.exists())
+
+        self.server.etag = '"v2"'
+        self.server.payload = zstandard.ZstdCompressor(write_checksum=True).compress(PAYLOAD)
+        self.assertTrue(self.download())
+        self.assertEqual(self.server.range_headers[-1], None)
+        self.assertEqual(self.output.read_bytes(), self.server.payload)
+
+
+class VerificationTests(DownloadTestCase):
+    def test_corrupt_download_is_rejected_and_output_kept(self) -> None:
+        self.output.write_bytes(b"previous archive")
+        corrupted = bytearray(PAYLOAD)
+        corrupted[len(corrupted) // 2] ^= 0xFF
+        self.server.payload = bytes(corrupted)
+        with self.assertRaises(download_lichess_db.ArchiveVerificationError):
+            self.download()
+        self.assertEqual(self.output.read_bytes(), b"previous archive")
+        self.assertFalse(self.part.exists())
+
+    def test_truncated_archive_is_rejected(self) -> None:
+        path = Path(self.tmp.name) / "truncated.zst"
+        path.write_bytes(PAYLOAD[:-10])
+        with self.assertRaises(download_lichess_db.ArchiveVerificationError):
+            download_lichess_db.verify_archive(path)
+
+    def test_multi_frame_archive_is_accepted(self) -> None:
+        path = Path(self.tmp.name) / "frames.zst"
+        second = zstandard.ZstdCompressor(write_checksum=True).compress(b"more rows\n")
+        path.write_bytes(PAYLOAD + second)
+        self.assertEqual(download_lichess_db.verify_archive(path), hashlib.sha256(PAYLOAD + second).hexdigest())
+
+
+class StreamTests(DownloadTestCase):
+    def test_stream_decompresses_while_downloading(self) -> None:
+        with download_lichess_db.stream_archive(self.url) as compressed:
+            with zstandard.ZstdDecompressor().stream_reader(compressed) as reader:
+                self.assertEqual(reader.read(), CONTENT)
+        self.assertFalse(self.output.exists())
+
+    def test_tee_leaves_a_verified_archive(self) -> None:
+        with download_lichess_db.stream_archive(self.url, self.output) as compressed:
+            compressed.read(100)
+        self.assertEqual(self.output.read_bytes(), PAYLOAD)
+        self.assertEqual(self.meta().sha256, hashlib.sha256(PAYLOAD).hexdigest())
+        self.assertFalse(self.part.exists())
+
+        self.server.methods.clear()
+        self.assertFalse(self.download())
+        self.assertEqual(self.server.methods, ["HEAD"])
+
+    def test_interrupted_tee_is_resumed_by_download(self) -> None:
+        self.server.fail_after = download_lichess_db.CHUNK_SIZE + 100
+        with self.assertRaises(requests.RequestException):
+            with download_lichess_db.stream_archive(self.url, self.output) as compressed:
+                compressed.read()
+        self.assertFalse(self.output.exists())
+        kept = self.part.stat().st_size
+
+        self.assertTrue(self.download())
+        self.assertEqual(self.server.range_headers[-1], f"bytes={kept}-")
+        self.assertEqual(self.output.read_bytes(), PAYLOAD)
+
+
+class ParallelTests(DownloadTestCase):
+    def test_parallel_ranges(self) -> None:
+        self.assertTrue(self.download(connections=4))
+        self.assertEqual(self.output.read_bytes(), PAYLOAD)
+        self.assertEqual(len(self.server.range_headers), 4)
+        self.assertTrue(all(header and header.startswith("bytes=") for header in self.server.range_headers))
+        self.assertFalse(download_lichess_db.segments_path_for(self.part).exists())
+
+    def test_parallel_resume_after_dropped_segment(self) -> None:
+        self.server.fail_after = download_lichess_db.CHUNK_SIZE // 2
+        with self.assertRaises(requests.RequestException):
+            self.download(connections=3)
+        self.assertTrue(download_lichess_db.segments_path_for(self.part).exists())
+        first_run_requests = len(self.server.range_headers)
+
+        self.assertTrue(self.download(connections=3))
+        self.assertEqual(self.output.read_bytes(), PAYLOAD)
+        # Only the interrupted segment is fetched again.
+        self.assertEqual(len(self.server.range_headers) - first_run_requests, 1)
+
+    def test_segment_progress_is_saved_in_batches(self) -> None:
+        with mock.patch.object(download_lichess_db, "save_segments", wraps=download_lichess_db.save_segments) as save:
+            self.assertTrue(self.download(connections=2))
+        # The plan, then once per finished segment: the payload is below SEGMENTS_SAVE_BYTES.
+        self.assertEqual(save.call_count, 3)
+
+        self.output.unlink()
+        self.server.fail_after = download_lichess_db.CHUNK_SIZE + 100
+        with self.assertRaises(requests.RequestException):
+            self.download(connections=2)
+        segments = download_lichess_db.load_segments(download_lichess_db.segments_path_for(self.part), len(PAYLOAD))
+        # Progress made before the dropped connection is saved when the download stops.
+        self.assertTrue(any(0 < segment.done < segment.end - segment.start + 1 for segment in segments))
+
+    def test_parallel_continues_single_connection_part(self) -> None:
+        offset = len(PAYLOAD) // 2
+        self.part.write_bytes(PAYLOAD[:offset])
+        self.assertTrue(self.download(connections=2))
+        self.assertEqual(self.output.read_bytes(), PAYLOAD)
+        starts = sorted(int(header.split("=")[1].split("-")[0]) for header in self.server.range_headers)
+        self.assertEqual(starts[0], offset)
+
+
+class NoRangeSupportTests(DownloadTestCase):
+    support_ranges = False
+
+    def test_part_file_is_restarted_without_range_support(self) -> None:
+        self.part.write_bytes(b"stale bytes")
+        self.assertTrue(self.download(connections=4))
+        self.assertEqual(self.output.read_bytes(), PAYLOAD)
+
+
+if __name__ == "__main__":
+    unittest.main()
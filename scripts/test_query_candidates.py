@@ -0,0 +1,129 @@
+"""Tests for the SQLite candidate store and query_candidates.py."""
+
+from __future__ import annotations
+
+import contextlib
+import io
+import json
+import tempfile
+import unittest
+from collections import Counter
+from dataclasses import replace
+from pathlib import Path
+from unittest import mock
+
+import build_lichess_puzzles
+import query_candidates
+from fixtures import default_config
+from query_candidates import CandidateFilter
+from synthetic_puzzles import write_synthetic_archive
+
+
+class CandidateStoreTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        archive = write_synthetic_archive(self.root / "synthetic.csv.zst", 2000, seed=4)
+        self.db_path = self.root / "candidates.sqlite"
+        self.config = replace(
+            default_config(),
+            input_path=archive,
+            output_dir=self.root / "built",
+            min_popularity=0,
+            min_nb_plays=0,
+            target_per_combo=3,
+            candidate_multiplier=3,
+            seed=11,
+            candidate_db=self.db_path
+        )
+        with contextlib.redirect_stdout(io.StringIO()):
+            selected_by_combo, _ = build_lichess_puzzles.build_dataset(self.config)
+            build_lichess_puzzles.write_outputs(self.config, selected_by_combo)
+            self.scan = build_lichess_puzzles.scan_candidates(self.config)
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_store_holds_every_candidate_in_acceptance_order(self) -> None:
+        connection = query_candidates.open_store(self.db_path)
+        try:
+            stored = query_candidates.load_candidates(connection, CandidateFilter())
+            self.assertEqual(stored, self.scan.candidates)
+            self.assertEqual(query_candidates.stored_config(connection), self.config)
+
+            pins = query_candidates.load_candidates(connection, CandidateFilter(piece_counts=[6], themes=["pin"]))
+            expected = [seed for seed in self.scan.candidates if seed.piece_count == 6 and "pin" in seed.themes]
+            self.assertEqual(pins, expected)
+
+            counts = query_candidates.count_candidates(connection, CandidateFilter(motifs=["fork"]), ["piece"])
+            for piece_count, count in counts:
+                self.assertEqual(count, sum(1 for seed in self.scan.candidates if seed.motif == "fork" and seed.piece_count == piece_count))
+        finally:
+            connection.close()
+
+    def test_count_reports_the_combo_cap(self) -> None:
+        capped_db = self.root / "capped.sqlite"
+        capped = replace(self.config, candidate_db=capped_db, candidate_multiplier=1)
+        with contextlib.redirect_stdout(io.StringIO()):
+            build_lichess_puzzles.build_dataset(capped)
+            scan = build_lichess_puzzles.scan_candidates(capped)
+        combos = Counter((seed.piece_count, seed.rating_bucket) for seed in scan.candidates)
+        full = sum(1 for count in combos.values() if count >= scan.combo_cap)
+        self.assertGreater(full, 0)
+
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            query_candidates.main(["--db", str(capped_db), "count", "--group-by", ""])
+        self.assertEqual(stdout.getvalue(), f"{len(scan.candidates)}\n")
+        self.assertIn(f"at most {scan.combo_cap} per piece count and rating bucket", stderr.getvalue())
+        self.assertIn(f"{full} combos reached that cap", stderr.getvalue())
+
+    def test_shards_regenerate_without_the_archive(self) -> None:
+        self.config.input_path.unlink()
+        output_dir = self.root / "regenerated"
+        with contextlib.redirect_stdout(io.StringIO()):
+            query_candidates.main(["--db", str(self.db_path), "shards", "--output", str(output_dir)])
+
+        built = sorted(path.relative_to(self.config.output_dir) for path in self.config.output_dir.rglob("r*.json"))
+        regenerated = sorted(path.relative_to(output_dir) for path in output_dir.rglob("r*.json"))
+        self.assertTrue(built)
+        self.assertEqual(regenerated, built)
+        for relative in built:
+            self.assertEqual((output_dir / relative).read_bytes(), (self.config.output_dir / relative).read_bytes())
+
+        export_path = self.root / "forks.json"
+        with contextlib.redirect_stderr(io.StringIO()):
+            query_candidates.main(["--db", str(self.db_path), "export", "--motif", "fork", "--limit", "5", "--output", str(export_path)])
+        exported = json.loads(export_path.read_text(encoding="utf-8"))
+        self.assertLessEqual(len(exported), 5)
+        self.assertTrue(all(build_lichess_puzzles.motif_for(entry["themes"]) == "fork" for entry in exported))
+
+    def test_shard_layout_flags_default_to_the_stored_build(self) -> None:
+        hashed_db = self.root / "hashed.sqlite"
+        hashed = replace(self.config, candidate_db=hashed_db, hash_shards=True, precompress=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            build_lichess_puzzles.build_dataset(hashed)
+
+        def layout(db_path: Path, *flags: str) -> tuple[bool, bool]:
+            connection = query_candidates.open_store(db_path)
+            try:
+                args = query_candidates.parse_args(["--db", str(db_path), "shards", *flags])
+                config = query_candidates.shard_config(connection, args)
+            finally:
+                connection.close()
+            return config.hash_shards, config.precompress
+
+        self.assertEqual(layout(self.db_path), (False, False))
+        self.assertEqual(layout(self.db_path, "--hash-shards", "--precompress"), (True, True))
+        self.assertEqual(layout(hashed_db), (True, True))
+        self.assertEqual(layout(hashed_db, "--no-precompress"), (True, False))
+        self.assertEqual(layout(hashed_db, "--no-hash-shards", "--no-precompress"), (False, False))
+
+        with mock.patch.object(build_lichess_puzzles, "brotli", None):
+            with self.assertRaisesRegex(SystemExit, "--no-precompress"):
+                query_candidates.main(["--db", str(hashed_db), "shards", "--output", str(self.root / "no-brotli")])
+        self.assertFalse((self.root / "no-brotli").exists())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+"""Tests for the synthetic puzzle archive generator."""
+
+from __future__ import annotations
+
+import contextlib
+import io
+import tempfile
+import unittest
+from dataclasses import replace
+from pathlib import Path
+
+import build_lichess_puzzles
+from fixtures import default_config
+from synthetic_puzzles import PuzzleMix, write_synthetic_archive
+
+
+class SyntheticArchiveTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_same_seed_gives_same_bytes(self) -> None:
+        first = write_synthetic_archive(self.root / "a.csv.zst", 300, seed=5)
+        second = write_synthetic_archive(self.root / "b.csv.zst", 300, seed=5)
+        other = write_synthetic_archive(self.root / "c.csv.zst", 300, seed=6)
+        self.assertEqual(first.read_bytes(), second.read_bytes())
+        self.assertNotEqual(first.read_bytes(), other.read_bytes())
+
+    def test_builder_accepts_valid_rows_and_rejects_bad_ones(self) -> None:
+        mix = PuzzleMix(piece_counts={4: 1.0, 6: 1.0, 20: 1.0}, malformed_rate=0.05, illegal_rate=0.05)
+        archive = write_synthetic_archive(self.root / "synthetic.csv.zst", 3000, seed=1, mix=mix)
+        config = replace(default_config(), input_path=archive, min_popularity=0, min_nb_plays=0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            scan = build_lichess_puzzles.scan_candidates(config)
+
+        self.assertEqual(scan.scanned, 3000)
+        self.assertGreater(len(scan.candidates), 100)
+        for stage in ("fields", "fen_prefilter", "board", "line"):
+            self.assertGreater(scan.rejections[stage], 0, stage)
+        self.assertTrue(all(3 <= seed.piece_count <= 8 for seed in scan.candidates))
+
+
+if __name__ == "__main__":
+    unittest.main()
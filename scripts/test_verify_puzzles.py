@@ -0,0 +1,94 @@
+"""Tests for verify_puzzles.py on freshly built and then damaged puzzle trees."""
+
+from __future__ import annotations
+
+import contextlib
+import io
+import json
+import tempfile
+import unittest
+from dataclasses import replace
+from pathlib import Path
+
+import build_lichess_puzzles
+import verify_puzzles
+from fixtures import default_config
+from synthetic_puzzles import write_synthetic_archive
+
+
+class VerifyTreeTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        archive = write_synthetic_archive(self.root / "synthetic.csv.zst", 1500, seed=3)
+        self.config = replace(
+            default_config(),
+            input_path=archive,
+            output_dir=self.root / "puzzles",
+            min_popularity=0,
+            min_nb_plays=0,
+            target_per_combo=4,
+            candidate_multiplier=1,
+            seed=5
+        )
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def build(self, **options: object) -> Path:
+        config = replace(self.config, **options)
+        with contextlib.redirect_stdout(io.StringIO()):
+            selected_by_combo, _ = build_lichess_puzzles.build_dataset(config)
+            build_lichess_puzzles.write_outputs(config, selected_by_combo)
+        return config.output_dir
+
+    def test_built_trees_verify_in_every_layout(self) -> None:
+        for options in ({}, {"shard_format": "columnar"}, {"hash_shards": True, "precompress": True, "page_size": 3}):
+            with self.subTest(**options):
+                output_dir = self.build(**options)
+                report = verify_puzzles.verify_tree(output_dir, workers=2)
+                self.assertEqual(report["mismatches"], [])
+                self.assertTrue(report["ok"])
+                manifest = json.loads((output_dir / "manifest.json").read_text(encoding="utf-8"))
+                self.assertEqual(report["puzzles"], manifest["totalCount"])
+
+    def test_damaged_shards_are_reported_by_check(self) -> None:
+        output_dir = self.build(precompress=True)
+        manifest = json.loads((output_dir / "manifest.json").read_text(encoding="utf-8"))
+        key = max(manifest["countsByCombo"], key=manifest["countsByCombo"].get)
+        piece_count, rating_bucket = (int(part[1:]) for part in key.split("-"))
+        shard_path = output_dir / manifest["shardPattern"].format(pieceCount=piece_count, ratingBucket=rating_bucket)
+        relative = shard_path.relative_to(output_dir).as_posix()
+        entries = json.loads(shard_path.read_text(encoding="utf-8"))
+        self.assertGreater(len(entries), 1)
+        first, second = entries[0], entries[-1]
+        first["sideToMove"] = "b" if first["sideToMove"] == "w" else "w"
+        first["continuationText"] += " ?"
+        second["continuationSan"] = ["Ka9", *second["continuationSan"][1:]]
+        shard_path.write_text(json.dumps(entries), encoding="utf-8")
+        (output_dir / "lichess" / "stray.json").write_text("[]", encoding="utf-8")
+
+        report = verify_puzzles.verify_tree(output_dir)
+        self.assertFalse(report["ok"])
+        found = {(mismatch["check"], mismatch.get("puzzleId")) for mismatch in report["mismatches"]}
+        self.assertIn(("sideToMove", first["puzzleId"]), found)
+        self.assertIn(("continuationText", first["puzzleId"]), found)
+        self.assertIn(("continuationSan", second["puzzleId"]), found)
+        self.assertIn(("sibling", None), found)
+        self.assertIn(("unlisted", None), found)
+        self.assertTrue(all(mismatch["path"] for mismatch in report["mismatches"]))
+
+        # Dropping a puzzle from the shard breaks the manifest counts.
+        shard_path.write_text(json.dumps(entries[1:]), encoding="utf-8")
+        checks = {mismatch["check"] for mismatch in verify_puzzles.verify_tree(output_dir)["mismatches"]}
+        self.assertIn("countsByCombo", checks)
+        self.assertIn("totalCount", checks)
+
+        with contextlib.redirect_stdout(io.StringIO()) as stdout, contextlib.redirect_stderr(io.StringIO()):
+            with self.assertRaises(SystemExit):
+                verify_puzzles.main(["--dir", str(output_dir), "--workers", "1"])
+        self.assertIn(relative, {mismatch["path"] for mismatch in json.loads(stdout.getvalue())["mismatches"]})
+
+
+if __name__ == "__main__":
+    unittest.main()
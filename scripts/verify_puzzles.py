@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+"""Check that a built puzzle tree (manifest, shards, siblings, facets) is internally consistent.
+
+Every puzzle is replayed with python-chess: its ``fen`` must give its piece
+lists and side to move, and ``continuationSan`` must be legal from ``fen`` and
+render to ``continuationText``. Shards are checked in parallel; mismatches are
+printed as a JSON report and make the exit status non-zero.
+"""
+
+from __future__ import annotations
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import chess
+import zstandard
+
+import build_lichess_puzzles
+from build_lichess_puzzles import (
+    MANIFEST_VERSION,
+    PRECOMPRESSED_SUFFIXES,
+    PREVIOUS_MANIFEST_NAME,
+    PUZZLE_SOURCE,
+    manifest_files,
+    numbered_line,
+    tokenise_pieces
+)
+
+REPORT_VERSION = 1
+
+Mismatch = Dict[str, object]
+
+
+def mismatch(check: str, path: Optional[str], message: str, puzzle_id: Optional[str] = None) -> Mismatch:
+    found: Mismatch = {"check": check, "path": path, "message": message}
+    if puzzle_id is not None:
+        found["puzzleId"] = puzzle_id
+    return found
+
+
+@dataclass(frozen=True)
+class ShardTask:
+    """One shard (or page) file and what the manifest says about it."""
+
+    output_dir: Path
+    path: str
+    combo: str
+    shard_format: str
+    max_plies: int
+    # The manifest entry from "shards" or "pages"; empty for shardPattern trees.
+    entry: Dict[str, object] = field(default_factory=dict)
+
+
+@dataclass
+class ShardResult:
+    path: str
+    combo: str
+    puzzle_ids: List[str]
+    mismatches: List[Mismatch]
+
+
+def verify_puzzle(entry: Dict[str, object], piece_count: int, rating_bucket: int, max_plies: int, path: str) -> List[Mismatch]:
+    """Replay one shard entry; every field that follows from ``fen`` and ``continuationSan`` must match."""
+    puzzle_id = str(entry.get("puzzleId"))
+    found: List[Mismatch] = []
+
+    def check(name: str, expected: object, actual: object) -> None:
+        if expected != actual:
+            found.append(mismatch(name, path, f"expected {expected!r}, found {actual!r}", puzzle_id))
+
+    fen = entry.get("fen")
+    try:
+        board = chess.Board(fen)
+    except (TypeError, ValueError) as error:
+        return [mismatch("fen", path, f"unreadable FEN {fen!r}: {error}", puzzle_id)]
+    check("pieceCount", piece_count, entry.get("pieceCount"))
+    check("pieceCount", piece_count, chess.popcount(board.occupied))
+    check("ratingBucket", rating_bucket, entry.get("ratingBucket"))
+    check("sideToMove", "w" if board.turn == chess.WHITE else "b", entry.get("sideToMove"))
+    white_pieces, black_pieces = tokenise_pieces(board)
+    check("whitePieces", white_pieces, entry.get("whitePieces"))
+    check("blackPieces", black_pieces, entry.get("blackPieces"))
+    check("source", PUZZLE_SOURCE, entry.get("source"))
+
+    san_line = entry.get("continuationSan")
+    if not isinstance(san_line, list) or not 0 < len(san_line) <= max_plies:
+        found.append(mismatch("continuationSan", path, f"expected 1..{max_plies} moves, found {san_line!r}", puzzle_id))
+        return found
+    move_number, turn = board.fullmove_number, board.turn
+    for index, san in enumerate(san_line):
+        try:
+            move = board.parse_san(san)
+        except ValueError as error:
+            found.append(mismatch("continuationSan", path, f"move {index + 1} {san!r} is not legal: {error}", puzzle_id))
+            return found
+        # parse_san also takes loose spellings ("Nbd2", missing "+"); the shard must hold the canonical one.
+        canonical = board.san_and_push(move)
+        if canonical != san:
+            found.append(mismatch("continuationSan", path, f"move {index + 1} {san!r} should be written {canonical!r}", puzzle_id))
+    check("continuationText", numbered_line(move_number, turn, san_line), entry.get("continuationText"))
+    return found
+
+
+def shard_entries(data: bytes, shard_format: str, piece_count: int, rating_bucket: int) -> List[Dict[str, object]]:
+    payload = json.loads(data)
+    if shard_format == "columnar":
+        # Decoding rebuilds the derived fields, so only fen, SAN and themes are really checked.
+        return build_lichess_puzzles.decode_columnar_shard(payload, piece_count, rating_bucket)
+    if not isinstance(payload, list):
+        raise ValueError("shard is not a JSON array")
+    return payload
+
+
+def decoded_sibling(suffix: str, encoded: bytes) -> Optional[bytes]:
+    if suffix == "gz":
+        return gzip.decompress(encoded)
+    if suffix == "zst":
+        return zstandard.ZstdDecompressor().decompress(encoded)
+    if build_lichess_puzzles.brotli is not None:
+        return build_lichess_puzzles.brotli.decompress(encoded)
+    return None
+
+
+def verify_file(task_path: str, file_path: Path, entry: Dict[str, object]) -> tuple[Optional[bytes], List[Mismatch]]:
+    """Read a listed file; check its size, hash and precompressed siblings against the manifest entry."""
+    try:
+        data = file_path.read_bytes()
+    except OSError as error:
+        return None, [mismatch("missing", task_path, f"cannot read: {error}")]
+    found: List[Mismatch] = []
+    if "bytes" in entry and entry["bytes"] != len(data):
+        found.append(mismatch("bytes", task_path, f"expected {entry['bytes']} bytes, found {len(data)}"))
+    if "sha256" in entry:
+        digest = hashlib.sha256(data).hexdigest()
+        if entry["sha256"] != digest:
+            found.append(mismatch("sha256", task_path, f"expected {entry['sha256']}, found {digest}"))
+    encoded_bytes = entry.get("encodedBytes") or {}
+    for suffix in PRECOMPRESSED_SUFFIXES:
+        sibling = file_path.with_name(f"{file_path.name}.{suffix}")
+        if not sibling.exists():
+            if suffix in encoded_bytes:
+                found.append(mismatch("sibling", f"{task_path}.{suffix}", "listed in encodedBytes but missing"))
+            continue
+        encoded = sibling.read_bytes()
+        if suffix in encoded_bytes and encoded_bytes[suffix] != len(encoded):
+            found.append(mismatch("sibling", f"{task_path}.{suffix}", f"expected {encoded_bytes[suffix]} bytes, found {len(encoded)}"))
+        try:
+            decoded = decoded_sibling(suffix, encoded)
+        except Exception as error:  # gzip, zstandard and brotli raise their own error types.
+            found.append(mismatch("sibling", f"{task_path}.{suffix}", f"does not decode: {error}"))
+            continue
+        if decoded is not None and decoded != data:
+            found.append(mismatch("sibling", f"{task_path}.{suffix}", "does not decode to the file it sits next to"))
+    return data, found
+
+
+def verify_shard(task: ShardTask) -> ShardResult:
+    piece_count, rating_bucket = (int(part[1:]) for part in task.combo.split("-"))
+    result = ShardResult(path=task.path, combo=task.combo, puzzle_ids=[], mismatches=[])
+    data, result.mismatches = verify_file(task.path, task.output_dir / task.path, task.entry)
+    if data is None:
+        return result
+    try:
+        entries = shard_entries(data, task.shard_format, piece_count, rating_bucket)
+    except (ValueError, KeyError, TypeError) as error:
+        result.mismatches.append(mismatch("format", task.path, f"not a {task.shard_format} shard: {error}"))
+        return result
+    if "puzzles" in task.entry and task.entry["puzzles"] != len(entries):
+        result.mismatches.append(mismatch("count", task.path, f"page lists {task.entry['puzzles']} puzzles, holds {len(entries)}"))
+    for entry in entries:
+        result.puzzle_ids.append(str(entry.get("puzzleId")))
+        result.mismatches.extend(verify_puzzle(entry, piece_count, rating_bucket, task.max_plies, task.path))
+    return result
+
+
+def shard_tasks(output_dir: Path, manifest: Dict[str, object], found: List[Mismatch]) -> List[ShardTask]:
+    """Every shard file the manifest names, in combo order."""
+    shard_format = str(manifest.get("shardFormat", "json"))
+    max_plies = int(manifest.get("maxContinuationPlies", 0))
+    counts_by_combo: Dict[str, int] = manifest.get("countsByCombo", {})
+    listed: Dict[str, List[Dict[str, object]]] = {}
+    if "pages" in manifest:
+        listed = manifest["pages"]
+    elif "shards" in manifest:
+        listed = {key: [entry] for key, entry in manifest["shards"].items()}
+    else:
+        pattern = str(manifest.get("shardPattern", ""))
+        for key in counts_by_combo:
+            piece_count, rating_bucket = (int(part[1:]) for part in key.split("-"))
+            listed[key] = [{"path": pattern.format(pieceCount=piece_count, ratingBucket=rating_bucket)}]
+    if set(listed) != set(counts_by_combo):
+        found.append(mismatch(
+            "countsByCombo",
+            "manifest.json",
+            f"combos with counts {sorted(counts_by_combo)} differ from combos with shards {sorted(listed)}"
+        ))
+
+    tasks: List[ShardTask] = []
+    for key, entries in sorted(listed.items()):
+        for entry in entries:
+            tasks.append(ShardTask(
+                output_dir=output_dir,
+                path=str(entry["path"]),
+                combo=key,
+                shard_format=shard_format,
+                max_plies=max_plies,
+                entry={name: value for name, value in entry.items() if name != "path"}
+            ))
+    return tasks
+
+
+def verify_facets(output_dir: Path, manifest: Dict[str, object], combo_ids: Dict[str, List[str]]) -> List[Mismatch]:
+    entry = manifest.get("facets")
+    if not isinstance(entry, dict):
+        return []
+    path = str(entry["path"])
+    data, found = verify_file(path, output_dir / path, entry)
+    if data is None:
+        return found
+    combos = json.loads(data).get("combos", {})
+    counts_by_combo: Dict[str, int] = manifest.get("countsByCombo", {})
+    for key, count in counts_by_combo.items():
+        combo = combos.get(key)
+        if combo is None:
+            found.append(mismatch("facets", path, f"no facets for {key}"))
+            continue
+        motif_total = sum(combo.get("motifCounts", {}).values())
+        if motif_total != count:
+            found.append(mismatch("facets", path, f"{key}: motifCounts add up to {motif_total}, countsByCombo has {count}"))
+        held = len(combo_ids.get(key, ()))
+        for facet in ("motifs", "themes"):
+            for name, offsets in combo.get(facet, {}).items():
+                if any(not 0 <= offset < held for offset in offsets):
+                    found.append(mismatch("facets", path, f"{key}: {facet} {name!r} points past the {held} puzzles held"))
+    return found
+
+
+def unlisted_files(output_dir: Path, listed: Sequence[str]) -> List[Mismatch]:
+    """Files under lichess/ that no manifest entry (or its siblings) names."""
+    known = set(listed)
+    known.update(f"{path}.{suffix}" for path in listed for suffix in PRECOMPRESSED_SUFFIXES)
+    lichess_dir = output_dir / "lichess"
+    found: List[Mismatch] = []
+    for path in sorted(lichess_dir.rglob("*")):
+        relative = path.relative_to(output_dir).as_posix()
+        if path.is_file() and relative not in known:
+            found.append(mismatch("unlisted", relative, "not named by manifest.json"))
+    return found
+
+
+def verify_tree(output_dir: Path, workers: int = 1) -> Dict[str, object]:
+    """Check ``output_dir`` and return the report; ``ok`` is true when nothing mismatched."""
+    started = time.perf_counter()
+    found: List[Mismatch] = []
+    report: Dict[str, object] = {"version": REPORT_VERSION, "outputDir": output_dir.as_posix()}
+    try:
+        manifest = json.loads((output_dir / "manifest.json").read_text(encoding="utf-8"))
+    except (OSError, ValueError) as error:
+        found.append(mismatch("manifest", "manifest.json", f"cannot read: {error}"))
+        return {**report, "ok": False, "shards": 0, "puzzles": 0, "mismatches": found}
+    if manifest.get("version") != MANIFEST_VERSION:
+        found.append(mismatch("manifest", "manifest.json", f"expected version {MANIFEST_VERSION}, found {manifest.get('version')!r}"))
+
+    tasks = shard_tasks(output_dir, manifest, found)
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+            results = list(pool.map(verify_shard, tasks))
+    else:
+        results = [verify_shard(task) for task in tasks]
+
+    combo_ids: Dict[str, List[str]] = defaultdict(list)
+    seen: Dict[str, str] = {}
+    for result in results:
+        found.extend(result.mismatches)
+        combo_ids[result.combo].extend(result.puzzle_ids)
+        for puzzle_id in result.puzzle_ids:
+            first = seen.setdefault(puzzle_id, result.path)
+            if first != result.path:
+                found.append(mismatch("duplicate", result.path, f"also in {first}", puzzle_id))
+
+    counts_by_combo: Dict[str, int] = manifest.get("countsByCombo", {})
+    for key, count in sorted(counts_by_combo.items()):
+        if len(combo_ids[key]) != count:
+            found.append(mismatch("countsByCombo", "manifest.json", f"{key}: expected {count} puzzles, shards hold {len(combo_ids[key])}"))
+    total = sum(len(ids) for ids in combo_ids.values())
+    if manifest.get("totalCount") != total:
+        found.append(mismatch("totalCount", "manifest.json", f"expected {manifest.get('totalCount')!r}, shards hold {total}"))
+    combos = [tuple(int(part[1:]) for part in key.split("-")) for key in counts_by_combo]
+    for name, values in (("pieceCounts", {combo[0] for combo in combos}), ("ratingBuckets", {combo[1] for combo in combos})):
+        if manifest.get(name) != sorted(values):
+            found.append(mismatch(name, "manifest.json", f"expected {sorted(values)}, found {manifest.get(name)!r}"))
+
+    found.extend(verify_facets(output_dir, manifest, combo_ids))
+    listed = [task.path for task in tasks]
+    if isinstance(manifest.get("facets"), dict):
+        listed.append(str(manifest["facets"]["path"]))
+    # The files of the previous generation stay until the next build.
+    previous_path = output_dir / PREVIOUS_MANIFEST_NAME
+    if previous_path.exists():
+        try:
+            listed.extend(manifest_files(json.loads(previous_path.read_text(encoding="utf-8"))))
+        except ValueError as error:
+            found.append(mismatch("manifest", PREVIOUS_MANIFEST_NAME, f"cannot read: {error}"))
+    found.extend(unlisted_files(output_dir, listed))
+
+    return {
+        **report,
+        "ok": not found,
+        "shards": len(tasks),
+        "puzzles": total,
+        "seconds": round(time.perf_counter() - started, 3),
+        "mismatches": found
+    }
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Verify a built puzzle tree by replaying every shard with python-chess")
+    parser.add_argument("--dir", default="public/puzzles", help="Output directory of build_lichess_puzzles.py")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Processes replaying shards (1 = in process)")
+    parser.add_argument("--output", default=None, help="Write the JSON report here (default: stdout)")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    args = parse_args(argv)
+    report = verify_tree(Path(args.dir).expanduser(), max(1, args.workers))
+    data = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output is None:
+        print(data)
+    else:
+        Path(args.output).expanduser().write_text(data + "\n", encoding="utf-8")
+    mismatches = report["mismatches"]
+    print(
+        f"Verified {report['puzzles']} puzzles in {report['shards']} shards: "
+        f"{len(mismatches) if mismatches else 'no'} mismatches",
+        file=sys.stderr
+    )
+    if mismatches:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
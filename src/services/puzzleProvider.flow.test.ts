@@ -144,6 +144,120 @@ describe("getNextPuzzle static-db flow", () => {
     expect(fetchSpy).toHaveBeenCalledTimes(2);
   });
 
+  it("loads content-hashed shards listed in the manifest", async () => {
+    const hashedPath = "lichess/p4/r1200.0123456789abcdef.json";
+    const fetchSpy = vi.spyOn(globalThis, "fetch");
+    fetchSpy.mockImplementation(async (input) => {
+      const url = String(input);
+      if (url.endsWith("/puzzles/manifest.json")) {
+        const manifest = {
+          ...MANIFEST,
+          shards: {
+            "p4-r1200": { path: hashedPath, sha256: "0123456789abcdef".repeat(4), bytes: 512 }
+          }
+        };
+        return new Response(JSON.stringify(manifest), {
+          status: 200,
+          headers: { "content-type": "application/json" }
+        });
+      }
+      if (url.endsWith(`/puzzles/${hashedPath}`)) {
+        return new Response(JSON.stringify(SHARD_P4_R1200), {
+          status: 200,
+          headers: { "content-type": "application/json" }
+        });
+      }
+      return new Response("not found", { status: 404 });
+    });
+    vi.spyOn(Math, "random").mockReturnValue(0);
+
+    const seed = await getNextPuzzle(SETTINGS);
+
+    expect(seed.puzzleId).toBe("p-1");
+    expect(String(fetchSpy.mock.calls[1][0])).toContain(hashedPath);
+  });
+
+  it("fetches a single page of a paged combo", async () => {
+    const pagePaths = ["lichess/p4/r1200.p0.json", "lichess/p4/r1200.p1.json"];
+    const fetchSpy = vi.spyOn(globalThis, "fetch");
+    fetchSpy.mockImplementation(async (input) => {
+      const url = String(input);
+      if (url.endsWith("/puzzles/manifest.json")) {
+        const manifest = {
+          ...MANIFEST,
+          shardPattern: "lichess/p{pieceCount}/r{ratingBucket}.p{page}.json",
+          pageSize: 1,
+          pages: {
+            "p4-r1200": pagePaths.map((path) => ({ path, sha256: "0".repeat(64), bytes: 256, puzzles: 1 }))
+          }
+        };
+        return new Response(JSON.stringify(manifest), {
+          status: 200,
+          headers: { "content-type": "application/json" }
+        });
+      }
+      const page = pagePaths.findIndex((path) => url.endsWith(`/puzzles/${path}`));
+      if (page >= 0) {
+        return new Response(JSON.stringify([SHARD_P4_R1200[page]]), {
+          status: 200,
+          headers: { "content-type": "application/json" }
+        });
+      }
+      return new Response("not found", { status: 404 });
+    });
+    vi.spyOn(Math, "random").mockReturnValue(0.6);
+
+    const seed = await getNextPuzzle(SETTINGS);
+
+    expect(seed.puzzleId).toBe("p-2");
+    expect(fetchSpy).toHaveBeenCalledTimes(2);
+    expect(String(fetchSpy.mock.calls[1][0])).toContain(pagePaths[1]);
+  });
+
+  it("rejects a combo missing from a paged manifest", async () => {
+    const fetchSpy = vi.spyOn(globalThis, "fetch");
+    fetchSpy.mockImplementation(async (input) => {
+      const url = String(input);
+      if (url.endsWith("/puzzles/manifest.json")) {
+        const manifest = {
+          ...MANIFEST,
+          shardPattern: "lichess/p{pieceCount}/r{ratingBucket}.p{page}.json",
+          pageSize: 1,
+          pages: {
+            "p4-r1400": [{ path: "lichess/p4/r1400.p0.json", sha256: "0".repeat(64), bytes: 256, puzzles: 1 }]
+          }
+        };
+        return new Response(JSON.stringify(manifest), {
+          status: 200,
+          headers: { "content-type": "application/json" }
+        });
+      }
+      return new Response("not found", { status: 404 });
+    });
+
+    await expect(getNextPuzzle(SETTINGS)).rejects.toThrow("Puzzle manifest lists no pages for p4-r1200");
+    expect(fetchSpy).toHaveBeenCalledTimes(1);
+  });
+
+  it("rejects a manifest for columnar shards", async () => {
+    const fetchSpy = vi.spyOn(globalThis, "fetch");
+    fetchSpy.mockImplementation(async (input) => {
+      const url = String(input);
+      if (url.endsWith("/puzzles/manifest.json")) {
+        const manifest = { ...MANIFEST, shardPattern: "lichess/p{pieceCount}/r{ratingBucket}.cols.json", shardFormat: "columnar" };
+        return new Response(JSON.stringify(manifest), {
+          status: 200,
+          headers: { "content-type": "application/json" }
+        });
+      }
+      return new Response("not found", { status: 404 });
+    });
+
+    await expect(getNextPuzzle(SETTINGS)).rejects.toThrow('Unsupported puzzle shard format "columnar"');
+    await expect(getPuzzleCatalog()).rejects.toThrow("--shard-format json");
+    expect(fetchSpy).toHaveBeenCalledTimes(1);
+  });
+
   it("exposes piece-count and rating buckets from manifest", async () => {
     mockStaticDb();
 
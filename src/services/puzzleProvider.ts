@@ -15,6 +15,16 @@ export interface PuzzleRecallSeed {
   source: PuzzleSource;
 }
 
+interface PuzzleShardEntry {
+  path: string;
+  sha256: string;
+  bytes: number;
+}
+
+interface PuzzlePageEntry extends PuzzleShardEntry {
+  puzzles: number;
+}
+
 interface PuzzleManifest {
   version: number;
   generatedAt: string;
@@ -24,6 +34,9 @@ interface PuzzleManifest {
   ratingBuckets: number[];
   countsByCombo: Record<string, number>;
   shardPattern: string;
+  shardFormat: string;
+  shards?: Record<string, PuzzleShardEntry>;
+  pages?: Record<string, PuzzlePageEntry[]>;
   totalCount: number;
 }
 
@@ -52,6 +65,8 @@ const RECENT_IDS_SIZE = 50;
 const MANIFEST_FILE = "manifest.json";
 const MISSING_DB_HINT = "Puzzle DB not found. Run `npm run puzzles:build` to generate `public/puzzles/*`.";
 const MANIFEST_VERSION = 6;
+// The builder's default shard encoding; columnar shards are for other readers.
+const SHARD_FORMAT = "json";
 const MAX_CLEAR_CONTINUATION_PLIES = 4;
 
 let manifestPromise: Promise<PuzzleManifest> | null = null;
@@ -167,6 +182,7 @@ function parseManifest(raw: unknown): PuzzleManifest {
   const ratingBuckets = candidate.ratingBuckets;
   const countsByCombo = candidate.countsByCombo;
   const shardPattern = candidate.shardPattern;
+  const shardFormat = candidate.shardFormat ?? SHARD_FORMAT;
   const totalCount = candidate.totalCount;
 
   if (
@@ -179,11 +195,15 @@ function parseManifest(raw: unknown): PuzzleManifest {
     !countsByCombo ||
     typeof countsByCombo !== "object" ||
     typeof shardPattern !== "string" ||
+    typeof shardFormat !== "string" ||
     typeof totalCount !== "number"
   ) {
     throw new Error(`Invalid puzzle manifest shape. ${MISSING_DB_HINT}`);
   }
 
+  const shards = parseShardEntries(candidate.shards);
+  const pages = parsePageEntries(candidate.pages);
+
   const parsedPieceCounts = pieceCounts.map((value) => Number(value)).filter((value) => Number.isFinite(value));
   const parsedRatingBuckets = ratingBuckets.map((value) => Number(value)).filter((value) => Number.isFinite(value));
   if (parsedPieceCounts.length === 0 || parsedRatingBuckets.length === 0) {
@@ -199,10 +219,62 @@ function parseManifest(raw: unknown): PuzzleManifest {
     ratingBuckets: parsedRatingBuckets,
     countsByCombo: countsByCombo as Record<string, number>,
     shardPattern,
+    shardFormat,
+    ...(shards ? { shards } : {}),
+    ...(pages ? { pages } : {}),
     totalCount
   };
 }
 
+function parseShardEntries(raw: unknown): Record<string, PuzzleShardEntry> | undefined {
+  if (raw === undefined) {
+    return undefined;
+  }
+  if (!raw || typeof raw !== "object") {
+    throw new Error(`Invalid puzzle manifest shards. ${MISSING_DB_HINT}`);
+  }
+
+  const entries: Record<string, PuzzleShardEntry> = {};
+  for (const [combo, value] of Object.entries(raw as Record<string, unknown>)) {
+    const entry = value as Record<string, unknown> | null;
+    if (!entry || typeof entry.path !== "string" || typeof entry.sha256 !== "string" || typeof entry.bytes !== "number") {
+      throw new Error(`Invalid puzzle manifest shard entry for ${combo}. ${MISSING_DB_HINT}`);
+    }
+    entries[combo] = { path: entry.path, sha256: entry.sha256, bytes: entry.bytes };
+  }
+  return entries;
+}
+
+function parsePageEntries(raw: unknown): Record<string, PuzzlePageEntry[]> | undefined {
+  if (raw === undefined) {
+    return undefined;
+  }
+  if (!raw || typeof raw !== "object") {
+    throw new Error(`Invalid puzzle manifest pages. ${MISSING_DB_HINT}`);
+  }
+
+  const pages: Record<string, PuzzlePageEntry[]> = {};
+  for (const [combo, value] of Object.entries(raw as Record<string, unknown>)) {
+    if (!Array.isArray(value) || value.length === 0) {
+      throw new Error(`Invalid puzzle manifest pages for ${combo}. ${MISSING_DB_HINT}`);
+    }
+    pages[combo] = value.map((item) => {
+      const entry = item as Record<string, unknown> | null;
+      if (
+        !entry ||
+        typeof entry.path !== "string" ||
+        typeof entry.sha256 !== "string" ||
+        typeof entry.bytes !== "number" ||
+        typeof entry.puzzles !== "number"
+      ) {
+        throw new Error(`Invalid puzzle manifest page entry for ${combo}. ${MISSING_DB_HINT}`);
+      }
+      return { path: entry.path, sha256: entry.sha256, bytes: entry.bytes, puzzles: entry.puzzles };
+    });
+  }
+  return pages;
+}
+
 async function loadManifest(): Promise<PuzzleManifest> {
   if (!manifestPromise) {
     manifestPromise = fetchJson(puzzleAssetUrl(MANIFEST_FILE))
@@ -215,7 +287,42 @@ async function loadManifest(): Promise<PuzzleManifest> {
   return manifestPromise;
 }
 
+function pickPage(pages: PuzzlePageEntry[]): PuzzlePageEntry {
+  // Weight by puzzle count so the last, shorter page is not over-sampled.
+  const total = pages.reduce((sum, page) => sum + page.puzzles, 0);
+  let remaining = Math.random() * total;
+  for (const page of pages) {
+    remaining -= page.puzzles;
+    if (remaining < 0) {
+      return page;
+    }
+  }
+  return pages[pages.length - 1];
+}
+
 function shardPathFor(manifest: PuzzleManifest, settings: PuzzleSettings): string {
+  const combo = comboKey(settings);
+  if (manifest.pages) {
+    // Page filenames carry a page number (and maybe a hash), so only the manifest can name them.
+    const pages = manifest.pages[combo];
+    if (!pages) {
+      throw new Error(`Puzzle manifest lists no pages for ${combo}. Regenerate puzzle DB.`);
+    }
+    return pickPage(pages).path;
+  }
+
+  if (manifest.shards) {
+    const hashedShard = manifest.shards[combo];
+    if (!hashedShard) {
+      throw new Error(`Puzzle manifest lists no shard for ${combo}. Regenerate puzzle DB.`);
+    }
+    return hashedShard.path;
+  }
+
+  if (manifest.shardPattern.includes("{page}")) {
+    throw new Error("Puzzle manifest has a paged shard pattern but no pages. Regenerate puzzle DB.");
+  }
+
   if (manifest.shardPattern.includes("{pieceCount}") && manifest.shardPattern.includes("{ratingBucket}")) {
     return manifest.shardPattern
       .replaceAll("{pieceCount}", String(settings.pieceCount))
@@ -226,9 +333,9 @@ function shardPathFor(manifest: PuzzleManifest, settings: PuzzleSettings): strin
 }
 
 async function loadShard(manifest: PuzzleManifest, settings: PuzzleSettings): Promise<PuzzleRecallSeed[]> {
-  const key = comboKey(settings);
-  if (!shardPromises.has(key)) {
-    const file = shardPathFor(manifest, settings);
+  // Paged combos resolve to one random page per call; each file is cached once.
+  const file = shardPathFor(manifest, settings);
+  if (!shardPromises.has(file)) {
     const promise = fetchJson(puzzleAssetUrl(file))
       .then((raw) => {
         if (!Array.isArray(raw)) {
@@ -239,14 +346,14 @@ async function loadShard(manifest: PuzzleManifest, settings: PuzzleSettings): Pr
           .filter((item): item is PuzzleRecallSeed => item !== null);
       })
       .catch((error) => {
-        shardPromises.delete(key);
+        shardPromises.delete(file);
         throw error;
       });
 
-    shardPromises.set(key, promise);
+    shardPromises.set(file, promise);
   }
 
-  return shardPromises.get(key)!;
+  return shardPromises.get(file)!;
 }
 
 function dedupeSeeds(items: PuzzleRecallSeed[]): PuzzleRecallSeed[] {
@@ -258,6 +365,9 @@ export async function getPuzzleCatalog(): Promise<PuzzleCatalog> {
   if (manifest.version !== MANIFEST_VERSION) {
     throw new Error(`Unsupported puzzle manifest version ${manifest.version}. Regenerate puzzle DB.`);
   }
+  if (manifest.shardFormat !== SHARD_FORMAT) {
+    throw new Error(`Unsupported puzzle shard format "${manifest.shardFormat}". Rebuild the puzzle DB with --shard-format json.`);
+  }
 
   return {
     pieceCounts: [...manifest.pieceCounts].sort((a, b) => a - b),
@@ -271,6 +381,9 @@ export async function getNextPuzzle(settings: PuzzleSettings): Promise<PuzzleRec
   if (manifest.version !== MANIFEST_VERSION) {
     throw new Error(`Unsupported puzzle manifest version ${manifest.version}. Regenerate puzzle DB.`);
   }
+  if (manifest.shardFormat !== SHARD_FORMAT) {
+    throw new Error(`Unsupported puzzle shard format "${manifest.shardFormat}". Rebuild the puzzle DB with --shard-format json.`);
+  }
 
   if (!manifest.pieceCounts.includes(settings.pieceCount) || !manifest.ratingBuckets.includes(settings.ratingBucket)) {
     throw new Error("Selected puzzle settings are not available in this puzzle DB.");